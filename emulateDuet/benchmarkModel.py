@@ -0,0 +1,148 @@
+#!python3
+"""
+Compares the selective object model parse used by DuetLapse3 with a full json parse
+# Copyright (C) 2020 Stuart Strolin all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Payloads can be files captured from a printer e.g.
+#   curl http://printer/machine/status -o status.json
+# or fetched from a printer with -duet.  With neither, a large object model is generated
+"""
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+import urllib.request
+
+benchmarkModelVersion = '1.0.0'
+
+
+def init():
+    parser = argparse.ArgumentParser(
+            description='Benchmark for the DuetLapse3 object model parse. V' + benchmarkModelVersion,
+            allow_abbrev=False)
+    parser.add_argument('payloads', type=str, nargs='*', help='Files with a /machine/status response')
+    parser.add_argument('-duet', type=str, nargs=1, default=[''],
+                        help='Also fetch /machine/status from this printer e.g. 192.168.1.10')
+    parser.add_argument('-dl3', type=str, nargs=1,
+                        default=[os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                              '..', 'plugin3.6.x', 'Code', 'dsf', 'DuetLapse3.py')],
+                        help='DuetLapse3.py to test. Default = the 3.6 plugin version')
+    parser.add_argument('-repeat', type=int, nargs=1, default=[50], help='Parses per payload. Default = 50')
+    parser.add_argument('-size', type=int, nargs=1, default=[20],
+                        help='Scale of the generated model (used when there are no other payloads). Default = 20')
+    return vars(parser.parse_args())
+
+
+def loadDuetLapse3(filename):
+    # Import without running - DuetLapse3 only starts when run as __main__
+    spec = importlib.util.spec_from_file_location('DuetLapse3', filename)
+    dl3 = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dl3)
+    dl3.logger = logging.getLogger('DuetLapse3')
+    return dl3
+
+
+def generateModel(size):
+    # Roughly the shape of a DSF object model for a machine with many tools, heaters and plugins
+    model = {'boards': [{'firmwareVersion': '3.6.0', 'name': 'Duet 3 MB6HC', 'canAddress': i,
+                         'v12': {'current': 12.1, 'max': 12.3, 'min': 11.9}} for i in range(size // 4 + 1)],
+             'directories': {'gCodes': '0:/gcodes', 'macros': '0:/macros', 'system': '0:/sys'},
+             'fans': [{'actualValue': 0.5, 'name': 'fan' + str(i), 'requestedValue': 0.5,
+                       'thermostatic': {'heaters': [1, 2], 'highTemperature': 50.0}} for i in range(size * 2)],
+             'global': {'DL3msg': [3, 'DuetLapse3.snapshot', None] + [None] * 12, 'DL3del': None},
+             'heat': {'heaters': [{'active': 200.0, 'current': 199.5, 'sensor': i, 'state': 'active',
+                                   'model': {'coolingExp': 1.4, 'deadTime': 5.2, 'heatingRate': 2.5,
+                                             'pid': {'p': 10.0, 'i': 0.1, 'd': 50.0}},
+                                   'monitors': [{'action': 0, 'condition': 'tooHigh', 'limit': 300.0}] * 3}
+                                  for i in range(size * 3)]},
+             'job': {'file': {'fileName': '0:/gcodes/big job.gcode',
+                              'layers': [{'height': 0.2, 'filament': [1.0, 2.0]} for _ in range(size * 20)]},
+                     'layer': 12, 'layerTime': 3.2},
+             'messages': [{'content': 'a message with } ] [ { in it', 'time': '2024-01-01T00:00:00', 'type': 0}] * size,
+             'move': {'axes': [{'letter': letter, 'machinePosition': 1.0, 'steps': 80.0, 'drivers': ['0.1']}
+                               for letter in 'XYZUVW'],
+                      'extruders': [{'position': 1.0, 'nonlinear': {'a': 0, 'b': 0}} for _ in range(size)]},
+             'plugins': {'plugin' + str(i): {'id': 'plugin' + str(i), 'data': {'values': [1.5, 2.5, 3.5] * 10},
+                                             'sbcPermissions': ['fileSystemAccess', 'launchProcesses'],
+                                             'dwcFiles': ['file' + str(j) + '.js' for j in range(50)]}
+                         for i in range(size)},
+             'sensors': {'analog': [{'lastReading': 20.1 + i, 'name': 'sensor' + str(i), 'type': 'thermistor',
+                                     'beta': 4725.0, 'c': 7.06e-8, 'r25': 100000.0} for i in range(size * 10)]},
+             'state': {'status': 'processing', 'upTime': 1234},
+             'tools': [{'name': 'T' + str(i), 'state': 'active', 'offsets': [0.0, 0.0, 0.0], 'heaters': [i]}
+                       for i in range(size)]}
+    model['plugins']['DuetLapse3'] = {'id': 'DuetLapse3', 'pid': 1234, 'dwcFiles': []}
+    return json.dumps(model, separators=(',', ':'))
+
+
+def select(value, selection):
+    # What the selective parse should return - taken from the full parse
+    if selection is None or not isinstance(value, dict):
+        return value
+    return {key: select(value[key], selection[key]) for key in selection if key in value}
+
+
+def checkDeepNesting(dl3):
+    # A value nested deeper than the skip pattern must make the selective parse fall back, not misread the model
+    deep = {'value': 1}
+    for _ in range(40):
+        deep = {'nested': deep}
+    model = {'plugins': {'other': {'data': deep, 'padding': 'x' * 20000}, 'DuetLapse3': {'pid': 1234}},
+             'state': {'status': 'processing'}}
+    text = json.dumps(model, separators=(',', ':'))
+    selection = dl3.modelSelection
+    if select(dl3.parseModel(text), selection) != select(model, selection):
+        print('deeply nested value -- selective parse does not match the full parse')
+        return False
+    return True
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark(dl3, name, text, repeat):
+    full = json.loads(text)
+    selected = dl3.parseModel(text)
+    if selected != select(full, dl3.modelSelection):
+        print(name + ' -- selective parse does not match the full parse')
+        return
+    fullms = timeit(lambda: json.loads(text), repeat)
+    selectms = timeit(lambda: dl3.parseModel(text), repeat)
+    print('{0:<30} {1:>8.1f} KB {2:>10.2f} ms {3:>10.2f} ms {4:>8.2f} x'.format(
+          name[-30:], len(text) / 1024, fullms, selectms, fullms / selectms))
+
+
+if __name__ == "__main__":
+    args = init()
+    dl3 = loadDuetLapse3(args['dl3'][0])
+    if dl3.jsonValue is None:
+        print('Python ' + sys.version.split()[0] + ' -- DuetLapse3 will always use the full parse (needs 3.11 or later)')
+        sys.exit(0)
+
+    if not checkDeepNesting(dl3):
+        sys.exit(1)
+
+    payloads = []
+    for filename in args['payloads']:
+        with open(filename, 'r', encoding='utf-8') as f:
+            payloads.append((os.path.basename(filename), f.read()))
+    if args['duet'][0] != '':
+        with urllib.request.urlopen('http://' + args['duet'][0] + '/machine/status', timeout=10) as response:
+            payloads.append((args['duet'][0], response.read().decode('utf-8')))
+    if len(payloads) == 0:
+        size = args['size'][0]
+        for scale in (size // 4, size, size * 4):
+            payloads.append(('generated size ' + str(scale), generateModel(max(1, scale))))
+
+    print('{0:<30} {1:>11} {2:>13} {3:>13} {4:>10}'.format('payload', 'size', 'full parse', 'selective', 'speedup'))
+    for name, text in payloads:
+        benchmark(dl3, name, text, args['repeat'][0])
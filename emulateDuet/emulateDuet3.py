@@ -0,0 +1,751 @@
+#!python3
+"""
+Emulates a Duet3D printer so that DuetLapse3 can be run and tested without a printer
+# Copyright (C) 2020 Stuart Strolin all rights reserved.
+# Released under The MIT License. Full text available via https://opensource.org/licenses/MIT
+#
+# Provides the SBC (DSF) http api used by DuetLapse3
+#   /machine/connect  /machine/disconnect  /machine/status  /machine/code
+#   /machine  (websocket object model subscription)
+# and optionally the DSF socket (-socket) for Command and Subscribe connections
+# or (-mode standalone) the RepRapFirmware http api
+#   /rr_connect  /rr_disconnect  /rr_model (including seqs)  /rr_gcode  /rr_reply
+#
+# Print jobs are played from a script (-script) or a simple job built from -layers and -layertime
+# Latency and faults can be injected and request counts are available from /emulator/stats
+"""
+
+import argparse
+import sys
+import time
+import json
+import os
+import re
+import threading
+import socket
+import select
+import signal
+import logging
+import base64
+import hashlib
+import struct
+import copy
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+emulateDuet3Version = '1.1.0'
+
+
+def init():
+    parser = argparse.ArgumentParser(
+            description='Emulated Duet3D printer for testing DuetLapse3. V' + emulateDuet3Version,
+            allow_abbrev=False)
+    parser.add_argument('-host', type=str, nargs=1, default=['127.0.0.1'],
+                        help='The ip address this service listens on. Default = 127.0.0.1')
+    parser.add_argument('-port', type=int, nargs=1, default=[8080],
+                        help='Specify the port on which the server listens. Default = 8080')
+    parser.add_argument('-version', type=str, nargs=1, default=['3.6.0'],
+                        help='Firmware version reported. Default = 3.6.0')
+    parser.add_argument('-layers', type=int, nargs=1, default=[20], help='Number of layers in the job. Default = 20')
+    parser.add_argument('-layertime', type=float, nargs=1, default=[5.0],
+                        help='Seconds per layer. Default = 5')
+    parser.add_argument('-startdelay', type=float, nargs=1, default=[10.0],
+                        help='Seconds before the job starts. Default = 10')
+    parser.add_argument('-socket', type=str, nargs=1, default=[''],
+                        help='Also serve the DSF socket at this path e.g. /tmp/dcs.sock. Default = none')
+    parser.add_argument('-mode', type=str, nargs=1, choices=['sbc', 'standalone'], default=['sbc'],
+                        help='Which printer api to emulate. Default = sbc')
+    parser.add_argument('-script', type=str, nargs=1, default=[''],
+                        help='json file with the print jobs to play. Default = one job from -layers and -layertime')
+    parser.add_argument('-latency', type=float, nargs=1, default=[0.0],
+                        help='Milliseconds added to every request. Default = 0')
+    parser.add_argument('-jitter', type=float, nargs=1, default=[0.0],
+                        help='Random milliseconds (0 to jitter) added to the latency. Default = 0')
+    parser.add_argument('-errorrate', type=float, nargs=1, default=[0.0],
+                        help='Fraction of requests answered with 503. Default = 0')
+    parser.add_argument('-droprate', type=float, nargs=1, default=[0.0],
+                        help='Fraction of requests where the connection is closed without an answer. Default = 0')
+    parser.add_argument('-seed', type=int, nargs=1, default=[0],
+                        help='Random seed for jitter and faults so that runs can be repeated. Default = 0')
+    parser.add_argument('-verbose', action='store_true', help='Detailed Logging')
+    args = vars(parser.parse_args())
+
+    global host, port, firmwareVersion, layers, layertime, startdelay, verbose, socketpath
+    global mode, script, latency, jitter, errorrate, droprate
+    socketpath = args['socket'][0]
+    mode = args['mode'][0]
+    if mode == 'standalone':
+        socketpath = ''  # DSF only
+    script = args['script'][0]
+    latency = args['latency'][0]
+    jitter = args['jitter'][0]
+    errorrate = args['errorrate'][0]
+    droprate = args['droprate'][0]
+    random.seed(args['seed'][0])
+    host = args['host'][0]
+    port = args['port'][0]
+    firmwareVersion = args['version'][0]
+    layers = args['layers'][0]
+    layertime = args['layertime'][0]
+    startdelay = args['startdelay'][0]
+    verbose = args['verbose']
+
+    global logger
+    logger = logging.getLogger(__name__)
+    logger.propagate = False
+    c_handler = logging.StreamHandler(sys.stdout)
+    c_handler.setFormatter(logging.Formatter('emulateDuet3 %(threadName)s - %(message)s'))
+    logger.addHandler(c_handler)
+    if verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+
+###########################
+# Object model
+###########################
+
+def newModel():
+    return {'boards': [{'firmwareVersion': firmwareVersion}],
+            'global': {},
+            'job': {'file': {'fileName': None}, 'layer': None, 'layerTime': None},
+            'move': {'axes': [{'letter': 'X', 'machinePosition': 0.0},
+                              {'letter': 'Y', 'machinePosition': 0.0},
+                              {'letter': 'Z', 'machinePosition': 0.0}]},
+            'plugins': {},
+            'state': {'status': 'idle', 'upTime': 0}}
+
+
+def changeModel(change, *args):
+    # All changes to the model go through here so that subscribers are woken up
+    # and the standalone seqs are kept up to date
+    global modelVersion
+    with modelCondition:
+        before = {key: slowValues(key, value) for key, value in model.items()}
+        change(*args)
+        for key, value in model.items():
+            if slowValues(key, value) != before.get(key):
+                seqs[key] = seqs.get(key, 0) + 1
+        modelVersion += 1
+        modelCondition.notify_all()
+
+
+def slowValues(key, value):
+    # The part of a section that is not returned by rr_model?flags=f - seqs only count changes to these
+    value = copy.deepcopy(value)
+    if key == 'state':
+        value.pop('status', None)
+        value.pop('upTime', None)
+    elif key == 'job':
+        value.pop('layer', None)
+        value.pop('layerTime', None)
+    elif key == 'move':
+        for axis in value['axes']:
+            axis.pop('machinePosition', None)
+    return value
+
+
+def frequentModel():
+    # What RepRapFirmware returns for rr_model?flags=f - the live values and the seqs
+    with modelCondition:
+        return {'state': {'status': model['state']['status'], 'upTime': model['state']['upTime']},
+                'job': {'layer': model['job']['layer'], 'layerTime': model['job']['layerTime']},
+                'move': {'axes': [{'machinePosition': axis['machinePosition']} for axis in model['move']['axes']]},
+                'seqs': dict(seqs)}
+
+
+def getModelCopy():
+    with modelCondition:
+        return copy.deepcopy(model), modelVersion
+
+
+def diffModel(old, new):
+    # Creates a patch that turns old into new (the format DSF sends to subscribers)
+    patch = {}
+    for key, value in new.items():
+        before = old.get(key) if isinstance(old, dict) else None
+        if isinstance(value, dict) and isinstance(before, dict):
+            child = diffModel(before, value)
+            if len(child) > 0:
+                patch[key] = child
+        elif isinstance(value, list) and isinstance(before, list) and len(value) == len(before) \
+                and all(isinstance(v, dict) for v in value):
+            children = [diffModel(before[i], value[i]) for i in range(len(value))]
+            if any(len(child) > 0 for child in children):
+                patch[key] = children
+        elif value != before:
+            patch[key] = copy.deepcopy(value)
+    return patch
+
+
+###########################
+# Gcode handling
+###########################
+
+def runGcode(code):
+    # Handles the gcode that DuetLapse3 sends
+    global gcodeCount
+    code = code.strip()
+    logger.info('Gcode: ' + code)
+    with statsLock:
+        gcodeCount += 1
+    if code.startswith('M25'):
+        if model['state']['status'] == 'processing':
+            changeModel(setStatus, 'pausing')
+            time.sleep(0.2)
+            changeModel(setStatus, 'paused')
+    elif code.startswith('M24'):
+        if model['state']['status'] == 'paused':
+            changeModel(setStatus, 'resuming')
+            time.sleep(0.2)
+            changeModel(setStatus, 'processing')
+    elif code.startswith('G0') or code.startswith('G1'):
+        changeModel(moveHead, code)
+    elif code.startswith('set global.DL3del'):
+        changeModel(setDeletes, code.split('=', 1)[1])
+    elif code.startswith(macroName):
+        match = re.search(r'B"([^"]*)"', code)
+        if match:
+            changeModel(runMacro, match.group(1))
+    return ''
+
+
+def setStatus(status):
+    model['state']['status'] = status
+
+
+def moveHead(code):
+    for i, letter in enumerate(['X', 'Y', 'Z']):
+        match = re.search(letter + r'(-?[0-9.]+)', code)
+        if match:
+            model['move']['axes'][i]['machinePosition'] = float(match.group(1))
+
+
+def setDeletes(value):
+    value = value.strip().strip('{}')
+    model['global']['DL3del'] = [int(v) for v in value.split(',') if v.strip() != '']
+
+
+def runMacro(message):
+    # Same behaviour as sys/M3291.g
+    variables = model['global']
+    if variables.get('DL3msg') is None:
+        variables['DL3msg'] = [0] + [None] * (queueLength - 1)
+        variables['DL3del'] = None
+    queue = variables['DL3msg']
+    if message == 'Clear':
+        variables['DL3msg'] = [queue[0]] + [None] * (queueLength - 1)
+        variables['DL3del'] = None
+    elif message == 'Del':
+        if variables.get('DL3del') is not None:
+            for i in variables['DL3del']:
+                queue[i] = None
+            variables['DL3del'] = None
+    else:
+        for i in range(1, queueLength):
+            if queue[i] is None:
+                queue[0] += 1
+                queue[i] = message
+                return
+        logger.info('DL3msg queue:  Full')
+
+
+###########################
+# Print jobs
+###########################
+
+def loadScript():
+    # A script is a list of jobs played one after the other e.g.
+    # {"jobs": [{"file": "cube.gcode", "startdelay": 5, "layers": 10, "layertime": 3,
+    #            "events": [{"layer": 4, "pause": 10}, {"layer": 6, "message": "DuetLapse3.snapshot"}]}],
+    #  "repeat": false}
+    if script == '':
+        return {'jobs': [{'file': 'emulated job.gcode', 'startdelay': startdelay,
+                          'layers': layers, 'layertime': layertime}]}
+    try:
+        with open(script, 'r') as f:
+            plan = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.info('Could not load script ' + script + ' -- ' + str(e))
+        sys.exit(2)
+    if len(plan.get('jobs', [])) == 0:
+        logger.info('Script ' + script + ' has no jobs')
+        sys.exit(2)
+    return plan
+
+
+def startJob(filename):
+    model['job']['file']['fileName'] = '0:/gcodes/' + filename
+    model['job']['layer'] = 1
+    model['job']['layerTime'] = 0
+    model['state']['status'] = 'processing'
+
+
+def nextLayer():
+    model['job']['layer'] += 1
+    model['job']['layerTime'] = 0
+    model['move']['axes'][2]['machinePosition'] = round(model['job']['layer'] * 0.2, 2)
+
+
+def endJob():
+    model['job']['file']['fileName'] = None
+    model['job']['layer'] = None
+    model['job']['layerTime'] = None
+    model['state']['status'] = 'idle'
+
+
+def tick(elapsed):
+    model['state']['upTime'] = int(time.time() - startTime)
+    if model['job']['layerTime'] is not None:
+        model['job']['layerTime'] = round(model['job']['layerTime'] + elapsed, 1)
+
+
+def runEvents(events):
+    # Returns False if the job was cancelled
+    for event in events:
+        logger.info('Event: ' + json.dumps(event))
+        if 'message' in event:  # Same as M3291 B"message" in the print file
+            changeModel(runMacro, event['message'])
+        if 'gcode' in event:
+            runGcode(event['gcode'])
+        if 'pause' in event:  # Paused by the print file e.g. filament change
+            if model['state']['status'] == 'processing':
+                changeModel(setStatus, 'pausing')
+                time.sleep(0.2)
+                changeModel(setStatus, 'paused')
+            time.sleep(event['pause'])
+            if model['state']['status'] == 'paused':
+                changeModel(setStatus, 'resuming')
+                time.sleep(0.2)
+                changeModel(setStatus, 'processing')
+        if event.get('cancel'):
+            return False
+    return True
+
+
+def playJob(job):
+    filename = job.get('file', 'emulated job.gcode')
+    joblayers = job.get('layers', layers)
+    joblayertime = job.get('layertime', layertime)
+    delay = job.get('startdelay', startdelay)
+    events = {}
+    for event in job.get('events', []):
+        events.setdefault(event.get('layer', 1), []).append(event)
+
+    logger.info('Job ' + filename + ' will start in ' + str(delay) + ' seconds')
+    time.sleep(delay)
+    changeModel(startJob, filename)
+    logger.info('Job ' + filename + ' started')
+    running = runEvents(events.get(1, []))
+    layerStart = time.time()
+    while running:
+        time.sleep(0.5)
+        status = model['state']['status']
+        if status == 'paused':
+            layerStart += 0.5  # Layers do not progress while paused
+            continue
+        changeModel(tick, 0.5)
+        if time.time() - layerStart >= joblayertime:
+            if model['job']['layer'] >= joblayers:
+                break
+            changeModel(nextLayer)
+            logger.info('Layer ' + str(model['job']['layer']))
+            running = runEvents(events.get(model['job']['layer'], []))
+            layerStart = time.time()
+    if not running:
+        logger.info('Job ' + filename + ' cancelled')
+        changeModel(setStatus, 'cancelling')
+        time.sleep(1)
+    changeModel(endJob)
+    logger.info('Job ' + filename + ' completed')
+
+
+def jobLoop():
+    while True:
+        for job in plan['jobs']:
+            playJob(job)
+        if not plan.get('repeat', False):
+            break
+    logger.info('All jobs completed')
+    while True:  # Keep the uptime ticking
+        time.sleep(1)
+        changeModel(tick, 1)
+
+
+###########################
+# Latency, faults and request stats
+###########################
+
+def injectFault():
+    # Returns None, 'error' or 'drop'
+    delay = latency + random.uniform(0, jitter)
+    if delay > 0:
+        time.sleep(delay / 1000)
+    if droprate > 0 and random.random() < droprate:
+        return 'drop'
+    if errorrate > 0 and random.random() < errorrate:
+        return 'error'
+    return None
+
+
+def statName(path, query):
+    # e.g. /machine/status, /rr_model?key=job or /rr_model?flags=d99fn
+    if path == '/rr_model':
+        if 'key' in query:
+            return path + '?key=' + query['key'][0]
+        return path + '?flags=' + query.get('flags', [''])[0]
+    return path
+
+
+def recordRequest(name, result, size, elapsed):
+    with statsLock:
+        entry = requestStats.setdefault(name, {'calls': 0, 'errors': 0, 'dropped': 0, 'bytes': 0, 'seconds': 0.0})
+        entry['calls'] += 1
+        if result == 'drop':
+            entry['dropped'] += 1
+        elif isinstance(result, int) and result >= 400:
+            entry['errors'] += 1
+        entry['bytes'] += size
+        entry['seconds'] = round(entry['seconds'] + elapsed, 6)
+
+
+def getStats(reset=False):
+    global requestStats, gcodeCount
+    with statsLock:
+        stats = {'version': emulateDuet3Version,
+                 'mode': mode,
+                 'upTime': round(time.time() - startTime, 1),
+                 'gcode': gcodeCount,
+                 'requests': copy.deepcopy(requestStats)}
+        if reset:
+            requestStats = {}
+            gcodeCount = 0
+    return stats
+
+
+###########################
+# http server
+###########################
+
+def wsMask(data, mask):
+    if len(data) == 0:
+        return data
+    repeated = (mask * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(data), 'big')
+
+
+class MyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def send_body(self, code, body, contenttype='application/json'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        recordRequest(self.statname, code, len(body), time.time() - self.started)
+
+    def start_request(self):
+        # Returns False if a fault was injected and the request has been dealt with
+        self.started = time.time()
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        self.statname = statName(parsed.path, query)
+        if parsed.path.startswith('/emulator/'):  # Never delayed or faulted
+            return parsed.path, query
+        fault = injectFault()
+        if fault == 'drop':
+            recordRequest(self.statname, 'drop', 0, time.time() - self.started)
+            self.close_connection = True
+            return None, None
+        if fault == 'error':
+            self.send_body(503, '')
+            return None, None
+        return parsed.path, query
+
+    def do_GET(self):
+        path, query = self.start_request()
+        if path is None:
+            return
+        if path == '/emulator/stats':
+            self.send_body(200, json.dumps(getStats(query.get('reset', [''])[0] == 'true'), indent=2))
+        elif mode == 'sbc' and path.startswith('/machine'):
+            self.sbc(path)
+        elif mode == 'standalone' and path.startswith('/rr_'):
+            self.standalone(path, query)
+        else:
+            self.send_body(404, '')
+
+    def do_POST(self):
+        path, query = self.start_request()
+        if path is None:
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        if mode == 'sbc' and path == '/machine/code':
+            self.send_body(200, runGcode(body), 'text/plain')
+        else:
+            self.send_body(404, '')
+
+    def sbc(self, path):
+        if path == '/machine' and self.headers.get('Upgrade', '').lower() == 'websocket':
+            recordRequest(self.statname, 101, 0, time.time() - self.started)
+            self.subscribe()
+        elif path == '/machine/connect':
+            self.send_body(200, json.dumps({'sessionKey': 12345, 'apiLevel': 1}))
+        elif path == '/machine/disconnect':
+            self.send_body(204, '')
+        elif path == '/machine/status':
+            self.send_body(200, json.dumps(getModelCopy()[0]))
+        else:
+            self.send_body(404, '')
+
+    def standalone(self, path, query):
+        if path == '/rr_connect':
+            self.send_body(200, json.dumps({'err': 0, 'sessionTimeout': 8000, 'boardType': 'emulated',
+                                            'apiLevel': 2, 'sessionKey': 0}))
+        elif path == '/rr_disconnect':
+            self.send_body(200, json.dumps({'err': 0}))
+        elif path == '/rr_model':
+            key = query.get('key', [''])[0]
+            flags = query.get('flags', [''])[0]
+            if key == '':
+                result = frequentModel() if 'f' in flags else getModelCopy()[0]
+            else:
+                result = getModelCopy()[0]
+                for part in key.split('.'):  # e.g. state.status
+                    result = result.get(part) if isinstance(result, dict) else None
+            self.send_body(200, json.dumps({'key': key, 'flags': flags, 'result': result}))
+        elif path == '/rr_gcode':
+            runGcode(query.get('gcode', [''])[0])
+            self.send_body(200, json.dumps({'buff': 255}))
+        elif path == '/rr_reply':
+            self.send_body(200, '', 'text/plain')
+        else:
+            self.send_body(404, '')
+
+    # websocket subscription - the full model is sent first
+    # after that each 'OK\n' from the client gets the next patch.  'PING\n' is answered while waiting for a change
+    def subscribe(self):
+        key = self.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.wfile.flush()
+        logger.info('Subscriber connected')
+        self.close_connection = True
+        try:
+            last, version = getModelCopy()
+            self.ws_send(json.dumps(last))
+            waiting = False  # an 'OK' has been received and no patch sent yet
+            while True:
+                if not waiting or select.select([self.connection], [], [], 0)[0]:
+                    message = self.ws_recv()
+                    if message is None:
+                        break
+                    if message.startswith('PING'):
+                        self.ws_send('PONG\n')
+                    else:
+                        waiting = True
+                    continue
+                with modelCondition:  # wait for something to change
+                    if modelVersion == version:
+                        modelCondition.wait(0.5)
+                    changed = modelVersion != version
+                if changed:
+                    current, version = getModelCopy()
+                    self.ws_send(json.dumps(diffModel(last, current)))
+                    last = current
+                    waiting = False
+        except (OSError, ConnectionError) as e:
+            logger.debug(str(e))
+        logger.info('Subscriber disconnected')
+
+    def ws_send(self, message, opcode=1):
+        payload = message.encode('utf-8')
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 126]) + struct.pack('!H', length)
+        else:
+            header = bytes([0x80 | opcode, 127]) + struct.pack('!Q', length)
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def ws_recv(self):
+        header = self.rfile.read(2)
+        if len(header) < 2:
+            return None
+        opcode = header[0] & 0x0F
+        length = header[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if header[1] & 0x80 else b''
+        payload = self.rfile.read(length)
+        if mask:
+            payload = wsMask(payload, mask)
+        if opcode == 8:
+            return None
+        return payload.decode('utf-8')
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+###########################
+# DSF socket
+###########################
+
+class JsonStream:
+    # Reads concatenated JSON objects from a socket (the DSF socket has no delimiters)
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+
+    def send(self, message):
+        self.conn.sendall(json.dumps(message).encode('utf-8'))
+
+    def receive(self):
+        while True:
+            text = self.buffer.lstrip()
+            if text != '':
+                try:
+                    message, end = self.decoder.raw_decode(text)
+                    self.buffer = text[end:]
+                    return message
+                except ValueError:
+                    pass
+            data = self.conn.recv(65536)
+            if not data:
+                return None
+            self.buffer = text + data.decode('utf-8')
+
+
+def filterModel(current, filters):
+    # Only top level keys are filtered e.g. "job/**" sends all of job
+    if not filters:
+        return current
+    keys = [f.split('/')[0] for f in filters]
+    return {key: value for key, value in current.items() if key in keys}
+
+
+def socketClient(conn, clientId):
+    stream = JsonStream(conn)
+    try:
+        stream.send({'version': 12, 'id': clientId})
+        init = stream.receive()
+        if init is None:
+            return
+        mode = init.get('mode')
+        logger.info('Socket client ' + str(clientId) + ' connected in ' + str(mode) + ' mode')
+        stream.send({'success': True})
+        if mode == 'Command':
+            while True:
+                command = stream.receive()
+                if command is None:
+                    break
+                name = command.get('command')
+                started = time.time()
+                fault = injectFault()
+                if fault == 'drop':
+                    recordRequest('socket/' + str(name), 'drop', 0, time.time() - started)
+                    break
+                if fault == 'error':
+                    stream.send({'success': False, 'errorType': 'IOException', 'errorMessage': 'Injected fault'})
+                    recordRequest('socket/' + str(name), 503, 0, time.time() - started)
+                    continue
+                recordRequest('socket/' + str(name), 200, 0, time.time() - started)
+                if name == 'GetObjectModel':
+                    stream.send({'success': True, 'result': getModelCopy()[0]})
+                elif name == 'SimpleCode':
+                    stream.send({'success': True, 'result': runGcode(command.get('code', ''))})
+                elif name == 'StopPlugin':
+                    logger.info('StopPlugin requested for ' + str(command.get('plugin')))
+                    stream.send({'success': True})
+                else:
+                    stream.send({'success': False, 'errorType': 'ArgumentException',
+                                 'errorMessage': 'Unsupported command ' + str(name)})
+        elif mode == 'Subscribe':
+            filters = init.get('filters')
+            current, version = getModelCopy()
+            last = filterModel(current, filters)
+            stream.send(last)
+            while True:
+                ack = stream.receive()
+                if ack is None:
+                    break
+                with modelCondition:
+                    while modelVersion == version:
+                        modelCondition.wait()
+                current, version = getModelCopy()
+                current = filterModel(current, filters)
+                patch = diffModel(last, current)
+                last = current
+                if len(patch) == 0:  # Nothing this subscriber cares about - wait again
+                    continue
+                stream.send(patch)
+    except OSError as e:
+        logger.debug(str(e))
+    finally:
+        conn.close()
+        logger.info('Socket client ' + str(clientId) + ' disconnected')
+
+
+def socketLoop():
+    if os.path.exists(socketpath):
+        os.remove(socketpath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socketpath)
+    server.listen(5)
+    logger.info('Emulated DSF socket at ' + socketpath)
+    clientId = 0
+    while True:
+        conn, _ = server.accept()
+        clientId += 1
+        threading.Thread(name='socket' + str(clientId), target=socketClient, args=(conn, clientId), daemon=True).start()
+
+
+def quit_gracefully(*args):
+    logger.info('Requests served:')
+    for name, entry in sorted(getStats()['requests'].items()):
+        logger.info('  ' + name + ' -- ' + json.dumps(entry))
+    logger.info('Stopped')
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGINT, quit_gracefully)
+    signal.signal(signal.SIGTERM, quit_gracefully)
+    init()
+
+    macroName = 'M3291'
+    queueLength = 15
+    startTime = time.time()
+    modelCondition = threading.Condition()
+    modelVersion = 0
+    model = newModel()
+    seqs = {key: 0 for key in model}
+    seqs['reply'] = 0
+    statsLock = threading.Lock()
+    requestStats = {}
+    gcodeCount = 0
+    plan = loadScript()
+
+    threading.Thread(name='job', target=jobLoop, daemon=True).start()
+    if socketpath != '':
+        threading.Thread(name='socketServer', target=socketLoop, daemon=True).start()
+    server = ThreadingHTTPServer((host, port), MyHandler)
+    logger.info('Emulated Duet (' + mode + ') listening on http://' + host + ':' + str(port))
+    logger.info('Use DuetLapse3 with -duet ' + host + ':' + str(port))
+    server.serve_forever()
@@ -26,7 +26,7 @@ For use with virtual environments
 #
 """
 
-duetLapse3Version = '5.3.7'
+duetLapse3Version = '5.4.0'
 duet3DVersion = '3.6'
 
 """
@@ -82,6 +82,32 @@ Added 10s timeout to wget commands.  Accidental connection to stream will not re
 changed ffmpeg image capture to use -frames:v 1 -update true - should be more efficient
 removed terminate button when using SBC
 added argument -# to allow comments in config file
+5.4.0
+Object model reads are cached so that one fetch serves all calls in a poll cycle
+Printer calls use a pooled keep-alive session with per endpoint latency stats on the Info tab
+Added -subscribe to receive object model changes from DSF instead of polling
+Added -transport socket to use the local DSF socket instead of http (SBC only)
+Standalone boards are polled with one rr_model call per cycle - sections are only fetched when their seqs change
+Added -fleet to run many printers from one process with a shared http port, capture and encode limits
+Printer calls go through a circuit breaker with jittered exponential backoff - calls fail fast while the printer is unreachable
+Only the parts of /machine/status that are used are decoded - the rest is skipped without creating python objects
+Added ?metrics api with latency histograms (Prometheus text format) for printer calls, captures, encodes and the capture loop
+Stream cameras are read continuously in a thread - a capture saves the latest frame instead of starting ffmpeg
+Added -usbgrabber and -usbdevice1 / -usbdevice2 to keep usb cameras open in one ffmpeg process instead of running fswebcam per frame
+Web cameras are fetched with a pooled keep-alive session (checked and written atomically) instead of wget
+Cameras are captured together from one layer reading.  Capture times and skew are saved in frametimes.csv
+Added -addcamera for any number of cameras, and -policy1 / -policy2 for a per camera trigger (layer, every n layers or seconds)
+Videos for all cameras are created in parallel
+Added -framebuffer to keep recent stream / usb grabber frames and use the one closest to the layer change
+Added -validate to reject corrupt, black and duplicate images.  Rejections are counted per camera on the status page
+Added -capturetimeout.  Captures that hang are killed (with any child processes) and a failing camera is rested
+Images from stream, usb grabber and web cameras are written by a background writer.  Added -writequeue and -writepolicy
+-camparam is checked at startup and filled in for each image without eval - commands without shell syntax run without a shell
+Added -encode live to encode each camera's video as the images are captured - the video is ready soon after the print ends
+Added -encode segments - blocks of images are encoded as they fill so snapshots and the final video only encode the newest images
+-extratime holds the last image in the encode (tpad) instead of copying it extratime*fps times
+Video encodes wait in a queue shared by all DuetLapse3 on the computer (-maxffmpeg slots) - final videos go before snapshots
+Each encode gets a share of the computer's cpus (-threads) and runs at low cpu / disk priority while the printer is printing
 """
 
 import subprocess
@@ -94,6 +120,7 @@ import requests
 import json
 import os
 import socket
+import select
 import threading
 import psutil
 import shutil
@@ -102,6 +129,34 @@ import stat
 import signal
 import logging
 import base64
+import hashlib
+import struct
+import copy
+import codecs
+import importlib.util
+import contextlib
+import random
+import re
+import bisect
+import queue
+import collections
+import io
+import ast
+import string
+import tempfile
+import itertools
+
+try:  # Optional - only used by -validate full
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+    Image = None
+
+try:  # Not on Windows - encode slots are then only shared within this process
+    import fcntl
+except ImportError:
+    fcntl = None
 
 #  Used for debugging by calling currenFuncName(x)
 # for current func name, specify 0 or no argument.
@@ -111,21 +166,15 @@ currentFuncName = lambda n=0: sys._getframe(n + 1).f_code.co_name
 
 
 def setstartvalues():
-    global zo1, zo2, printState, captureLoopState, mainLoopState,  duetStatus, timePriorPhoto1, timePriorPhoto2, frame1, frame2, lastImage
+    global printState, captureLoopState, mainLoopState,  duetStatus, lastImage
     logger.debug('*****  Initializing state and counters  *****')
     printState = 'Waiting'
     stopCaptureLoop()
     duetStatus = 'Printer is not connected'
 
-    # initialize timers
-    timePriorPhoto1 = time.time()
-    timePriorPhoto2 = time.time()
-
-    # frame counters and layer (zo) state
-    frame1 = 0 # Camera1
-    zo1 = -1  
-    frame2 = 0 # Camera2
-    zo2 = -1 
+    # initialize timers, frame counters and layer (zo) state
+    for camera in cameras:
+        camera.reset()
 
     # last image captured
     lastImage = ''
@@ -181,9 +230,18 @@ def whitelist(parser):
     parser.add_argument('-password', type=str, nargs=1, default=['reprap'],
                         help='Password for printer. Default = reprap')
     parser.add_argument('-poll', type=int, nargs=1, default=[12])
+    parser.add_argument('-subscribe', action='store_true', help='Use object model subscription instead of polling (SBC only)')
+    parser.add_argument('-transport', type=str, nargs=1, choices=['http', 'socket'], default=['http'],
+                        help='How to talk to DSF (SBC only). Default = http')
+    parser.add_argument('-dsfsocket', type=str, nargs=1, default=['/run/dsf/dcs.sock'],
+                        help='DSF socket used with -transport socket. Default = /run/dsf/dcs.sock')
     parser.add_argument('-basedir', type=str, nargs=1, default=[''], help='default = This program directory')
     parser.add_argument('-instances', type=str, nargs=1, choices=['single', 'oneip', 'many'], default=['single'],
                         help='Default = single')
+    parser.add_argument('-fleet', type=str, nargs=1, default=[''],
+                        help='File with the options for each printer - one printer per line')
+    parser.add_argument('-fleetworkers', type=int, nargs=1, default=[4],
+                        help='Max concurrent image captures across the fleet. Default = 4')
     parser.add_argument('-logtype', type=str, nargs=1, choices=['console', 'file', 'both'], default=['both'],
                         help='Deprecated.  Use -nolog')
     parser.add_argument('-nolog', action='store_true', help='Do not use log file')
@@ -220,10 +278,33 @@ def whitelist(parser):
     parser.add_argument('-camera2', type=str, nargs=1, choices=['usb', 'pi', 'web', 'stream', 'other'], default=[''],
                         help='Optional second camera. No Default')
     parser.add_argument('-weburl2', type=str, nargs=1, default=[''], help='Url for Camera2 if web or stream')
+    parser.add_argument('-usbgrabber', action='store_true', help='Keep usb cameras open with ffmpeg instead of fswebcam')
+    parser.add_argument('-writequeue', type=int, nargs=1, default=[32],
+                        help='Images waiting to be written before -writepolicy applies. 0 = write during capture. Default = 32')
+    parser.add_argument('-writepolicy', type=str, nargs=1, choices=['block', 'drop'], default=['block'],
+                        help='When the write queue is full: block (slow capture) or drop the image. Default = block')
+    parser.add_argument('-capturetimeout', type=int, nargs=1, default=[10],
+                        help='Seconds before a capture is abandoned. Default = 10')
+    parser.add_argument('-validate', type=str, nargs=1, choices=['off', 'jpeg', 'full'], default=['jpeg'],
+                        help='Check images before use. full needs numpy and Pillow. Default = jpeg')
+    parser.add_argument('-framebuffer', type=int, nargs=1, default=[0],
+                        help='Seconds of frames kept from stream / usb grabber cameras to match layer changes. Default = 0 (off)')
+    parser.add_argument('-usbdevice1', type=str, nargs=1, default=['/dev/video0'],
+                        help='Device for Camera1 if usb and -usbgrabber. Default = /dev/video0')
+    parser.add_argument('-usbdevice2', type=str, nargs=1, default=['/dev/video0'],
+                        help='Device for Camera2 if usb and -usbgrabber. Default = /dev/video0')
+    parser.add_argument('-policy1', type=str, nargs=1, default=['default'],
+                        help='When Camera1 captures: default, layer, layers:n or seconds:n. Default = default (-detect and -seconds)')
+    parser.add_argument('-policy2', type=str, nargs=1, default=['default'],
+                        help='When Camera2 captures. Same as -policy1')
+    parser.add_argument('-addcamera', type=str, action='append', default=[],
+                        help='More cameras. Use -addcamera "type=web url=http://camera policy=layers:2" once per camera')
     # Video
     parser.add_argument('-extratime', type=int, nargs=1, default=[0], help='Time to repeat last image, Default = 0')
     parser.add_argument('-minvideo', type=int, nargs=1, default=[5], help='Minimum video length (sec), Default = 5')
     parser.add_argument('-maxvideo', type=int, nargs=1, default=[0], help='Fixed video length (sec), Default = inactive')
+    parser.add_argument('-encode', type=str, nargs=1, choices=['end', 'live', 'segments'], default=['end'],
+                        help='Encode videos at the end of the print, live as images are captured or in segments. Default = end')
     # Overrides
     parser.add_argument('-camparam1', type=str, nargs=1, default=[''],
                         help='Camera1 Capture overrides. Use -camparam1="parameters"')
@@ -280,7 +361,47 @@ def runsubprocess(cmd):
         logger.info('Exception = ' + str(e))
         return False
 
-def init():
+def runcapture(cmd, timeout):
+    # As runsubprocess but killed after timeout seconds.  The command runs in its own process group
+    # so that the shell and anything it started (fswebcam, ffmpeg ...) are all stopped
+    # cmd is a command string (run by the shell) or an argument list (run directly)
+    # Returns True, False or 'timeout'
+    logger.debug('RUNNING CAPTURE WITH ' + str(cmd))
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   shell=isinstance(cmd, str), start_new_session=not win)
+    except OSError as e:
+        logger.info('Command Exception: ' + str(cmd))
+        logger.info('Exception = ' + str(e))
+        return False
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.info('Capture Timed Out after ' + str(timeout) + ' seconds: ' + str(cmd))
+        try:
+            if win:
+                process.kill()
+            else:
+                os.killpg(process.pid, signal.SIGKILL)
+        except OSError as e:
+            logger.debug('Could not kill capture ' + str(e))
+        try:
+            process.communicate(timeout=5)  # Reap it
+        except subprocess.TimeoutExpired:
+            logger.info('Capture process ' + str(process.pid) + ' did not exit')
+        return 'timeout'
+    logger.debug('Return Code = ' + str(process.returncode))
+    if process.returncode == 0:
+        logger.debug('Command Success : ' + str(cmd))
+        if stdout != '':
+            logger.debug(str(stdout))
+        return True
+    logger.info('Command Failure: ' + str(cmd))
+    logger.debug('Error = ' + str(stderr))
+    logger.debug('Response = ' + str(stdout))
+    return False
+
+def init(argv = None):
     global inputs
     parser = argparse.ArgumentParser(
             description='Create time lapse video for Duet3D based printer. V' + duetLapse3Version, allow_abbrev=False)
@@ -288,7 +409,7 @@ def init():
 
     parser.add_argument('-file', type=argparse.FileType('r'), help='file of options', action=LoadFromFilex)
 
-    args = vars(parser.parse_args())  # Save as a dict
+    args = vars(parser.parse_args(argv))  # Save as a dict
 
     inputs = {}
 
@@ -306,9 +427,19 @@ def init():
     # Environment
     inputs.update({'# Environment':''})
     
+    global fleet, fleetworkers
+    fleet = args['fleet'][0]
+    fleetworkers = args['fleetworkers'][0]
+    if fleetworkers < 1:
+        fleetworkers = 1
+
     duet = args['duet'][0]
     if simulate in ['all','printer']:
         duet = 'SIMULATED'
+    if fleetMember:
+        fleet = ''  # No fleets within fleets
+    if fleet != '':
+        duet = 'fleet'  # The fleet itself only has a log - members have the printers
     inputs.update({'duet': str(duet)})
 
     password = args['password'][0]  
@@ -326,9 +457,25 @@ def init():
     if poll < minPoll:
         poll = minPoll
     inputs.update({'poll': str(int(poll))})
+
+    global subscribe
+    subscribe = args['subscribe']
+    inputs.update({'subscribe': str(subscribe)})
+
+    global transport, dsfsocket
+    transport = args['transport'][0]
+    if transport == 'socket' and not hasattr(socket, 'AF_UNIX'):
+        transport = 'http'  # Not available on this OS
+    inputs.update({'transport': str(transport)})
+
+    dsfsocket = args['dsfsocket'][0]
+    inputs.update({'dsfsocket': str(dsfsocket)})
     
     instances = args['instances'][0]
     inputs.update({'instances': str(instances)})
+
+    inputs.update({'fleet': str(fleet)})
+    inputs.update({'fleetworkers': str(fleetworkers)})
     
     logtype = args['logtype'][0]
     inputs.update({'logtype': str(logtype)})
@@ -346,6 +493,8 @@ def init():
     inputs.update({'host': str(host)})
 
     port = args['port'][0]
+    if fleetMember:
+        port = 0  # Served by the fleet http listener
     inputs.update({'port': str(port)})
 
     keeplogs = args['keeplogs']
@@ -416,8 +565,52 @@ def init():
     weburl2 = args['weburl2'][0]
     inputs.update({'weburl2': str(weburl2)})
 
+    global usbgrabber, usbdevice1, usbdevice2, framebuffer
+    usbgrabber = args['usbgrabber']
+    inputs.update({'usbgrabber': str(usbgrabber)})
+
+    framebuffer = args['framebuffer'][0]
+    if framebuffer < 0:
+        framebuffer = 0
+    inputs.update({'framebuffer': str(framebuffer)})
+
+    global validate
+    validate = args['validate'][0]
+    inputs.update({'validate': str(validate)})
+
+    global writequeue, writepolicy
+    writequeue = args['writequeue'][0]
+    if writequeue < 0:
+        writequeue = 0
+    inputs.update({'writequeue': str(writequeue)})
+
+    writepolicy = args['writepolicy'][0]
+    inputs.update({'writepolicy': str(writepolicy)})
+
+    global capturetimeout
+    capturetimeout = args['capturetimeout'][0]
+    if capturetimeout < 1:
+        capturetimeout = 1
+    inputs.update({'capturetimeout': str(capturetimeout)})
+
+    usbdevice1 = args['usbdevice1'][0]
+    inputs.update({'usbdevice1': str(usbdevice1)})
+
+    usbdevice2 = args['usbdevice2'][0]
+    inputs.update({'usbdevice2': str(usbdevice2)})
+
+    global policy1, policy2, addcamera
+    policy1 = args['policy1'][0]
+    inputs.update({'policy1': str(policy1)})
+
+    policy2 = args['policy2'][0]
+    inputs.update({'policy2': str(policy2)})
+
+    addcamera = args['addcamera']
+    inputs.update({'addcamera': str(addcamera)})
+
     # Video
-    global extratime, fps, minvideo, maxvideo
+    global extratime, fps, minvideo, maxvideo, encode
     inputs.update({'# Video': ''})
 
     extratime = args['extratime'][0]
@@ -436,6 +629,9 @@ def init():
 
     inputs.update({'maxvideo': str(maxvideo)})
 
+    encode = args['encode'][0]
+    inputs.update({'encode': str(encode)})
+
     # Overrides
     global camparam1, camparam2, vidparam1, vidparam2
     inputs.update({'# Overrides': ''})
@@ -499,7 +695,8 @@ def init():
     thisinstance = os.path.basename(__file__)
     if not win:
         thisinstance = './' + thisinstance
-    checkInstances(thisinstance, instances)
+    if not fleetMember:  # The fleet has already been checked
+        checkInstances(thisinstance, instances)
 
     ####################################################
     # Setup for logging and filenames
@@ -513,7 +710,7 @@ def init():
     setdebug(verbose)
 
     # duetname used for filenames and directories
-    duetname = duet.replace('.', '-')
+    duetname = duet.replace('.', '-') + fleetSuffix
 
     # set directories for files
     global topDir, nextWorkingDir, workingDir, loggingset, logname, pidIncrement
@@ -569,41 +766,41 @@ def init():
 
     # Invalid Combinations that will abort program
 
-    if (camera1 == 'stream' or camera1 == 'web') and (not weburl1.startswith('http://')):
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera1 + ' cannot be used without a url')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
+    global cameras
+    cameras = createCameras()
 
-    if (camera2 == 'stream' or camera2 == 'web') and (not weburl1.startswith('http://')):
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera2 + ' cannot be used without a url')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
+    for camera in cameras:
+        if (camera.type == 'stream' or camera.type == 'web') and (not camera.url.startswith(('http://', 'https://'))):
+            logger.info('************************************************************************************')
+            logger.info('Invalid Combination: ' + camera.name + ' type ' + camera.type + ' cannot be used without a url')
+            logger.info('************************************************************************************\n')
+            sys.exit(2)
 
-    if (camera1 != 'other') and (camparam1 != ''):
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera1 + ' cannot be used with camparam1')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
-
-    if (camera2 != 'other') and (camparam2 != ''):
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera2 + ' cannot be used with camparam2')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
+        if (camera.type != 'other') and (camera.camparam != ''):
+            logger.info('************************************************************************************')
+            logger.info('Invalid Combination: ' + camera.name + ' type ' + camera.type + ' cannot be used with camparam')
+            logger.info('************************************************************************************\n')
+            sys.exit(2)
 
-    if (camera1 == 'usb' or camera1 == 'pi') and win:  # These do not work on WIN OS
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera1 + ' cannot be on Windows OS')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
+        if camera.type == 'other':
+            try:
+                camera.template = CommandTemplate(camera.camparam)
+            except ValueError as e:
+                logger.info('************************************************************************************')
+                logger.info('Invalid camparam for ' + camera.name + ': ' + camera.camparam)
+                logger.info(str(e))
+                logger.info('************************************************************************************\n')
+                sys.exit(2)
+            if camera.template.shell:
+                logger.info(camera.name + ' camparam uses shell syntax - it will be run by the shell')
+            elif shutil.which(camera.template.program() or '') is None:
+                logger.info('!!!!!  ' + camera.name + ' camparam program ' + str(camera.template.program()) + ' was not found !!!!!')
 
-    if (camera2 == 'usb' or camera2 == 'pi') and win:
-        logger.info('************************************************************************************')
-        logger.info('Invalid Combination: Camera type ' + camera2 + ' cannot be on Windows OS')
-        logger.info('************************************************************************************\n')
-        sys.exit(2)
+        if (camera.type == 'usb' or camera.type == 'pi') and win:  # These do not work on WIN OS
+            logger.info('************************************************************************************')
+            logger.info('Invalid Combination: ' + camera.name + ' type ' + camera.type + ' cannot be on Windows OS')
+            logger.info('************************************************************************************\n')
+            sys.exit(2)
 
 
     if (not movehead == [0.0, 0.0]) and (not 'yes' in pause) and (not 'pause' in detect):
@@ -669,6 +866,12 @@ def issue_warnings():
         logger.info('* "-detect pause"')
         logger.info('************************************************************************************\n')
 
+    if validate == 'full' and numpy is None:
+        logger.info('************************************************************************************')
+        logger.info('Warning: -validate full needs numpy and Pillow (pip install numpy pillow)')
+        logger.info('Only the jpeg checks will be used')
+        logger.info('************************************************************************************\n')
+
     if novideo and deletepics:
         logger.info('************************************************************************************')
         logger.info('Warning: The combination of -novideo and -deletepics will not create any output')
@@ -829,7 +1032,7 @@ def checkDependencies(id):
         camera = camera2
         camparam  = camparam2
 
-    if 'usb' in camera:
+    if 'usb' in camera and not usbgrabber:  # The grabber uses ffmpeg
         if runsubprocess('fswebcam --version') is False:
             logger.info("Module 'fswebcam' is required. ")
             if not win:
@@ -846,7 +1049,7 @@ def checkDependencies(id):
                 logger.info("Obtain via 'sudo apt install raspistill'")
             sys.exit(3)
 
-    if 'web' in camera or 'wget' in camparam:
+    if 'wget' in camparam:  # web cameras are fetched without wget
         if runsubprocess('wget --version') is False:
             logger.info("Module 'wget' is required. ")
             if not win:
@@ -916,29 +1119,19 @@ def checkforConnection():
     try:
         checkforconnectionState = 1
         connectionState = False
-        elapsed = 0
         shortcheck = mainLoopPoll
-        quickcheck = mainLoopPoll*4  # check up to 4 times
-        longcheck = 3*60 # every 3 minutes
         checking = True
         logger.info('----------------  Waiting for printer to reconnect -----------------')
         while checking and terminateState != 1:
-            if elapsed <= quickcheck: # Check every shortcheck
-                model, code = loginPrinter(apiModel)
-                if code != 200: # Still not connected
-                    #terminate()
-                    logger.debug('Retrying connection every ' + str(shortcheck) + ' seconds')
-                    time.sleep(shortcheck)
-                    elapsed = elapsed + shortcheck
-                else:
-                    checking = False
-            else:  #  Check every longcheck
-                model, code = loginPrinter(apiModel)
-                if code != 200: # Still not connected
-                    logger.debug('Retrying connection every ' + str(longcheck) + ' seconds')
-                    time.sleep(longcheck)
-                else:
-                    checking = False
+            model, code = loginPrinter(apiModel)
+            if code != 200: # Still not connected
+                # Wait for the circuit breaker backoff (which grows while the printer is down)
+                # but not less than shortcheck e.g. if the printer answers but refuses the login
+                wait = max(shortcheck, breakerWait())
+                logger.debug('Retrying connection in ' + '{0:.1f}'.format(wait) + ' seconds')
+                time.sleep(wait)
+            else:
+                checking = False
 
         apiModel = model
         connectionState = True
@@ -983,11 +1176,17 @@ def make_archive(source):
         logger.info(msg)
     return msg
 
-def createVideo(directory):
+cameraImage = re.compile(r'^(Camera\d+)_(\d{8})\.jpeg$')
+
+def createVideo(directory, final = False, hold = 0):
+    # final is the video at the end of a print - it can use the -encode live video
+    # hold is the seconds to hold the last image for (-extratime)
+    priority = 'final' if final else 'snapshot'  # Final videos are encoded first
     global makeVideoState
     makeVideoState = 1  # Can be called from makeVideo or directly from http server
-    # loop through directory count # files and detect if Camera1 / Camera2
+    # loop through directory count # files for each camera e.g. Camera1_00000001.jpeg
     logger.info('Create Video from ' + str(directory))
+    flushFrames()  # All images on disk
     if not os.path.isdir(directory):
         msg = 'Error: No permission or directory not found'
         logger.info(msg)
@@ -996,9 +1195,8 @@ def createVideo(directory):
 
     # Scan the directory and count the number of images
 
-    f1 = f2 = 0
-    Cameras = []
-    C1 = C2 = False
+    frames = {}
+    numbers = {}
 
     try:
         listdir = os.listdir(directory)
@@ -1009,114 +1207,669 @@ def createVideo(directory):
         return msg
 
     for fn in listdir:
-        if fn.startswith('Camera1_') and fn.endswith('.jpeg'):
-            C1 = True
-            f1 += 1
-        elif fn.startswith('Camera2_') and fn.endswith('.jpeg'):
-            C2 = True
-            f2 += 1
+        match = cameraImage.match(fn)
+        if match is not None:
+            frames[match.group(1)] = frames.get(match.group(1), 0) + 1
+            numbers.setdefault(match.group(1), []).append(int(match.group(2)))
     
-    if C1 is False and C2 is False:
+    if len(frames) == 0:
         msg = 'Cannot create a video.\n\
               Are there any images captured?'
         logger.info(msg)
         makeVideoState = -1
         return msg
 
-    if C1: Cameras.append('Camera1')
-    if C2: Cameras.append('Camera2')
+    for cameraname in frames:
+        if max(numbers[cameraname]) != frames[cameraname]:  # ffmpeg would stop at the first missing image
+            closeGaps(directory, cameraname, sorted(numbers[cameraname]))
+
+    # Each camera is encoded in its own thread - ffmpeg capacity still limits how many run at once
+    Cameras = sorted(frames, key=lambda name: int(name[len('Camera'):]))
+    messages = {}
+    threads = []
+    def encodeCamera(cameraname):
+        msg = None
+        if final and encode == 'live':
+            msg = liveVideo(directory, cameraname, frames[cameraname], hold)
+        elif encode == 'segments':  # Snapshots too
+            msg = segmentVideo(directory, cameraname, frames[cameraname], hold, priority)
+            if final:  # Only snapshots need the segments again
+                encoder = segmentEncoders.pop(cameraname, None)
+                if encoder is not None:
+                    encoder.remove()
+        if msg is not None:
+            messages[cameraname] = msg
+            return
+        messages[cameraname] = encodeVideo(directory, cameraname, frames[cameraname], hold, priority)
+    for cameraname in Cameras[1:]:
+        thread = threading.Thread(name=cameraname + 'Video', target=encodeCamera, args=(cameraname,), daemon=False)
+        thread.start()
+        threads.append(thread)
+    encodeCamera(Cameras[0])  # First camera on this thread
+    for thread in threads:
+        thread.join()
 
-    for cameraname in Cameras:
-        if cameraname == 'Camera1':
-            frame = f1
-        elif cameraname == 'Camera2':
-            frame = f2
+    makeVideoState = -1
+    for cameraname in Cameras:  # First error - otherwise success
+        if messages.get(cameraname) != 'Video(s) successfully created':
+            return messages.get(cameraname, 'Error: ' + cameraname + ': video was not created')
+    return 'Video(s) successfully created'
+
+def closeGaps(directory, cameraname, numbers):
+    # An image that could not be written leaves a gap in the numbers
+    # The later images are moved down so the numbers run on.  New images keep their own numbers
+    location = os.path.join(directory, cameraname + '_%08d.jpeg')
+    moved = {}
+    for new, old in enumerate(numbers, 1):
+        if new == old:
+            continue
+        try:
+            os.replace(location % old, location % new)
+            moved[old] = new
+        except OSError as e:
+            logger.info('!!!!!  Could not renumber ' + location % old + ' -- ' + str(e) + ' !!!!!')
+            break
+    if len(moved) == 0:
+        return
+    logger.info('!!!!!  ' + cameraname + ': ' + str(numbers[-1] - len(numbers)) + ' image(s) missing - renumbered '
+                + str(len(moved)) + ' image(s) !!!!!')
+    # Keep frametimes.csv matching the files.  The lock stops a capture adding a line while it is rewritten
+    fn = os.path.join(directory, 'frametimes.csv')
+    with frameTimesLock:
+        try:
+            with open(fn) as f:
+                lines = f.readlines()
+            for i, line in enumerate(lines):
+                fields = line.split(',')
+                if len(fields) > 1 and fields[0] == cameraname and fields[1].isdigit() and int(fields[1]) in moved:
+                    fields[1] = str(moved[int(fields[1])])
+                    lines[i] = ','.join(fields)
+            with open(fn + '.tmp', 'w') as f:
+                f.writelines(lines)
+            os.replace(fn + '.tmp', fn)
+        except OSError as e:
+            logger.debug('Could not renumber frame times ' + str(e))
+            removeFile(fn + '.tmp')
 
-        if maxvideo > 0:
-            if frame < maxvideo:
-                thisfps = 1.0                         #  make it as long as we can     
-            else:
-                thisfps = float(frame/maxvideo)       #  set for  maxvideo duration
+def videoRate(cameraname, frame, hold = 0):
+    # The fps for -maxvideo or -fps.  Returns (fps, None) or (None, error message) if the video would be too short
+    # hold is the seconds the last image is held for (-extratime) - it is part of -maxvideo
+    if maxvideo > 0:
+        length = max(1, maxvideo - hold)
+        if frame < length:
+            thisfps = 1.0                         #  make it as long as we can     
         else:
-            thisfps = float(fps)                      #  set for fixed fps
+            thisfps = float(frame/length)         #  set for  maxvideo duration
+    else:
+        thisfps = float(fps)                      #  set for fixed fps
 
 
-        if frame/thisfps < minvideo:
-            msg = 'Error: ' + cameraname + ': Cannot create video shorter than ' + str(minvideo) + ' second(s).\n Length would have been ' + str(frame/thisfps) + ' second(s).' 
-            logger.info(msg)
-            logger.info('frame = ' + str(frame) + ' thisfps = ' + str(thisfps) + ' fps = ' + str(fps) + ' maxvideo = ' + str(maxvideo) + ' minvideo = ' + str(minvideo))
-            makeVideoState = -1
-            return msg
+    if frame/thisfps + hold < minvideo:
+        msg = 'Error: ' + cameraname + ': Cannot create video shorter than ' + str(minvideo) + ' second(s).\n Length would have been ' + str(frame/thisfps + hold) + ' second(s).' 
+        logger.info(msg)
+        logger.info('frame = ' + str(frame) + ' thisfps = ' + str(thisfps) + ' fps = ' + str(fps) + ' maxvideo = ' + str(maxvideo) + ' minvideo = ' + str(minvideo))
+        return None, msg
+    return thisfps, None
+
+def holdFilter(seconds):
+    # Repeats the last image for seconds at the end of the video (-extratime)
+    if seconds <= 0:
+        return ''
+    return ' -vf tpad=stop_mode=clone:stop_duration=' + str(seconds)
+
+def videoFiles(directory, cameraname):
+    # The video and the temporary file it is made in
+    timestamp = time.strftime('%a-%H-%M', time.localtime())
+    fn = directory + '_' + cameraname + '_' + timestamp + '.mp4'
+    tmpfn = os.path.join(directory, '_tmpvideo_' + cameraname + '.mp4')
+    return fn, tmpfn
+
+def encodeVideo(directory, cameraname, frame, hold = 0, priority = 'snapshot'):
+    thisfps, msg = videoRate(cameraname, frame, hold)
+    if thisfps is None:
+        return msg
 
-        logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video with fps = ' +str(thisfps))
-        if 250 < frame:
-            logger.info("This can take a while...")
+    logger.info(cameraname + ': now making ' + str(frame) + ' frames into a video with fps = ' +str(thisfps))
+    if 250 < frame:
+        logger.info("This can take a while...")
 
-        timestamp = time.strftime('%a-%H-%M', time.localtime())
+    fn, tmpfn = videoFiles(directory, cameraname)
+    location = os.path.join(directory, cameraname + '_%08d.jpeg')
 
-        fn = directory + '_' + cameraname + '_' + timestamp + '.mp4'
-        tmpfn = os.path.join(directory, '_tmpvideo.mp4')
-        location = os.path.join(directory, cameraname + '_%08d.jpeg')
+    prefix, threads = encodeResources(priority)
+    cmd = (prefix + 'ffmpeg' + ffmpegquiet + ' -r ' + str(thisfps) + ' -i ' + location + holdFilter(hold) +
+           ' -vcodec libx264 -threads ' + str(threads) + ' -y ' + tmpfn + debug)
 
-        if printState == 'Completed':
-            threadsin = ''  #  Dont limit ffmpeg
-            threadsout = ''  #  Dont limit ffmpeg
-        else:
-            threadsin = ' -threads 1 '
-            threadsout = ' -threads 2 '
+    encodeStart = time.time()
+    encoded = runEncode(cmd, priority)
+    observe('duetlapse3_encode_seconds', {'camera': cameraname, 'result': 'ok' if encoded else 'failed'},
+            time.time() - encodeStart)
 
-        #  cmd = 'ffmpeg' + threadsin + ffmpegquiet + ' -r ' + str(thisfps) + ' -i ' + location + ' -vcodec libx264 -y ' + threadsout + tmpfn + debug
-        cmd = 'ffmpeg' + ffmpegquiet + ' -r ' + str(thisfps) + ' -i ' + location + ' -vcodec libx264 -y ' + tmpfn + debug
+    if encoded is False:
+        msg = ('!!!!!  There was a  creating the video for '+cameraname+' !!!!!')
+        logger.info(msg)
+        removeFile(tmpfn)
+        return msg
+    return moveVideo(cameraname, tmpfn, fn)
+
+def printerActive():
+    # True while a print is running - DSF and the capture need the cpu
+    return duetStatus in ['processing', 'pausing', 'paused', 'resuming', 'busy', 'simulating']
+
+def encodeResources(priority):
+    # (command prefix, ffmpeg threads) for an encode
+    # The cpus are shared between the encode slots.  While printing, one cpu is left for DSF and the capture
+    # and encodes run at low cpu and disk priority.  When idle, final videos get all of their share at normal priority
+    cpus = os.cpu_count() or 1
+    slots = encodeScheduler.slots
+    if priority == 'background':  # -encode segments and live work
+        threads, niceness, ioclass = 1, 19, '3'
+    elif printerActive():
+        threads, niceness, ioclass = max(1, (cpus - 1) // slots), 10, '2 -n 7'
+    else:
+        threads, niceness, ioclass = max(1, cpus // slots), 0, ''
+    prefix = ''
+    if not win:
+        if niceness > 0 and shutil.which('nice') is not None:
+            prefix += 'nice -n ' + str(niceness) + ' '
+        if ioclass != '' and shutil.which('ionice') is not None:
+            prefix += 'ionice -c ' + ioclass + ' '
+    return prefix, threads
+
+def runEncode(cmd, priority = 'snapshot'):
+    # Runs an ffmpeg encode when it gets an encode slot.  priority is final, snapshot or background
+    with encodeScheduler.slot(priority):
+        return runsubprocess(cmd)
+
+def moveVideo(cameraname, tmpfn, fn):
+    try:
+        shutil.move(tmpfn, fn)
+        logger.info('Video processing completed for ' + cameraname)
+        logger.info('Video is in file ' + fn)                
+        msg = 'Video(s) successfully created'
+    except shutil.Error as e:
+        msg = 'Error on move of temp video file ' + str(e)
+        logger.info(msg)
+    return msg
 
-        #  Wait for up to minutes for ffmpeg capacity to  become available
-        #  If still not available - try anyway
-        minutes = 5
-        increment = 15  #  seconds
-        loop = 0
-        while loop < minutes*60:
-            if ffmpeg_available():
+def removeFile(fn):
+    if os.path.isfile(fn): 
+        try:
+            os.remove(fn)
+        except OSError as e:
+            logger.info('Error deleting file ' + str(e))
+
+###########################
+# Live video encode
+###########################
+
+class LiveEncoder:
+    # -encode live.  A low priority ffmpeg for one camera is fed each image as it is captured
+    # At the end of the print the video only needs to be retimed for -maxvideo
+    depth = 64  # Images waiting for ffmpeg before the live encode is abandoned
+    finishTimeout = 600  # seconds for ffmpeg to encode what is left when the print ends
+
+    def __init__(self, cameraname):
+        self.cameraname = cameraname
+        self.directory = workingDir
+        self.filename = os.path.join(self.directory, '_live_' + cameraname + '.mkv')
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.frames = 0  # images given to ffmpeg
+        self.held = 0  # repeats of the last image for -extratime
+        self.last = None
+        self.failed = None  # why the live encode cannot be used
+        self.process = None
+        self.thread = threading.Thread(name=cameraname + 'Encode', target=self.run, daemon=False)
+        self.thread.start()
+
+    def add(self, data, count=1):
+        # data None repeats the last image
+        if self.failed is not None:
+            return
+        if data is None:
+            data = self.last
+            if data is None:
+                return
+            self.held += count
+        self.last = data
+        try:
+            self.queue.put_nowait((data, count))
+        except queue.Full:
+            self.abandon('ffmpeg is not keeping up')
+
+    def run(self):
+        prefix, threads = encodeResources('background')  # Capture and the printer come first
+        cmd = shlex.split(prefix) + ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(fps),
+                                     '-i', '-', '-vcodec', 'libx264', '-threads', str(threads), '-y', self.filename]
+        logger.debug(self.cameraname + ' starting live encode ' + str(cmd))
+        try:
+            self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL, start_new_session=not win)
+        except OSError as e:
+            self.failed = 'could not start ffmpeg ' + str(e)
+            return
+        while self.failed is None:
+            item = self.queue.get()
+            if item is None:  # finish
                 break
-            else:
-                time.sleep(increment)  # wait a while before trying again
-                loop += increment
-                logger.debug('Have waited ' + str(loop) + ' seconds for ffmpeg capacity')
+            data, count = item
+            try:
+                for _ in range(count):
+                    self.process.stdin.write(data)
+                    self.frames += 1
+            except (OSError, ValueError):
+                self.failed = 'ffmpeg stopped with code ' + str(self.process.poll())
+        if self.failed is not None:
+            self.process.kill()
+            self.process.wait()
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=self.finishTimeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        if self.process.returncode != 0:
+            self.failed = 'ffmpeg stopped with code ' + str(self.process.returncode)
+
+    def finish(self):
+        # Waits for ffmpeg to encode the remaining images.  True if the live video can be used
+        if self.failed is None:
+            try:
+                self.queue.put(None, timeout=self.finishTimeout)
+            except queue.Full:
+                self.abandon('ffmpeg is not keeping up')
+        self.thread.join()
+        return self.failed is None
+
+    def abandon(self, reason):
+        if self.failed is None:
+            self.failed = reason
+            logger.info('!!!!!  ' + self.cameraname + ' live encode abandoned: ' + reason + ' !!!!!')
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()  # Also ends a write that is waiting on ffmpeg
+        try:
+            self.queue.put_nowait(None)  # Wake the thread
+        except queue.Full:
+            pass
 
+    def remove(self):
+        removeFile(self.filename)
+
+def liveFrame(cameraname, data, count=1):
+    # Gives an image to the camera's live encoder.  data None repeats the last image
+    encoder = liveEncoders.get(cameraname)
+    if encoder is not None and encoder.directory != workingDir:  # Left over from the last print
+        encoder.abandon('a new print started')
+        encoder = None
+    if encoder is None:
+        if data is None:
+            return
+        encoder = liveEncoders[cameraname] = LiveEncoder(cameraname)
+    encoder.add(data, count)
+
+def liveVideo(directory, cameraname, frame, hold = 0):
+    # Finishes the -encode live video.  Returns None if the images need to be encoded instead
+    encoder = liveEncoders.pop(cameraname, None)
+    if encoder is None or encoder.directory != directory:
+        if encoder is not None:
+            encoder.abandon('a different directory was requested')
+        return None
+    thisfps, msg = videoRate(cameraname, frame, hold)
+    if thisfps is None:
+        encoder.abandon('the video would be too short')
+        encoder.finish()
+        encoder.remove()
+        return msg
+    logger.info(cameraname + ': finishing the live encode')
+    encodeStart = time.time()
+    encoder.add(None, round(hold * thisfps))  # The last image again - after the retime it lasts hold seconds
+    if encoder.finish() and encoder.frames - encoder.held != frame:
+        encoder.failed = 'it has ' + str(encoder.frames - encoder.held) + ' of ' + str(frame) + ' images'
+    if encoder.failed is not None:
+        logger.info(cameraname + ': the live encode cannot be used (' + encoder.failed + ') - encoding the images instead')
+        encoder.remove()
+        return None
+    fn, tmpfn = videoFiles(directory, cameraname)
+    # Only the timestamps change - the video is not encoded again
+    cmd = 'ffmpeg' + ffmpegquiet + ' -itsscale ' + str(fps / thisfps) + ' -i ' + encoder.filename + ' -c copy -y ' + tmpfn + debug
+    encoded = runsubprocess(cmd)
+    observe('duetlapse3_encode_seconds', {'camera': cameraname, 'result': 'ok' if encoded else 'failed'},
+            time.time() - encodeStart)
+    encoder.remove()
+    if encoded is False:
+        logger.info(cameraname + ': could not retime the live video - encoding the images instead')
+        removeFile(tmpfn)
+        return None
+    return moveVideo(cameraname, tmpfn, fn)
+
+def stopLiveEncoders():
+    for encoder in list(liveEncoders.values()):
+        encoder.abandon('stopped')
+        encoder.thread.join()
+        encoder.remove()
+    liveEncoders.clear()
+
+def liveStatus():
+    if len(liveEncoders) == 0:
+        return 'none'
+    return ', '.join(name + ' ' + (str(encoder.frames) + ' frames' if encoder.failed is None else 'abandoned')
+                     for name, encoder in liveEncoders.items())
 
-        if runsubprocess(cmd) is False:
-            msg = ('!!!!!  There was a  creating the video for '+cameraname+' !!!!!')
-            logger.info(msg)
-            if os.path.isfile(tmpfn): 
+###########################
+# Segmented video encode
+###########################
+
+class SegmentEncoder:
+    # -encode segments.  Each block of images for one camera is encoded in the background as soon as it is complete
+    # Snapshots and the final video join the finished segments without encoding them again and only encode the rest
+    size = 250  # images per segment
+
+    def __init__(self, cameraname):
+        self.cameraname = cameraname
+        self.directory = workingDir
+        self.queue = queue.Queue()  # segment numbers ready to encode
+        self.done = []  # segment files in order
+        self.failed = None  # why later segments are not encoded
+        self.thread = threading.Thread(name=cameraname + 'Segments', target=self.run, daemon=False)
+        self.thread.start()
+
+    def run(self):
+        while self.failed is None:
+            index = self.queue.get()
+            if index is None:
+                break
+            if index != len(self.done):  # Already encoded
+                continue
+            flushFrames()  # All the images are on disk
+            filename = os.path.join(self.directory, '_segment_' + self.cameraname + '_' + str(index).zfill(4) + '.mkv')
+            if encodeImages(self.directory, self.cameraname, index * self.size + 1, self.size, filename, 'background'):
+                self.done.append(filename)
+                logger.debug(self.cameraname + ' encoded segment ' + str(index + 1))
+            elif self.failed is None:
+                self.failed = 'segment ' + str(index + 1) + ' could not be encoded'
+                logger.info('!!!!!  ' + self.cameraname + ' ' + self.failed + ' - videos will encode the images !!!!!')
+
+    def stop(self):
+        if self.failed is None:
+            self.failed = 'stopped'
+        self.queue.put(None)
+
+    def remove(self):
+        # Stops and deletes the segments - waits for one that is being encoded
+        self.stop()
+        self.thread.join()
+        for filename in self.done:
+            removeFile(filename)
+
+def encodeImages(directory, cameraname, first, count, filename, priority, hold = 0):
+    # Encodes count images starting at image number first at -fps.  The images must all be there
+    location = os.path.join(directory, cameraname + '_%08d.jpeg')
+    for frame in range(first, first + count):
+        if not os.path.isfile(location % frame):
+            logger.info(cameraname + ': image ' + str(frame) + ' is missing')
+            return False
+    prefix, threads = encodeResources(priority)
+    cmd = (prefix + 'ffmpeg' + ffmpegquiet + ' -framerate ' + str(fps) + ' -start_number ' + str(first) + ' -i ' + location +
+           ' -frames:v ' + str(count) + holdFilter(hold) + ' -vcodec libx264 -threads ' + str(threads) + ' -y ' + filename + debug)
+    return runEncode(cmd, priority)
+
+def segmentFrame(cameraname, frame):
+    # Called with each new image.  Starts the encode of a segment when it is full
+    encoder = segmentEncoders.get(cameraname)
+    if encoder is not None and encoder.directory != workingDir:  # Left over from the last print
+        encoder.stop()
+        encoder = None
+    if encoder is None:
+        encoder = segmentEncoders[cameraname] = SegmentEncoder(cameraname)
+    if frame % SegmentEncoder.size == 0:
+        encoder.queue.put(frame // SegmentEncoder.size - 1)
+
+def segmentVideo(directory, cameraname, frame, hold = 0, priority = 'snapshot'):
+    # Joins the finished segments with an encode of the newer images
+    # Returns None if all the images need to be encoded instead
+    encoder = segmentEncoders.get(cameraname)
+    if encoder is None or encoder.directory != directory:
+        return None
+    thisfps, msg = videoRate(cameraname, frame, hold)
+    if thisfps is None:
+        return msg
+    parts = encoder.done[:frame // SegmentEncoder.size]
+    first = len(parts) * SegmentEncoder.size + 1
+    count = frame - first + 1
+    if count == 0 and hold > 0:  # The hold needs an image to repeat
+        parts = parts[:-1]
+        first -= SegmentEncoder.size
+        count = SegmentEncoder.size
+    logger.info(cameraname + ': making a video from ' + str(len(parts)) + ' encoded segment(s) and ' + str(count) +
+                ' more images with fps = ' + str(thisfps))
+    encodeStart = time.time()
+    tail = os.path.join(directory, '_tail_' + cameraname + '.mkv')
+    if count > 0:
+        # The tail is retimed with the segments - the hold is in -fps time
+        if not encodeImages(directory, cameraname, first, count, tail, priority, hold * thisfps / fps):
+            logger.info(cameraname + ': could not encode the newest images - encoding all the images instead')
+            removeFile(tail)
+            return None
+        parts = parts + [tail]
+    listfile = os.path.join(directory, '_segments_' + cameraname + '.txt')
+    try:
+        with open(listfile, 'w') as f:
+            for part in parts:
+                f.write("file '" + part.replace("'", "'\\''") + "'\n")
+    except OSError as e:
+        logger.info('Could not write ' + listfile + ' ' + str(e))
+        removeFile(tail)
+        return None
+    fn, tmpfn = videoFiles(directory, cameraname)
+    # The segments are joined as they are - only the timestamps change for -maxvideo
+    cmd = ('ffmpeg' + ffmpegquiet + ' -itsscale ' + str(fps / thisfps) + ' -f concat -safe 0 -i ' + listfile +
+           ' -c copy -y ' + tmpfn + debug)
+    encoded = runsubprocess(cmd)
+    observe('duetlapse3_encode_seconds', {'camera': cameraname, 'result': 'ok' if encoded else 'failed'},
+            time.time() - encodeStart)
+    removeFile(tail)
+    removeFile(listfile)
+    if encoded is False:
+        logger.info(cameraname + ': could not join the segments - encoding all the images instead')
+        removeFile(tmpfn)
+        return None
+    return moveVideo(cameraname, tmpfn, fn)
+
+def stopSegmentEncoders():
+    for encoder in list(segmentEncoders.values()):
+        encoder.remove()
+    segmentEncoders.clear()
+
+def encodeStatus():
+    if encode == 'live':
+        return liveStatus()
+    if encode == 'segments':
+        if len(segmentEncoders) == 0:
+            return 'none'
+        return ', '.join(name + ' ' + str(len(encoder.done)) + ' segments' + ('' if encoder.failed is None else ' (stopped)')
+                         for name, encoder in segmentEncoders.items())
+    return 'at end'
+
+def stopEncoders():
+    stopLiveEncoders()
+    stopSegmentEncoders()
+
+###########################
+# Encode scheduler
+###########################
+
+encodePriorities = {'final': 0, 'snapshot': 1, 'background': 2}
+
+class EncodeScheduler:
+    # -maxffmpeg slots for video encodes shared by every DuetLapse3 on this computer
+    # A slot is a locked file so that it is freed even if DuetLapse3 is killed
+    # Waiting encodes hold a locked ticket file.  Only the first ticket (by priority then age) can take a slot
+    # A ticket that is not locked belongs to a process that has gone and is removed
+    poll = 0.25  # seconds between looks at the queue - waiters in this process are woken straight away
+
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self.local = threading.Condition()
+        self.counter = itertools.count()
+        self.waiting = []  # tickets in this process
+        self.running = 0  # encodes in this process
+        self.directory = None
+        if fcntl is not None:
+            directory = os.path.join(tempfile.gettempdir(), 'DuetLapse3-encode')
+            try:
                 try:
-                    os.remove(tmpfn)
-                except OSError as e:
-                    logger.info('Error deleting file ' + str(e))
-            makeVideoState = -1
-            return msg
-        else:
+                    os.mkdir(directory)
+                except FileExistsError:
+                    pass
+                st = os.lstat(directory)
+                if stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) != 0o1777:
+                    os.chmod(directory, 0o1777)  # Shared with instances run by other users - sticky like /tmp
+                    st = os.lstat(directory)
+                problem = self.untrusted(st)
+                if problem is None:
+                    self.directory = directory
+                else:
+                    logger.info('!!!!! Encode slots are only shared within this process - ' + directory + ' ' + problem + ' !!!!!')
+            except OSError as e:
+                logger.info('Encode slots are only shared within this process - could not use ' + directory + ' ' + str(e))
+
+    @staticmethod
+    def untrusted(st):
+        # None if the slot directory is safe to share, otherwise why not
+        # Anyone can create files in /tmp - a directory planted by another user could be used to block or steal slots
+        if stat.S_ISLNK(st.st_mode):
+            return 'is a symbolic link'
+        if not stat.S_ISDIR(st.st_mode):
+            return 'is not a directory'
+        if st.st_uid not in (os.getuid(), 0):
+            return 'belongs to another user'
+        if st.st_mode & stat.S_IWOTH and not st.st_mode & stat.S_ISVTX:
+            return 'is writable by everyone without the sticky bit'
+        return None
+
+    @contextlib.contextmanager
+    def slot(self, priority):
+        start = time.time()
+        ticket = self.enqueue(priority)
+        try:
+            slot = self.acquire(ticket)
+        finally:
+            self.dequeue(ticket)
+        observe('duetlapse3_encode_wait_seconds', {'priority': priority}, time.time() - start)
+        try:
+            yield
+        finally:
+            self.release(slot)
+
+    def enqueue(self, priority):
+        name = '{0}-{1:020d}-{2}-{3}.ticket'.format(encodePriorities[priority], time.time_ns(), os.getpid(), next(self.counter))
+        fd = None
+        if self.directory is not None:
             try:
-                shutil.move(tmpfn, fn)
-                logger.info('Video processing completed for ' + cameraname)
-                logger.info('Video is in file ' + fn)                
-                msg = 'Video(s) successfully created'
-            except shutil.Error as e:
-                msg = 'Error on move of temp video file ' + str(e)
-                logger.info(msg)
- 
-    makeVideoState = -1
-    return msg
+                # Locked before it appears in the queue so it is never taken for a stale ticket
+                fd = os.open(os.path.join(self.directory, name + '.new'), os.O_CREAT | os.O_RDONLY, 0o644)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.rename(os.path.join(self.directory, name + '.new'), os.path.join(self.directory, name))
+            except OSError as e:
+                logger.info('Could not queue for an encode slot ' + str(e))
+                if fd is not None:
+                    os.close(fd)
+                fd = None
+        ticket = (name, fd)
+        with self.local:
+            self.waiting.append(ticket)
+        logger.debug('Waiting for an encode slot with ticket ' + name)
+        return ticket
+
+    def dequeue(self, ticket):
+        name, fd = ticket
+        with self.local:
+            self.waiting.remove(ticket)
+            self.local.notify_all()  # The next ticket may now be first
+        if fd is not None:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            os.close(fd)
 
+    def acquire(self, ticket):
+        with self.local:
+            while True:
+                if self.first(ticket):
+                    slot = self.take()
+                    if slot is not None:
+                        self.running += 1
+                        return slot
+                self.local.wait(self.poll)
+
+    def first(self, ticket):
+        name, fd = ticket
+        if min(self.waiting)[0] != name:  # One in this process is ahead
+            return False
+        if fd is None:  # Only this process
+            return True
+        for other in self.tickets():
+            if other >= name:
+                return True
+            if not self.stale(other):
+                return False
+        return True
 
-def ffmpeg_available():
-    count = 0
-    max_count = maxffmpeg  # Default is 2
-    for p in psutil.process_iter():
-        if 'ffmpeg' in p.name():  # Check to see if it's running
-            count += 1
-        if count >= max_count:
-            logger.debug('Waiting for ffmpeg to become available')
+    def tickets(self):
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith('.ticket'))
+        except OSError:
+            return []
+
+    def stale(self, name):
+        # True (and removed) if nothing holds the ticket's lock
+        try:
+            fd = os.open(os.path.join(self.directory, name), os.O_RDONLY)
+        except OSError:
+            return True  # Already gone
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
             return False
-    logger.debug('There are ' + str(count) + ' instances of ffmpeg running')
-    return True
+        else:
+            logger.info('Removing encode ticket ' + name + ' left by a process that has stopped')
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            return True
+        finally:
+            os.close(fd)
+
+    def take(self):
+        # A free slot or None
+        if self.directory is None:
+            return True if self.running < self.slots else None
+        for i in range(self.slots):
+            try:
+                fd = os.open(os.path.join(self.directory, 'slot' + str(i) + '.lock'), os.O_CREAT | os.O_RDONLY, 0o644)
+            except OSError as e:
+                logger.info('Could not open encode slot ' + str(e))
+                return True if self.running < self.slots else None
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def release(self, slot):
+        if slot is not True:
+            os.close(slot)  # Also unlocks it
+        with self.local:
+            self.running -= 1
+            self.local.notify_all()
+
+    def status(self):
+        queued = len(self.tickets()) if self.directory is not None else len(self.waiting)
+        return str(self.running) + ' running, ' + str(len(self.waiting)) + ' waiting (' + str(queued) + ' on this computer)'
 
 def getRunningInstancePids():
     pidlist = []
@@ -1307,7 +2060,7 @@ def checkForPause(layer):
         sendDuetGcode(apiModel, 'M25')  # Ask for a pause
         loop = 0
         while True:
-            time.sleep(loopinterval)  # wait and try again    
+            waitforModelChange(loopinterval)  # wait and try again
             duetStatus, _ = getDuet('check for pause = yes', Status)
             if connectionState is False:
                 return
@@ -1327,7 +2080,7 @@ def checkForPause(layer):
             sendDuetGcode(apiModel, 'G0 X{0:4.2f} Y{1:4.2f}'.format(movehead[0], movehead[1]))
             loop = 0
             while True:
-                time.sleep(loopinterval)  # wait and try again
+                waitforModelChange(loopinterval)  # wait and try again
                 xpos, ypos, _ = getDuet('Position paused = yes', Position)
                 if connectionState is False:
                     return
@@ -1361,7 +2114,7 @@ def unPause():  # Only gets called if duetStatus = paused
         sendDuetGcode(apiModel, 'M24')  # Ask for an un pause
         loop = 0
         while True:
-            time.sleep(loopinterval)  # wait a short time so as to not miss transition on short layer            
+            waitforModelChange(loopinterval)  # wait a short time so as to not miss transition on short layer
             duetStatus, _ = getDuet('unPause loop', Status)
             if connectionState is False:
                 return
@@ -1375,69 +2128,914 @@ def unPause():  # Only gets called if duetStatus = paused
     return
 
 
-def onePhoto(cameraname, camera, weburl, camparam):
-    global frame1, frame2, workingDir, camfile1, camfile2, lastImage, referer
+###########################
+# Image validation
+###########################
+
+rejectReasons = ['corrupt', 'black', 'duplicate']
+blackLevel = 16  # Luminance (0-255) below which a pixel is dark
+blackFraction = 0.98  # A black image has at least this much of the thumbnail dark
+frozenLevel = 0.5  # Mean luminance difference below which an image is a repeat of the last one
+
+def frameThumbnail(data):
+    # Small grayscale copy - draft lets the JPEG decoder scale down while it decodes
+    image = Image.open(io.BytesIO(data))
+    image.draft('L', (80, 60))
+    image = image.convert('L').resize((64, 48))
+    return numpy.asarray(image, dtype=numpy.int16)
+
+flatBytesPerPixel = 0.06  # A baseline jpeg with less scan data than this per pixel has (almost) no detail
+
+def jpegHeaders(data):
+    # Tables, frame size and scan offset of a baseline jpeg - None for anything else (e.g. progressive)
+    quant, huffman, frame = {}, {}, None
+    i = 2
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        marker = data[i + 1]
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        segment = data[i + 4:i + 2 + length]
+        if marker == 0xDB:  # DQT - only the DC entry of each table is needed
+            j = 0
+            while j < len(segment):
+                precision, table = segment[j] >> 4, segment[j] & 0x0F
+                quant[table] = int.from_bytes(segment[j + 1:j + 2 + precision], 'big')
+                j += 65 + 64 * precision
+        elif marker == 0xC4:  # DHT
+            j = 0
+            while j + 17 <= len(segment):
+                counts = segment[j + 1:j + 17]
+                symbols = segment[j + 17:j + 17 + sum(counts)]
+                codes, code, k = {}, 0, 0
+                for bits, count in enumerate(counts, 1):
+                    for _ in range(count):
+                        codes[(bits, code)] = symbols[k]
+                        code += 1
+                        k += 1
+                    code <<= 1
+                huffman[segment[j]] = codes
+                j += 17 + len(symbols)
+        elif marker in (0xC0, 0xC1):  # Baseline SOF - height, width, first component's quantisation table
+            frame = (int.from_bytes(segment[1:3], 'big'), int.from_bytes(segment[3:5], 'big'), segment[8])
+        elif marker == 0xDA:  # SOS - the entropy coded data follows
+            if frame is None:
+                return None
+            return quant, huffman, frame, segment[2] >> 4, i + 2 + length
+        elif 0xC2 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):  # Progressive, lossless ...
+            return None
+        i += 2 + length
+    return None
+
+def jpegBlack(data):
+    # Dependency free check for a black jpeg - almost no scan data (flat) and a dark first block
+    try:
+        headers = jpegHeaders(data)
+        if headers is None:
+            return False
+        quant, huffman, (height, width, qtable), dctable, start = headers
+        if len(data) - start > flatBytesPerPixel * width * height:
+            return False
+        bits = ''.join(format(b, '08b') for b in data[start:start + 8].replace(b'\xff\x00', b'\xff'))
+        codes = huffman[dctable]  # class 0 (DC) tables have ids 0-3
+        for length in range(1, 17):
+            size = codes.get((length, int(bits[:length], 2)))
+            if size is not None:
+                break
+        else:
+            return False
+        value = int(bits[length:length + size], 2) if size else 0
+        if size and value < 1 << (size - 1):
+            value -= (1 << size) - 1
+        return value * quant[qtable] / 8 + 128 < blackLevel
+    except (KeyError, IndexError, ValueError):  # Not something this simple parser understands
+        return False
+
+pngStart = b'\x89PNG\r\n\x1a\n'
+pngEnd = b'IEND\xaeB`\x82'
+
+def validateFrame(camera, data):
+    # None if the image can be used, otherwise the reason it is rejected
+    # web and other cameras may not give jpegs - only jpeg and png are checked for missing end markers
+    if len(data) < 128 or data.lstrip()[:1] == b'<':  # Empty or an html error page
+        return 'corrupt'
+    if data[:2] == b'\xff\xd8':
+        if b'\xff\xd9' not in data[-32:]:  # Some cameras pad after the end marker
+            return 'corrupt'
+    elif data[:8] == pngStart:
+        if pngEnd not in data[-32:]:
+            return 'corrupt'
+    digest = hashlib.sha1(data).digest()
+    if digest == camera.lastDigest:  # A stream that has frozen repeats the same bytes
+        return 'duplicate'
+    thumbnail = None
+    if validate == 'full' and numpy is not None:
+        try:
+            thumbnail = frameThumbnail(data)
+        except (OSError, ValueError, SyntaxError):  # Pillow reports truncated or bad data with these
+            return 'corrupt'
+        histogram = numpy.bincount(thumbnail.ravel(), minlength=256)
+        if histogram[:blackLevel].sum() >= blackFraction * thumbnail.size:
+            return 'black'
+        last = camera.lastThumbnail
+        if last is not None and last.shape == thumbnail.shape and numpy.abs(thumbnail - last).mean() < frozenLevel:
+            return 'duplicate'
+    elif data[:2] == b'\xff\xd8' and jpegBlack(data):
+        return 'black'
+    camera.lastDigest = digest
+    camera.lastThumbnail = thumbnail
+    return None
+
+def checkFrame(camera, data, fn):
+    # Counts and logs a rejected image.  Returns True if the image can be used
+    reason = validateFrame(camera, data)
+    if reason is None:
+        return True
+    camera.rejected[reason] += 1
+    logger.info('!!!!!  ' + camera.name + ' image ' + os.path.basename(fn) + ' rejected: ' + reason + ' !!!!!')
+    return False
+
+def rejectStatus():
+    text = []
+    for camera in cameras:
+        rejected = sum(camera.rejected.values())
+        if rejected == 0:
+            text.append(camera.name + ' 0')
+        else:
+            text.append(camera.name + ' ' + str(rejected) + ' (' + ', '.join(reason + ' ' + str(count)
+                        for reason, count in camera.rejected.items() if count > 0) + ')')
+    return ', '.join(text)
+
+###########################
+# Cameras
+###########################
 
-    if workingDirStatus == -1: # Create as late as possible
-        workingDir = createworkingDir()
-        camfile1 = os.path.join(workingDir, 'Camera1_')
+cameraTypes = ['usb', 'pi', 'web', 'stream', 'other']
+
+class Camera:
+    # One camera - its settings, trigger policy, frame count and capture worker
+    def __init__(self, name, type, url='', camparam='', device='/dev/video0', policy='default'):
+        self.name = name
+        self.type = type
+        self.url = url
+        self.camparam = camparam
+        self.device = device
+        self.policy, self.every = parsePolicy(policy)
+        self.template = None  # CommandTemplate for type other
+        self.requests = queue.Queue()
+        self.state = -1  # capture worker: -1 not running, 0 stop requested, 1 running
+        self.busy = False
+        self.failures = 0  # in a row
+        self.cooldownUntil = 0
+        self.reset()
+
+    def reset(self):
+        self.frame = 0
+        self.zo = -1
+        self.timePrior = time.time()
+        # -validate
+        self.rejected = dict.fromkeys(rejectReasons, 0)
+        self.lastDigest = None
+        self.lastThumbnail = None
+
+    def camfile(self):
+        return os.path.join(workingDir, self.name + '_')
+
+    def start(self):
+        if self.state != -1:
+            return
+        self.state = 1
+        threading.Thread(name=self.name + 'Capture', target=self.run, daemon=False).start()
 
-        camfile2 = os.path.join(workingDir, 'Camera2_')
-    
-    if workingDirStatus == 0: # Keep checking until jobname is known
-        workingDir = renameworkingDir(workingDir)
-        camfile1 = workingDir + '/Camera1_'
-        camfile2 = workingDir + '/Camera2_'
-
-    if cameraname == 'Camera1':
-        frame1 += 1
-        s = str(frame1).zfill(8)
-        fn = camfile1 + s + '.jpeg'
-    else:
-        frame2 += 1
-        s = str(frame2).zfill(8)
-        fn = camfile2 + s + '.jpeg'
+    def stop(self):
+        if self.state == 1:
+            self.state = 0
+
+    def capture(self, reason, results, transition=None):
+        # Asks the worker for an image.  (name, time taken or None) is put on results
+        # transition is when the layer changed - used with -framebuffer
+        self.requests.put((reason, results, transition))
 
-    if 'usb' in camera:
+    def run(self):
+        while self.state == 1:
+            try:
+                reason, results, transition = self.requests.get(timeout=1)
+            except queue.Empty:
+                continue
+            logger.info(reason)
+            self.busy = True
+            try:
+                taken, result = onePhoto(self, transition)
+            except Exception as e:
+                logger.info('!!!!!  Error capturing ' + self.name + ' -- ' + str(e) + ' !!!!!')
+                taken, result = None, 'failed'
+            self.busy = False
+            if result != 'rejected':  # -validate rejected the image - the camera itself is working
+                self.captured(result == 'ok')
+            results.put((self.name, taken))
+        self.state = -1
+
+    def captured(self, ok):
+        # A camera that keeps failing is rested so that it does not hold up every capture
+        if ok:
+            if self.failures >= cooldownFailures:
+                logger.info(self.name + ' is working again')
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= cooldownFailures:
+            rest = min(cooldownMax, cooldownBase * 2 ** (self.failures - cooldownFailures))
+            self.cooldownUntil = time.time() + rest
+            logger.info('!!!!!  ' + self.name + ' failed ' + str(self.failures) + ' times in a row - resting it for ' + str(rest) + ' seconds !!!!!')
+
+    def available(self):
+        # False while the camera is resting or a capture is still running
+        if self.busy:
+            logger.debug(self.name + ' is still capturing')
+            return False
+        if time.time() < self.cooldownUntil:
+            logger.debug(self.name + ' is resting')
+            return False
+        return True
+
+    def health(self):
+        if self.busy:
+            return 'capturing'
+        wait = self.cooldownUntil - time.time()
+        if wait > 0:
+            return 'resting ' + str(int(wait) + 1) + 's'
+        if self.failures > 0:
+            return str(self.failures) + ' failed'
+        return 'ok'
+
+def parsePolicy(policy):
+    # default | layer | layers:n | seconds:n  -->  (policy, n)   n = 0 uses -numlayers or -seconds
+    name, _, value = policy.partition(':')
+    if name not in ['default', 'layer', 'layers', 'seconds']:
+        raise ValueError('Unknown policy ' + policy)
+    every = int(value) if value != '' else 0
+    if every < 0 or (name == 'seconds' and every == 0):
+        raise ValueError('Invalid policy ' + policy)
+    if name == 'layers':
+        name = 'layer'
+    return name, every
+
+# -camparam templates for -camera other
+templateNames = ['weburl', 'fn', 'debug', 'frame', 'layer', 'camera']
+templateField = re.compile(r'\x00(\w+)\x00')
+shellSyntax = re.compile(r'[|;&<>`]|\$\(')
+
+class CommandTemplate:
+    # A -camparam parsed once at startup.  Each image only substitutes the values into the command
+    # Accepts the original form  'ffmpeg -y -i '+weburl+' -vframes 1 '+fn+debug
+    # or placeholders            ffmpeg -y -i {weburl} -vframes 1 {fn}
+    def __init__(self, text):
+        self.text = text
+        parts = self.parse(text)  # [(literal, name or None)]
+        literals = ''.join(literal for literal, name in parts)
+        self.shell = shellSyntax.search(literals) is not None
+        if self.shell:  # Pipes and redirection need a shell - the values are quoted
+            self.parts = parts
+            self.argv = None
+            return
+        # debug is not needed without a shell - the output is captured
+        marked = ''.join(literal + ('\x00' + name + '\x00' if name not in (None, 'debug') else '')
+                         for literal, name in parts)
+        try:
+            tokens = shlex.split(marked)
+        except ValueError as e:
+            raise ValueError('Cannot split into arguments - ' + str(e))
+        if len(tokens) == 0:
+            raise ValueError('There is no command')
+        self.argv = [templateField.split(token) for token in tokens]  # names are at the odd positions
+
+    def parse(self, text):
+        try:
+            tree = ast.parse(text.strip(), mode='eval')
+        except SyntaxError:
+            tree = None
+        if tree is not None and not (isinstance(tree.body, ast.Constant) and '{' in str(tree.body.value)):
+            parts = []
+            self.expression(tree.body, parts)
+            return parts
+        parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(text):  # ValueError if the braces do not match
+            if name is not None and name not in templateNames:
+                raise ValueError('Unknown placeholder {' + name + '}')
+            parts.append((literal, name))
+        return parts
+
+    def expression(self, node, parts):
+        # Only strings and the template names joined with +
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            self.expression(node.left, parts)
+            self.expression(node.right, parts)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            parts.append((node.value, None))
+        elif isinstance(node, ast.Name) and node.id in templateNames:
+            parts.append(('', node.id))
+        elif isinstance(node, ast.Name):
+            raise ValueError('Unknown name ' + node.id + ' - use one of ' + ', '.join(templateNames))
+        else:
+            raise ValueError('Only quoted strings and ' + ', '.join(templateNames) + ' joined with + can be used')
+
+    def program(self):
+        if self.shell:
+            return None
+        return self.argv[0][0] if len(self.argv[0]) == 1 else None
+
+    def render(self, values):
+        # values has the templateNames.  Returns an argument list or (with shell syntax) a command string
+        if self.shell:
+            return ''.join(literal + (values[name] if name == 'debug' else shlex.quote(values[name]) if name else '')
+                           for literal, name in self.parts)
+        argv = []
+        for token in self.argv:
+            token = token.copy()
+            for i in range(1, len(token), 2):
+                token[i] = values[token[i]]
+            argv.append(''.join(token))
+        return argv
+
+def createCameras():
+    # Camera1 and Camera2 from their own options then Camera3 ... from -addcamera
+    specs = [{'type': camera1, 'url': weburl1, 'camparam': camparam1, 'device': usbdevice1, 'policy': policy1}]
+    if camera2 != '':
+        specs.append({'type': camera2, 'url': weburl2, 'camparam': camparam2, 'device': usbdevice2, 'policy': policy2})
+    for option in addcamera:
+        spec = {'type': '', 'url': '', 'camparam': '', 'device': '/dev/video0', 'policy': 'default'}
+        for item in shlex.split(option):
+            key, _, value = item.partition('=')
+            if key not in spec:
+                spec['type'] = 'invalid - unknown setting ' + key
+                break
+            spec[key] = value
+        specs.append(spec)
+
+    cameralist = []
+    for spec in specs:
+        name = 'Camera' + str(len(cameralist) + 1)
+        try:
+            if spec['type'] not in cameraTypes:
+                raise ValueError('type ' + spec['type'] + ' must be one of ' + ', '.join(cameraTypes))
+            cameralist.append(Camera(name, spec['type'], spec['url'], spec['camparam'], spec['device'], spec['policy']))
+        except ValueError as e:
+            logger.info('************************************************************************************')
+            logger.info('Invalid Camera: ' + name + ' ' + str(e))
+            logger.info('************************************************************************************\n')
+            sys.exit(2)
+    if usbgrabber:  # Only one grabber can open a device
+        devices = {}
+        for camera in cameralist:
+            if camera.type != 'usb':
+                continue
+            if camera.device in devices:
+                logger.info('************************************************************************************')
+                logger.info('Invalid Camera: ' + camera.name + ' uses ' + camera.device + ' as ' + devices[camera.device]
+                            + ' does.  Set -usbdevice2 (or device= for -addcamera)')
+                logger.info('************************************************************************************\n')
+                sys.exit(2)
+            devices[camera.device] = camera.name
+    return cameralist
+
+def cameraHealth():
+    return ', '.join(camera.name + ' ' + camera.health() for camera in cameras)
+
+def stopCaptureWorkers():
+    for camera in cameras:
+        camera.stop()
+
+###########################
+# Stream cameras
+###########################
+
+def jpegEnd(data, start):
+    # Index just after the JPEG that starts at start or -1 if it is not all there yet
+    # Segments are skipped by their length so that the end marker of an EXIF thumbnail does not end the image
+    pos = start + 2
+    while True:
+        if pos + 2 > len(data):
+            return -1
+        if data[pos] != 0xff:  # Not a marker - the segments are damaged so use the first end marker
+            end = data.find(b'\xff\xd9', pos)
+            return -1 if end < 0 else end + 2
+        marker = data[pos + 1]
+        if marker == 0xd9:
+            return pos + 2
+        if marker == 0xff:  # Fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd7:  # No length
+            pos += 2
+            continue
+        if pos + 4 > len(data):
+            return -1
+        pos += 2 + (data[pos + 2] << 8 | data[pos + 3])
+        if marker == 0xda:  # Start of scan - the image data runs to the next marker
+            while True:
+                pos = data.find(b'\xff', pos)
+                if pos < 0 or pos + 2 > len(data):
+                    return -1
+                following = data[pos + 1]
+                if following == 0 or 0xd0 <= following <= 0xd7:  # Stuffed byte or restart marker
+                    pos += 2
+                    continue
+                break
+
+class StreamReader:
+    # Keeps a stream camera (MJPEG over http) open and holds the latest complete JPEG in memory
+    # so that a capture is just a write of that frame.  onePhoto falls back to ffmpeg if there is no recent frame
+    maxBuffer = 4*1024*1024  # No frame in this many bytes - not an MJPEG stream
+    maxAge = 2  # seconds - an older frame means the stream has stalled
+    bufferRate = 5  # Most frames per second kept for -framebuffer
+
+    def __init__(self, cameraname, url):
+        self.cameraname = cameraname
+        self.url = url
+        self.lock = threading.Lock()
+        self.frame = None
+        self.frameTime = 0
+        self.buffer = collections.deque(maxlen=max(1, framebuffer * self.bufferRate))  # (monotonic time, frame)
+        self.frames = 0
+        self.fps = 0.0
+        self.state = -1  # -1 not running, 0 stop requested, 1 running
+        self.supported = True
+
+    def start(self):
+        if self.state != -1:
+            return
+        self.state = 1
+        threading.Thread(name=self.cameraname + 'Stream', target=self.run, daemon=False).start()
+
+    def stop(self):
+        if self.state == 1:
+            self.state = 0
+
+    def latest(self):
+        # The most recent frame and when it arrived or None, 0 if it is too old
+        with self.lock:
+            if self.frame is None or time.time() - self.frameTime > self.maxAge:
+                return None, 0
+            return self.frame, self.frameTime
+
+    def closest(self, when):
+        # The buffered frame taken nearest to when (time.time()) and its time or None, 0
+        target = time.monotonic() - (time.time() - when)
+        with self.lock:
+            if len(self.buffer) == 0:
+                return None, 0
+            taken, frame = min(self.buffer, key=lambda item: abs(item[0] - target))
+        return frame, time.time() - (time.monotonic() - taken)
+
+    def run(self):
+        logger.info('Starting stream reader for ' + self.cameraname)
+        retry = 0
+        while self.state == 1 and self.supported:
+            try:
+                with requests.get(self.url, stream=True, timeout=(5, 10)) as r:
+                    if not r.ok:
+                        raise requests.RequestException('http code ' + str(r.status_code))
+                    retry = 0
+                    self.readFrames(r.iter_content(chunk_size=4096))  # Small reads so a frame is seen as soon as it is complete
+            except (requests.RequestException, OSError) as e:
+                logger.debug(self.cameraname + ' stream error: ' + str(e))
+            if self.state == 1 and self.supported:
+                retry += 1
+                time.sleep(min(30, retry * 2))  # Camera restarting or unplugged
+        with self.lock:
+            self.frame = None
+            self.buffer.clear()
+        self.state = -1
+        logger.info('Stream reader for ' + self.cameraname + ' stopped')
+
+    def readFrames(self, chunks):
+        # Frames are found from the JPEG start (FFD8) using the part Content-Length if there is one,
+        # otherwise by following the JPEG segments to the end (FFD9).  This works with any multipart boundary or a bare run of JPEGs
+        buffer = bytearray()
+        counted = 0
+        countStart = time.time()
+        for chunk in chunks:
+            if self.state != 1:
+                return
+            buffer += chunk
+            while True:
+                start = buffer.find(b'\xff\xd8')
+                if start < 0:  # Keep the part headers - maxBuffer stops the buffer growing without a frame
+                    break
+                header = None
+                for header in re.finditer(rb'content-length:\s*(\d+)', buffer[:start], re.IGNORECASE):
+                    pass  # The last one is for this part
+                if header is not None:
+                    end = start + int(header.group(1))
+                    if len(buffer) < end:
+                        break
+                else:
+                    end = jpegEnd(buffer, start)
+                    if end < 0:
+                        break
+                with self.lock:
+                    self.frame = bytes(buffer[start:end])
+                    self.frameTime = time.time()
+                    self.frames += 1
+                    if framebuffer > 0:
+                        now = time.monotonic()
+                        if len(self.buffer) == 0 or now - self.buffer[-1][0] >= 1 / self.bufferRate:
+                            self.buffer.append((now, self.frame))
+                        while now - self.buffer[0][0] > framebuffer:  # Older than -framebuffer seconds
+                            self.buffer.popleft()
+                del buffer[:end]
+                counted += 1
+            if len(buffer) > self.maxBuffer:
+                logger.info('!!!!! ' + self.cameraname + ' is not an MJPEG stream - using ffmpeg for captures !!!!!')
+                self.supported = False
+                return
+            if time.time() - countStart >= 10:
+                self.fps = counted / (time.time() - countStart)
+                counted = 0
+                countStart = time.time()
+
+class UsbGrabber(StreamReader):
+    # Keeps a usb camera open in one ffmpeg process that writes JPEGs to a pipe.
+    # The device keeps its format and exposure between frames.  Restarted if ffmpeg exits e.g. the camera is unplugged
+    grabberFps = 4  # Frames per second from ffmpeg - enough to keep the latest frame fresh
+
+    def __init__(self, cameraname, device):
+        super().__init__(cameraname, device)
+        self.process = None
+
+    def stop(self):
+        super().stop()
+        process = self.process
+        if process is not None and process.poll() is None:
+            process.terminate()  # Unblocks the pipe read
+
+    def run(self):
+        logger.info('Starting usb grabber for ' + self.cameraname + ' on ' + self.url)
+        retry = 0
+        while self.state == 1:
+            cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'v4l2', '-i', self.url,
+                   '-vf', 'fps=' + str(self.grabberFps), '-f', 'image2pipe', '-c:v', 'mjpeg', '-q:v', '2', '-']
+            logger.debug('RUNNING GRABBER WITH ' + str(cmd))
+            started = time.time()
+            try:
+                self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                stderr=subprocess.DEVNULL)
+                self.readFrames(iter(lambda: self.process.stdout.read1(65536), b''))
+            except OSError as e:
+                logger.debug(self.cameraname + ' grabber error: ' + str(e))
+            finally:
+                if self.process is not None:
+                    if self.process.poll() is None:
+                        self.process.terminate()
+                    try:
+                        self.process.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        self.process.kill()
+                    self.process = None
+            with self.lock:
+                self.frame = None
+                self.buffer.clear()  # Frames from before a restart are not trusted
+            if self.state == 1:
+                retry = 1 if time.time() - started > 60 else retry + 1  # Ran for a while - start the backoff again
+                logger.info(self.cameraname + ' grabber stopped - restarting')
+                time.sleep(min(30, retry * 2))  # Device unplugged or busy
+        self.state = -1
+        logger.info('Usb grabber for ' + self.cameraname + ' stopped')
+
+def startStreamReaders():
+    if simulate in ['all', 'camera']:
+        return
+    for camera in cameras:
+        if camera.name not in streamReaders:
+            if camera.type == 'stream':
+                streamReaders[camera.name] = StreamReader(camera.name, camera.url)
+            elif camera.type == 'usb' and usbgrabber:
+                streamReaders[camera.name] = UsbGrabber(camera.name, camera.device)
+            else:
+                continue
+        streamReaders[camera.name].start()
+
+def stopStreamReaders():
+    for reader in streamReaders.values():
+        reader.stop()
+
+def streamStatus():
+    text = ''
+    for cameraname, reader in streamReaders.items():
+        label = cameraname + (' Grabber:= ' if isinstance(reader, UsbGrabber) else ' Stream:= ')
+        if reader.state != 1 or not reader.supported:
+            text += label + 'off<br>'
+        elif reader.latest()[0] is None:
+            text += label + 'waiting for frames<br>'
+        else:
+            text += label + '{0:.1f}'.format(reader.fps) + ' fps'
+            if framebuffer > 0:
+                text += ', ' + str(len(reader.buffer)) + ' buffered'
+            text += '<br>'
+    return text
+
+def cameraSession():
+    # Web cameras share one keep-alive session - separate from the printer session so they never use its slots
+    global snapshotSession
+    with urlSessionLock:
+        if snapshotSession is None:
+            snapshotSession = requests.Session()
+            retries = requests.adapters.Retry(total=1, connect=1, read=0, status=0, other=0,
+                                              allowed_methods=frozenset(['GET']), raise_on_status=False)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=2, max_retries=retries)
+            snapshotSession.mount('http://', adapter)
+            snapshotSession.mount('https://', adapter)
+        return snapshotSession
+
+def fetchSnapshot(cameraname, url):
+    # One image from a web camera or None if a complete image was not received
+    maxSnapshot = 32*1024*1024
+    deadline = time.time() + capturetimeout
+    try:
+        with cameraSession().get(url, stream=True, timeout=(min(5, capturetimeout), capturetimeout)) as r:
+            if not r.ok:
+                logger.info(cameraname + ' snapshot failed: http code ' + str(r.status_code) + ' from ' + url)
+                return None
+            contentType = r.headers.get('Content-Type', '').lower()
+            if contentType.startswith('multipart/'):
+                logger.info(cameraname + ' snapshot failed: ' + url + ' is a stream - use -camera stream')
+                return None
+            if not contentType.startswith('image/') and not contentType.startswith('application/octet-stream'):
+                logger.info(cameraname + ' snapshot failed: Content-Type ' + contentType + ' is not an image')
+                return None
+            expected = 0
+            if 'Content-Encoding' not in r.headers:  # Otherwise the length is before decoding
+                expected = int(r.headers.get('Content-Length', '0') or '0')
+            if expected > maxSnapshot:
+                logger.info(cameraname + ' snapshot failed: ' + str(expected) + ' bytes is too large')
+                return None
+            data = bytearray()
+            size = 0
+            late = False
+            for chunk in r.iter_content(chunk_size=65536):
+                size += len(chunk)
+                late = time.time() > deadline
+                if size > maxSnapshot or late:
+                    break
+                data += chunk
+        if late:
+            logger.info(cameraname + ' snapshot failed: took longer than ' + str(capturetimeout) + ' seconds')
+        elif size > maxSnapshot:
+            logger.info(cameraname + ' snapshot failed: more than ' + str(maxSnapshot) + ' bytes')
+        elif size == 0:
+            logger.info(cameraname + ' snapshot failed: empty response')
+        elif expected and size != expected:
+            logger.info(cameraname + ' snapshot failed: received ' + str(size) + ' of ' + str(expected) + ' bytes')
+        else:
+            return bytes(data)
+    except requests.Timeout:
+        logger.info(cameraname + ' snapshot failed: timed out fetching ' + url)
+    except requests.ConnectionError as e:
+        logger.info(cameraname + ' snapshot failed: could not connect to ' + url)
+        logger.debug(str(e))
+    except (requests.RequestException, OSError, ValueError) as e:
+        logger.info(cameraname + ' snapshot failed: ' + str(e))
+    return None
+
+###########################
+# Background image writer
+###########################
+
+class FrameWriter:
+    # Writes images from memory to disk in a background thread so that a slow card does not delay the capture loop
+    # Each file is written to a .tmp name and renamed when it is safely on disk.  Several files share one directory sync
+    batchSize = 16
+    retries = 2  # more tries for each file before the image is lost
+    drainTimeout = 10  # seconds to write what is queued before a forced termination
+
+    def __init__(self, depth, policy):
+        self.queue = queue.Queue(maxsize=depth)
+        self.policy = policy
+        self.state = -1  # -1 not running, 0 stop requested, 1 running
+        self.dropped = 0
+        self.errors = 0
+
+    def start(self):
+        if self.state != -1:
+            return
+        self.state = 1
+        threading.Thread(name='FrameWriter', target=self.run, daemon=False).start()
+
+    def stop(self):
+        self.flush()
+        if self.state == 1:
+            self.state = 0
+
+    def put(self, fn, data):
+        # Returns False if the image was dropped - the caller has not used the frame number
+        self.start()
+        try:
+            if self.policy == 'drop':
+                self.queue.put_nowait((fn, data, time.time()))
+            else:  # block - the capture waits for room
+                self.queue.put((fn, data, time.time()), timeout=capturetimeout)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.info('!!!!!  Image writes are falling behind - dropped ' + os.path.basename(fn) + ' !!!!!')
+            return False
+
+    def flush(self, timeout = None):
+        # Waits until everything queued is on disk.  Used before the images are read e.g. to make a video
+        # Returns False if images were still queued after timeout seconds
+        if self.state != 1:
+            return True
+        end = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def run(self):
+        while self.state == 1:
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.write(batch)
+            for _ in batch:
+                self.queue.task_done()
+        self.state = -1
+
+    def write(self, batch):
+        written = []
+        for fn, data, queued in batch:
+            for attempt in range(self.retries + 1):
+                try:
+                    with open(fn + '.tmp', 'wb') as outputfile:
+                        outputfile.write(data)
+                        outputfile.flush()
+                        os.fsync(outputfile.fileno())
+                    written.append((fn, queued))
+                    break
+                except OSError as e:
+                    removeFile(fn + '.tmp')
+                    if attempt < self.retries:
+                        time.sleep(0.5)
+                        continue
+                    # The frame number was used - createVideo closes the gap
+                    self.errors += 1
+                    logger.info('!!!!!  Could not write ' + fn + ' -- ' + str(e) + ' !!!!!')
+        directories = set()
+        for fn, queued in written:
+            try:
+                os.replace(fn + '.tmp', fn)
+                directories.add(os.path.dirname(fn))
+            except OSError as e:
+                self.errors += 1
+                logger.info('!!!!!  Could not write ' + fn + ' -- ' + str(e) + ' !!!!!')
+                removeFile(fn + '.tmp')
+        if not win:  # Makes the renames durable - once per directory for the whole batch
+            for directory in directories:
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    logger.debug('Could not sync ' + directory + ' ' + str(e))
+        now = time.time()
+        for fn, queued in written:
+            observe('duetlapse3_write_seconds', {}, now - queued)
+
+frameWriter = None  # Set in main from -writequeue
+
+def saveFrame(fn, data):
+    # Writes an image held in memory.  Returns False if it was not saved
+    if frameWriter is not None:
+        return frameWriter.put(fn, data)
+    try:
+        with open(fn + '.tmp', 'wb') as outputfile:
+            outputfile.write(data)
+        os.replace(fn + '.tmp', fn)
+        return True
+    except OSError as e:
+        logger.info('Could not save image ' + str(e))
+        removeFile(fn + '.tmp')
+        return False
+
+def flushFrames(timeout = None):
+    if frameWriter is not None:
+        return frameWriter.flush(timeout)
+    return True
+
+def stopFrameWriter():
+    if frameWriter is not None:
+        frameWriter.stop()
+
+def onePhoto(camera, transition = None):
+    # Returns (the time the image was taken or None, 'ok' or 'failed' or 'rejected' by -validate)
+    # transition is when the layer changed.  Used to choose a buffered frame with -framebuffer
+    global workingDir, lastImage, referer
+
+    with workingDirLock:  # Cameras can be captured at the same time
+        if workingDirStatus == -1: # Create as late as possible
+            workingDir = createworkingDir()
+
+        if workingDirStatus == 0: # Keep checking until jobname is known
+            workingDir = renameworkingDir(workingDir)
+
+    cameraname = camera.name
+    weburl = camera.url
+    camera.frame += 1
+    s = str(camera.frame).zfill(8)
+    fn = camera.camfile() + s + '.jpeg'
+
+    image = None
+    grabberBusy = False
+    if cameraname in streamReaders:  # stream camera or usb grabber
+        reader = streamReaders[cameraname]
+        if transition is not None and framebuffer > 0:
+            image, imageTime = reader.closest(transition)
+            if image is not None:
+                logger.debug(cameraname + ' using buffered frame from ' + '{0:.1f}'.format(imageTime - transition) + ' seconds after the layer change')
+        if image is None:
+            image, imageTime = reader.latest()
+        # The grabber holds the device open - fswebcam cannot use it
+        grabberBusy = image is None and isinstance(reader, UsbGrabber) and reader.state == 1
+
+    if 'usb' in camera.type:
         cmd = 'fswebcam --quiet --no-banner ' + fn + debug
 
-    if 'pi' in camera:
+    if 'pi' in camera.type:
         cmd = 'raspistill -t 1 -w 1280 -h 720 -ex sports -mm matrix -n -o ' + fn + debug
 
-    if 'stream' in camera:
+    if 'stream' in camera.type:
         #  cmd = 'ffmpeg -threads 1' + ffmpegquiet + ' -y -i ' + weburl + ' -vframes 1 -threads 1 ' + fn + debug
         cmd = 'ffmpeg' + ffmpegquiet + ' -y -i ' + weburl + ' -frames:v 1 -update true ' + fn + debug
 
-    if 'web' in camera:
+    if 'web' in camera.type:
         # Only for use if the url delivers single images (not for streaming)
-        # ? on use of --auth-no-challenge
-        if debug:
-            cmd = 'wget --auth-no-challenge -v --tries 2 -O ' + fn + ' "' + weburl + '" ' + debug
-        else:   
-            cmd = 'wget --auth-no-challenge -v --tries 2 -O ' + fn + ' "' + weburl + '" ' + debug
-            #cmd = 'wget --auth-no-challenge -nv --timeout 10 --tries 1 -O ' + fn + ' "' + weburl + '" ' + debug
+        # Fetched by fetchSnapshot - credentials in the url are sent without a challenge (as wget --auth-no-challenge)
+        cmd = None
 
-    if 'other' in camera:
-        cmd = eval(camparam)
-
-    global timePriorPhoto1, timePriorPhoto2
+    if 'other' in camera.type:
+        cmd = camera.template.render({'weburl': weburl, 'fn': fn, 'debug': debug, 'frame': s,
+                                      'layer': str(camera.zo), 'camera': cameraname})
 
+    rejected = False
     if simulate in ['all','camera']:
-        with open(fn, 'wb') as outputfile:
-            outputfile.write(simulatedImage)
-    elif runsubprocess(cmd) is False: #  order is important
-        logger.info('!!!!!  There was a problem capturing an image !!!!!')
+        captured = saveFrame(fn, simulatedImage)
+        captureTime = time.time()
+    elif grabberBusy:
+        logger.info('!!!!!  ' + cameraname + ' has no recent frame from the usb grabber !!!!!')
+        captured = False
+    elif image is not None:  # Latest frame from the stream reader or usb grabber
+        start = time.time()
+        # Checked before it is saved
+        rejected = validate != 'off' and not checkFrame(camera, image, fn)
+        captured = not rejected and saveFrame(fn, image)
+        captureTime = imageTime
+        observe('duetlapse3_capture_seconds', {'camera': cameraname, 'type': camera.type,
+                'result': 'ok' if captured else 'failed'}, time.time() - start)
+    else:
+        with fleetCapture or contextlib.nullcontext():  # Fleet members share the capture workers
+            start = time.time()
+            if cmd is None:
+                image = fetchSnapshot(cameraname, weburl)
+                captured = image is not None
+            else:
+                captured = runcapture(cmd, capturetimeout)
+            end = time.time()
+            captureTime = (start + end) / 2  # Best estimate - the exposure is somewhere in the call
+            observe('duetlapse3_capture_seconds', {'camera': cameraname, 'type': camera.type,
+                    'result': captured if captured == 'timeout' else ('ok' if captured else 'failed')}, end - start)
+            if captured == 'timeout':
+                captured = False
+        if cmd is None:  # web camera image is in memory
+            rejected = captured and validate != 'off' and not checkFrame(camera, image, fn)
+            captured = captured and not rejected and saveFrame(fn, image)
+        elif captured and validate != 'off':
+            try:
+                with open(fn, 'rb') as inputfile:
+                    data = inputfile.read()
+            except OSError:
+                data = b''
+            if not checkFrame(camera, data, fn):
+                rejected = True
+                captured = False
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+    if captured is False: #  order is important
+        if not rejected:  # Already logged by checkFrame
+            logger.info('!!!!!  There was a problem capturing an image !!!!!')
         # Decrement the frame counter because we did not capture anything
-        if cameraname == 'Camera1':
-            frame1 -= 1
-            if frame1 < 0:
-                frame1 = 0
-            return
-        else:
-            frame2 -= 1
-            if frame2 < 0:
-                frame2 = 0
-            return
+        camera.frame = max(0, camera.frame - 1)
+        return None, 'rejected' if rejected else 'failed'
     #  Success
     try:
         referer  # May not be defined yet
@@ -1445,29 +3043,54 @@ def onePhoto(cameraname, camera, weburl, camparam):
         pass
     else:
         lastImage = 'http://' + referer + '?getfile=' + fn
-    if cameraname == 'Camera1':
-        timePriorPhoto1 = time.time()
-        return
+    camera.timePrior = time.time()
+    if encode == 'live':
+        if simulate in ['all','camera']:
+            image = simulatedImage
+        elif image is None:  # Written by the capture command
+            try:
+                with open(fn, 'rb') as inputfile:
+                    image = inputfile.read()
+            except OSError as e:
+                logger.info('Could not read ' + fn + ' for the live encode ' + str(e))
+        if image is not None:
+            liveFrame(cameraname, image)
+    elif encode == 'segments':
+        segmentFrame(cameraname, camera.frame)
+    return captureTime, 'ok'
+
+def captureReason(camera, zn, layer, finalframe):
+    # Why this camera needs an image now or None
+    frame = str(camera.frame + 1)  # incremented in onePhoto before the image is captured
+    if pause == 'yes' and zn < 1:  # Dont capture anything until first layers is done
+        logger.debug('Bypassing ' + camera.name + ' because -pause = ' + pause + ' and layer = ' + str(zn))
+        layerTrigger = pauseTrigger = False
     else:
-        timePriorPhoto2 = time.time()
-        return
-
-def oneInterval(cameraname, camera, weburl, camparam, finalframe = False):
+        layerTrigger = camera.policy == 'layer' or (camera.policy == 'default' and 'layer' in detect)
+        pauseTrigger = camera.policy == 'default' and 'pause' in detect and duetStatus == 'paused'
+    interval = camera.every if camera.policy == 'seconds' else (seconds if camera.policy == 'default' else 0)
+
+    if layerTrigger:
+        if zn%(camera.every or numlayers) == 0 and not zn == camera.zo: #  Every numlayers layer
+            return 'Layer - ' + camera.name + ': capturing frame ' + frame + ' at layer ' + layer + ' after layer change'
+    elif pauseTrigger:
+        return 'Pause - ' + camera.name + ': capturing frame ' + frame + ' at layer ' + layer + ' at pause in print gcode'
+    elif finalframe:
+        return 'finalframe - ' + camera.name + ': capturing frame ' + frame + ' at layer ' + layer + ' after layer change'
+
+    elap = time.time() - camera.timePrior
+    logger.debug(camera.name + ' elapsed: ' + str(elap))
+    if (interval > 0) and (interval < elap) and (dontwait or 'none' in detect or camera.policy == 'seconds' or zn >= 1):
+        return 'Time - ' + camera.name + ': capturing frame ' + frame + ' at layer ' + layer + ' after ' + str(interval) + ' seconds'
+    return None
+
+def captureInterval(finalframe = False):
+    # Reads the layer once, decides which cameras need an image and has their workers capture at the same time
     if connectionState is False:
-        logger.debug('Bypassing oneInterval because of connectionState')
-        return
-    global frame1, frame2
-    global timePriorPhoto1, timePriorPhoto2
-
-    # set the logical frame number
-    # frame1 and frame 2 are incremented in onePhoto before image is captured
-    if cameraname == 'Camera1':
-        frame = frame1 + 1
-    else:
-        frame = frame2 + 1
+        logger.debug('Bypassing captureInterval because of connectionState')
+        return
 
-    global zo1, zo2  
-    zn = getDuet('Layer from oneInterval', Layer)
+    zn = getDuet('Layer from captureInterval', Layer)
     if connectionState is False:
         return
     if zn == -1:
@@ -1475,47 +3098,76 @@ def oneInterval(cameraname, camera, weburl, camparam, finalframe = False):
     else:
         layer = str(zn)
 
-    if pause == 'yes' and zn < 1:  # Dont capture anything until first layers is done
-        logger.debug('Bypassing onePhoto from oneInterval because -pause = ' + pause + ' and layer = ' +str(zn))
-    else:    
-        if 'layer' in detect:
-            checkForPause(zn)
-            if zn%numlayers == 0: #  Every numlayers layer
-                if (not zn == zo1 and cameraname == 'Camera1') or (not zn == zo2 and cameraname == 'Camera2'):
-                    # Layer changed, take a picture.
-                    logger.info('Layer - ' + cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' after layer change')
-                    onePhoto(cameraname, camera, weburl, camparam)
-
-        elif ('pause' in detect) and (duetStatus == 'paused'):
-            checkForPause(zn)
-            logger.info('Pause - ' + cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' at pause in print gcode')
-            onePhoto(cameraname, camera, weburl, camparam)
-        elif finalframe:
-            # get a final frame
-            checkForPause(zn)
-            logger.info('finalframe - ' + cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' after layer change')
-            onePhoto(cameraname, camera, weburl, camparam)
-
-
-    # update the layer counter
-    if cameraname == 'Camera1':
-        zo1 = zn
-    else:
-        zo2 = zn
-
-    # Note that onePhoto() updates timePriorPhoto1 and timePriorPhoto2
-    if cameraname == 'Camera1':
-        elap = (time.time() - timePriorPhoto1)
+    if 'layer' in detect and not (pause == 'yes' and zn < 1):
+        checkForPause(zn)
+        paused = True
     else:
-        elap = (time.time() - timePriorPhoto2)
+        paused = False
 
-    logger.debug('elapsed: ' + str(elap))
+    captures = []
+    for camera in cameras:
+        reason = captureReason(camera, zn, layer, finalframe)
+        if reason is not None and camera.available():
+            captures.append((camera, reason))
+        camera.zo = zn  # update the layer counter
 
-    if (seconds > 0) and (seconds < elap) and (dontwait or 'none' in detect or zn >= 1):
+    if len(captures) == 0:
+        return
+    if not paused:
         checkForPause(zn)
-        logger.info('Time - ' + cameraname + ': capturing frame ' + str(frame) + ' at layer ' + layer + ' after ' + str(
-                seconds) + ' seconds')
-        onePhoto(cameraname, camera, weburl, camparam)
+
+    transition = None  # With -pause yes the head is parked now - the latest frame is the right one
+    if framebuffer > 0 and pause == 'no' and any(reason.startswith('Layer') for camera, reason in captures):
+        transition = layerChangeTime()
+
+    # All cameras start together
+    trigger = time.time()
+    results = queue.Queue()
+    for camera, reason in captures:
+        camera.start()  # Only starts the worker the first time
+        camera.capture(reason, results, transition if reason.startswith('Layer') else None)
+    taken = {}
+    while len(taken) < len(captures):
+        try:
+            cameraname, captureTime = results.get(timeout=captureWait)
+        except queue.Empty:
+            logger.info('!!!!!  Gave up waiting for ' + str(len(captures) - len(taken)) + ' camera(s) !!!!!')
+            break
+        taken[cameraname] = captureTime
+
+    recordFrameTimes(captures, taken, layer, trigger)
+
+def recordFrameTimes(captures, taken, layer, trigger):
+    # One line per image in frametimes.csv.  skew is how much later the image was taken than the first in the group
+    global captureSkew
+    times = [t for t in taken.values() if t is not None]
+    if len(times) == 0:
+        return
+    first = min(times)
+    if len(times) > 1:
+        captureSkew = max(times) - first
+        observe('duetlapse3_capture_skew_seconds', {}, captureSkew)
+    lines = ''
+    for camera, reason in captures:
+        if taken.get(camera.name) is None:
+            continue
+        lines += '{0},{1},{2},{3:.3f},{4:.3f},{5:.3f}\n'.format(camera.name, camera.frame, layer, trigger,
+                                                             taken[camera.name], taken[camera.name] - first)
+    fn = os.path.join(workingDir, 'frametimes.csv')
+    with frameTimesLock:  # closeGaps may be rewriting it
+        try:
+            newfile = not os.path.isfile(fn)
+            with open(fn, 'a') as f:
+                if newfile:
+                    f.write('camera,frame,layer,trigger,captured,skew\n')
+                f.write(lines)
+        except OSError as e:
+            logger.debug('Could not write frame times ' + str(e))
+
+def skewStatus():
+    if captureSkew is None:
+        return 'n/a'
+    return str(int(captureSkew * 1000)) + ' ms'
 
 #############################################################################
 ##############  Duet API access Functions
@@ -1550,14 +3202,14 @@ def getDuet(calledfrom, function): #  Helper function to call other specific get
             connectionState = False # Stop additional calls
             disconnected += 1
             logger.debug('Number of disconnects ' + str(disconnected))
-            time.sleep(1)
-            if disconnected > 2:  #  Persistent error state
+            if disconnected > 2 or breakerState != 'closed':  #  Persistent error state - or breaker says don't wait
                 #  connectionState = False
                 startnextAction('waitforconnection')
                 response = [] # start with a list
                 for i in range(responseitems):
                     response.append(None) # Dummy return
                 return tuple(response)  # turn the response into a tuple 
+            time.sleep(breakerJitter(disconnected))
         else:
             getstatus = True # We have a status
 
@@ -1565,6 +3217,115 @@ def getDuet(calledfrom, function): #  Helper function to call other specific get
     return result
 
 
+def printerSession():
+    # One keep-alive session per printer so that polls reuse the same connection
+    # Standalone Duets only have a few connection slots - so keep the pool small
+    global urlSession
+    with urlSessionLock:
+        if urlSession is None:
+            urlSession = requests.Session()
+            # No retries here - urlCall retries and counts every attempt for the circuit breaker
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0)
+            urlSession.mount('http://', adapter)
+            logger.debug('Created new printer session')
+        return urlSession
+
+def resetSession():
+    # Drops all pooled connections - the next call reconnects
+    global urlSession
+    with urlSessionLock:
+        if urlSession is not None:
+            try:
+                urlSession.close()
+            except Exception as e:
+                logger.debug('Error closing printer session ' + str(e))
+        urlSession = None
+
+def urlEndpoint(url):
+    # Name used for latency stats e.g. /machine/status or /rr_model?key=state
+    parsed = urlparse(url)
+    endpoint = parsed.path
+    if endpoint == '/rr_model':
+        query = parse_qs(parsed.query)
+        if 'key' in query:
+            endpoint += '?key=' + query['key'][0]
+        else:
+            endpoint += '?flags=' + query.get('flags', [''])[0]
+    return endpoint
+
+def recordUrlStats(url, elapsed, ok):
+    endpoint = urlEndpoint(url)
+    with urlSessionLock:
+        stats = urlStats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        stats['calls'] += 1
+        if not ok:
+            stats['errors'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['last'] = elapsed
+    observe('duetlapse3_printer_call_seconds', {'endpoint': endpoint}, elapsed)
+    logger.debug(endpoint + ' took ' + '{0:.3f}'.format(elapsed) + ' seconds')
+
+def getUrlStats():
+    # Snapshot of the per endpoint latency stats
+    with urlSessionLock:
+        return {endpoint: dict(stats) for endpoint, stats in urlStats.items()}
+
+def breakerJitter(attempt):
+    # Random wait that doubles with each attempt - spreads out retries from many threads (or printers)
+    delay = min(breakerMaxDelay, breakerBaseDelay * (2 ** (attempt - 1)))
+    return random.uniform(delay / 2, delay)
+
+def breakerAllow():
+    # Circuit breaker for calls to the printer
+    # closed - calls are made as normal
+    # open - calls fail immediately until the backoff time has passed
+    # half-open - one probe call is allowed through.  Success closes the breaker, failure opens it again for longer
+    global breakerState
+    with breakerLock:
+        if breakerState == 'closed':
+            return True
+        if breakerState == 'open' and time.time() >= breakerRetryTime:
+            breakerState = 'half-open'
+            logger.info('!!!!! Printer circuit half-open - probing the printer !!!!!')
+            return True
+        return False
+
+def breakerSuccess():
+    global breakerState, breakerFailures, breakerOpens
+    with breakerLock:
+        if breakerState != 'closed':
+            logger.info('!!!!! Printer circuit closed - printer is responding !!!!!')
+        breakerState = 'closed'
+        breakerFailures = 0
+        breakerOpens = 0
+
+def breakerFailure():
+    global breakerState, breakerFailures, breakerOpens, breakerRetryTime
+    with breakerLock:
+        breakerFailures += 1
+        if breakerState == 'half-open' or breakerFailures >= breakerThreshold:
+            breakerOpens += 1
+            wait = breakerJitter(breakerOpens)
+            breakerRetryTime = time.time() + wait
+            if breakerState != 'open':
+                logger.info('!!!!! Printer circuit open - next try in ' + '{0:.1f}'.format(wait) + ' seconds !!!!!')
+            breakerState = 'open'
+
+def breakerWait():
+    # Seconds until the breaker allows a probe
+    with breakerLock:
+        if breakerState != 'open':
+            return 0
+        return max(0, breakerRetryTime - time.time())
+
+def breakerStatus():
+    with breakerLock:
+        text = breakerState + ' (' + str(breakerFailures) + ' failures)'
+        if breakerState == 'open':
+            text += ' retry in ' + str(int(max(0, breakerRetryTime - time.time()))) + 's'
+        return text
+
 def urlCall(url, post):
     # Makes all the calls to the printer
     # If post is True then make a http post call
@@ -1575,22 +3336,45 @@ def urlCall(url, post):
     while loop < limit:
         error  = ''
         code = 9999
+        if not breakerAllow():  # Fail fast - the printer is not responding
+            error = 'Circuit open'
+            logger.debug('Circuit open - not calling ' + str(url))
+            break
         logger.debug(str(loop) +' url: ' + str(url) + ' post: ' + str(post))
+        session = printerSession()
+        start = time.time()
         try:
             if post is False:
-                r = requests.get(url, timeout=timelimit, headers=urlHeaders)
+                r = session.get(url, timeout=timelimit, headers=urlHeaders)
             else:
-                r = requests.post(url, timeout=timelimit, data=post, headers=urlHeaders)
+                r = session.post(url, timeout=timelimit, data=post, headers=urlHeaders)
         except requests.ConnectionError as e:
             logger.info('Cannot connect to the printer\n')
             logger.debug(str(e))
             logger.debug('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n')
             error = 'Connection Error'
+            resetSession()  # Reconnect on the next try
         except requests.exceptions.Timeout as e:
             logger.info('The printer connection timed out\n')
             logger.debug(str(e))
             logger.debug('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n')
             error = 'Timed Out'
+            resetSession()
+        except requests.RequestException as e:  # e.g. a broken chunked reply - still a failed call
+            logger.info('The printer call failed\n')
+            logger.debug(str(e))
+            logger.debug('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!\n')
+            error = 'Request Error'
+            resetSession()
+        except Exception:
+            breakerFailure()  # Never leave the breaker half-open waiting for this probe
+            raise
+        recordUrlStats(url, time.time() - start, error == '' and r.ok)
+
+        if error != '' or r.status_code >= 500:  # Printer not reachable or not able to answer
+            breakerFailure()
+        else:
+            breakerSuccess()
 
         if error == '': # call returned something
             code = r.status_code
@@ -1606,8 +3390,9 @@ def urlCall(url, post):
                     if loginRetry > 1: # Failed to get new key
                         break
             # any other http error codes are to be handled by caller            
-        time.sleep(1)
         loop += 1      # Try again
+        if loop < limit:
+            time.sleep(breakerJitter(loop) / 2)
  
     # Call failed - Create dummy response
     class r:
@@ -1623,6 +3408,13 @@ def loginPrinter(model = ''):
     global urlHeaders
     urlHeaders = {}
     logger.info('Logging in to Printer')
+    resetSession()  # Start with fresh connections
+    resetStandaloneModel()
+
+    if transport == 'socket' and model in ['', 'SBC']:
+        if connectSocket():
+            return 'SBC', 200
+        logger.info('!!!!! Falling back to http !!!!!')
 
     if model == '' or model == 'rr_model':
         URL = ('http://' + duet + '/rr_disconnect') # Close any open session
@@ -1666,7 +3458,7 @@ def loginPrinter(model = ''):
             logger.debug('!!!!! Connected to SBC printer !!!!!')
             j = json.loads(r.text)
             sessionKey = j['sessionKey']
-            urlHeaders = {'X-Session-Key': sessionKey}
+            urlHeaders = {'X-Session-Key': str(sessionKey)}
             model = 'SBC'
 
             #  Could not connect to printer   
@@ -1713,65 +3505,595 @@ def getDuetVersion(model):
             logger.info('!!!!! Error getting rr_model?key=boards code = ' + str(r.status_code) + '!!!!!') 
 
     elif model == 'SBC':       
-        URL = ('http://' + duet + '/machine/status')
-        r = urlCall(URL,  False)
-        if r.status_code == 200:
-            j = {}
-            try:
-                j = json.loads(r.text)
-            except:
-                logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-                logger.info("json.loads(r.text) could not be parsed")
-                logger.info(j)
-                logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+        boards = getModel('boards')  # http or DSF socket
+        if boards != 'disconnected':
             try:
-                version = j['boards'][0]['firmwareVersion']
+                version = boards[0]['firmwareVersion']
                 return version
-            except KeyError:
+            except (KeyError, IndexError, TypeError):
                 logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-                logger.info("j['boards'][0]['firmwareVersion'] does not exist")
-                logger.info(j)
+                logger.info("['boards'][0]['firmwareVersion'] does not exist")
+                logger.info(boards)
                 logger.info('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
             except:
                 logger.info('!!!!! Could not get SBC firmware version !!!!!')
         else:
-            logger.info('!!!!! Error getting /machine/status code = ' + str(r.status_code) + '!!!!!')
+            logger.info('!!!!! Error getting SBC object model !!!!!')
     else:
         logger.info('!!!!! Could not get version for installation type =  ' + model +  '  !!!!!')
         logger.info('!!!!! THIS SHOULD NEVER HAPPEN !!!!!')
         return ''  # Failed to determine API and firmware version
 
-def Jobname():
-    # Used to get the print jobname from Duet
-    if simulate in ['all','printer']:
-        return 'simulated_job'
+def getModel(key):
+    # Returns one top level section of the object model e.g. state, job, move, global, plugins
+    # Over http (SBC) only the keys in modelSelection are decoded
+    # All the accessors in a poll cycle share a single fetch and parse of the object model
+    # The parsed response is cached for modelTTL seconds
+    # Returns 'disconnected' if the printer could not be reached
+    global modelCacheHits, modelCacheMisses
+    if subscriptionLive and (subscribedKeys is None or key in subscribedKeys):  # Kept up to date by subscribeLoop
+        with modelLock:
+            modelCacheHits += 1
+            return copy.deepcopy(subscribedModel.get(key))
+
     if apiModel == 'rr_model':
-        URL = ('http://' + duet + '/rr_model?key=job.file.fileName')
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                jobname = j['result']
-                if jobname is None:
-                    jobname = ''
-                return jobname
-            except Exception as e:
-                logger.debug('Could not get jobname')
-                logger.debug(str(e))
+        return getStandaloneModel(key)
 
-    elif apiModel == 'SBC':
+    if socketTransport:
+        URL = 'socket/GetObjectModel'
+    else:
         URL = ('http://' + duet + '/machine/status')
-        r = urlCall(URL,  False)
-        if r.ok:
+
+    with modelLock:  # Only one thread fetches - the others use the result
+        cached = modelCache.get(URL)
+        if cached is not None and time.time() - cached[0] < modelTTL:
+            modelCacheHits += 1
+            j = cached[1]
+        else:
+            modelCacheMisses += 1
+            if socketTransport:
+                ok, j = dsfCommand({'command': 'GetObjectModel'})
+                if not ok or j is None:
+                    return 'disconnected'
+            else:
+                r = urlCall(URL,  False)
+                if not r.ok:
+                    return 'disconnected'
+                try:
+                    j = parseModel(r.text)
+                except ValueError as e:
+                    logger.debug('Could not parse object model')
+                    logger.debug(str(e))
+                    return 'disconnected'
+            modelCache[URL] = (time.time(), j)
+
+    return j.get(key)
+
+###########################
+# Selective object model parsing
+###########################
+
+# /machine/status returns the whole object model - hundreds of KB on a machine with many tools, heaters and plugins
+# Only the values in modelSelection are decoded.  Everything else is skipped by regular expressions without
+# creating python objects.  None means decode the whole value
+modelSelection = {'boards': None,
+                  'global': {'DL3msg': None, 'DL3del': None},
+                  'job': {'file': {'fileName': None}, 'layer': None, 'layerTime': None},
+                  'move': {'axes': None},
+                  'plugins': {'DuetLapse3': {'pid': None}},
+                  'state': None}
+
+jsonString = r'"[^"\\]*+(?:\\.[^"\\]*+)*+"'
+
+def jsonSkipPattern(depth):
+    # Matches one complete object or array nested up to depth levels (re has no recursion)
+    inner = r'(?:[^"{}\[\]]++|' + jsonString + r')*+'
+    for _ in range(depth):
+        inner = r'(?:[^"{}\[\]]++|' + jsonString + r'|[{\[]' + inner + r'[}\]])*+'
+    return r'[{\[]' + inner + r'[}\]]'
+
+if sys.version_info >= (3, 11):  # Possessive quantifiers - without them a failed match can backtrack for ever
+    jsonKey = re.compile(r'[\s,]*+(' + jsonString + r')\s*+:\s*+')
+    # Numbers and literals only - an object or array nested deeper than the skip pattern must fail (full parse)
+    jsonValue = re.compile(jsonSkipPattern(16) + r'|' + jsonString + r'|-?\d[\d.eE+-]*+|true|false|null')
+    jsonClose = re.compile(r'\s*+}')
+else:
+    jsonValue = None  # Always do a full parse
+jsonDecoder = json.JSONDecoder()
+
+def selectJson(text, pos, selection):
+    # Decodes the object starting at text[pos] keeping only the selected keys
+    # Raises ValueError if the text cannot be followed
+    result = {}
+    pos += 1
+    while True:
+        match = jsonKey.match(text, pos)
+        if match is None:
+            break
+        key = match.group(1)[1:-1]
+        if '\\' in key:
+            key = json.loads(match.group(1))
+        pos = match.end()
+        if key in selection:
+            if selection[key] is None or text[pos] != '{':
+                result[key], pos = jsonDecoder.raw_decode(text, pos)
+            else:
+                result[key], pos = selectJson(text, pos, selection[key])
+        else:
+            skipped = jsonValue.match(text, pos)
+            if skipped is None:
+                raise ValueError('Could not skip ' + key + ' at ' + str(pos))
+            pos = skipped.end()
+    close = jsonClose.match(text, pos)
+    if close is None:
+        raise ValueError('Expected } at ' + str(pos))
+    return result, close.end()
+
+def parseModel(text, selection = None):
+    # The selected parts of the object model - or all of it if the selective parse is not possible
+    if selection is None:
+        selection = modelSelection
+    if jsonValue is not None and len(text) >= 16384:  # Below this a full parse is quicker
+        start = len(text) - len(text.lstrip())
+        if text[start:start + 1] == '{':
             try:
-                j = json.loads(r.text)
-                jobname = j['job']['file']['fileName']
-                if jobname is None:
-                    jobname = ''
-                return jobname
-            except Exception as e:
-                logger.debug('Could not get jobname')
+                return selectJson(text, start, selection)[0]
+            except (ValueError, IndexError) as e:
+                logger.debug('Selective parse failed - using full parse')
                 logger.debug(str(e))
+    return json.loads(text)
+
+def invalidateModel():
+    # Called after anything that changes the printer state e.g. gcode
+    global standaloneFrequentTime
+    with modelLock:
+        modelCache.clear()
+        standaloneFrequentTime = 0
+
+def rrModel(query):
+    URL = ('http://' + duet + '/rr_model?' + query)
+    r = urlCall(URL,  False)
+    if not r.ok:
+        return 'disconnected'
+    try:
+        return json.loads(r.text)['result']
+    except (ValueError, KeyError) as e:
+        logger.debug('Could not parse rr_model?' + query)
+        logger.debug(str(e))
+        return 'disconnected'
+
+def getStandaloneModel(key):
+    # Standalone boards: one rr_model call per poll returns the frequently changing values (status, layer, position)
+    # and the seqs counters. A section is only fetched again when its seqs counter has changed
+    global modelCacheHits, modelCacheMisses, standaloneFrequentTime, standaloneSeqs
+    with modelLock:
+        if time.time() - standaloneFrequentTime >= modelTTL:
+            modelCacheMisses += 1
+            result = rrModel('flags=d99fn')
+            if result == 'disconnected':
+                return 'disconnected'
+            standaloneSeqs = result.pop('seqs', None) or {}
+            mergePatch(standaloneModel, result)
+            standaloneFrequentTime = time.time()
+        else:
+            modelCacheHits += 1
+
+        seq = standaloneSeqs.get(key)
+        if key not in standaloneFetched:
+            stale = True
+        elif seq is None:  # Older firmware without seqs - refresh on the poll interval
+            stale = time.time() - standaloneFetched[key][1] >= modelTTL
+        else:
+            stale = seq != standaloneFetched[key][0]
+        if stale:
+            result = rrModel('key=' + key + '&flags=d99vn')
+            if result == 'disconnected':
+                return 'disconnected'
+            standaloneModel[key] = result
+            standaloneFetched[key] = (seq, time.time())
+            logger.debug('Fetched ' + key + ' at seq ' + str(seq))
+
+        return copy.deepcopy(standaloneModel.get(key))
+
+def resetStandaloneModel():
+    # After a (re)connect the board may have restarted and its seqs counters with it
+    global standaloneFrequentTime, standaloneSeqs
+    with modelLock:
+        standaloneModel.clear()
+        standaloneFetched.clear()
+        standaloneSeqs = {}
+        standaloneFrequentTime = 0
+
+#############################################################################
+##############  DSF IPC socket (SBC)
+#############################################################################
+
+class DsfSocketClient:
+    # Client for the local DSF socket e.g. /run/dsf/dcs.sock
+    # Messages in both directions are plain JSON objects with no delimiter
+    def __init__(self, mode, timeout, filters=None):
+        self.buffer = ''
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.first = True
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(dsfsocket)
+            server = self.receive()  # DSF announces its protocol version
+            init = {'mode': mode, 'version': server.get('version', 12)}
+            if mode == 'Subscribe':
+                init['subscriptionMode'] = 'Patch'
+                if filters is not None:
+                    init['filters'] = filters
+            self.send(init)
+            response = self.receive()
+        except (OSError, ConnectionError, ValueError):
+            self.close()
+            raise
+        if not response.get('success'):
+            self.close()
+            raise ConnectionError('DSF refused the connection: ' + str(response.get('errorMessage')))
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message).encode('utf-8'))
+
+    def receive(self):
+        while True:
+            text = self.buffer.lstrip()
+            if text != '':
+                try:
+                    message, end = self.decoder.raw_decode(text)
+                    self.buffer = text[end:]
+                    return message
+                except ValueError:
+                    pass  # Not all of it has arrived yet
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('DSF closed the connection')
+            self.buffer = text + self.utf8.decode(data)
+
+    def command(self, command):
+        # Returns the full response - success is checked by the caller
+        self.send(command)
+        return self.receive()
+
+    def update(self):
+        # Subscription: first call returns the full model, then one patch per call
+        if not self.first:
+            self.send({'command': 'Acknowledge'})
+        self.first = False
+        return self.receive()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def connectSocket():
+    # Opens the command connection.  Returns False if DSF could not be reached this way
+    global dsfConnection, socketTransport
+    with dsfLock:
+        if dsfConnection is not None:
+            dsfConnection.close()
+            dsfConnection = None
+        try:
+            dsfConnection = DsfSocketClient('Command', dsfTimeout)
+        except (OSError, ConnectionError, ValueError) as e:
+            logger.info('!!!!! Could not connect to DSF socket ' + dsfsocket + ' !!!!!')
+            logger.debug(str(e))
+            socketTransport = False
+            return False
+    logger.info('!!!!! Connected to SBC printer using ' + dsfsocket + ' !!!!!')
+    socketTransport = True
+    return True
+
+def dsfCommand(command):
+    # Sends one command over the DSF socket.  Returns success, result
+    # Uses the same circuit breaker as urlCall - fails fast while DSF is not answering
+    global dsfConnection
+    with dsfLock:
+        for attempt in range(2):  # Reconnect once if the connection was lost
+            if not breakerAllow():
+                logger.debug('Circuit open - not sending ' + command['command'])
+                return False, None
+            start = time.time()
+            try:
+                if dsfConnection is None:
+                    dsfConnection = DsfSocketClient('Command', dsfTimeout)
+                response = dsfConnection.command(command)
+            except (OSError, ConnectionError, ValueError) as e:
+                logger.debug('DSF socket error on ' + command['command'] + ' : ' + str(e))
+                recordUrlStats('socket/' + command['command'], time.time() - start, False)
+                breakerFailure()
+                if dsfConnection is not None:
+                    dsfConnection.close()
+                    dsfConnection = None
+                continue
+            breakerSuccess()  # DSF answered - even if the command itself failed
+            recordUrlStats('socket/' + command['command'], time.time() - start, response.get('success') is True)
+            if response.get('success'):
+                return True, response.get('result')
+            logger.info('DSF ' + command['command'] + ' failed: ' + str(response.get('errorMessage')))
+            return False, None
+    return False, None
+
+#############################################################################
+##############  Object model subscription (SBC)
+#############################################################################
+
+def wsMask(data, mask):
+    # XOR data with the 4 byte websocket mask
+    if len(data) == 0:
+        return data
+    repeated = (mask * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(len(data), 'big')
+
+
+class WebSocketClient:
+    # Minimal RFC 6455 client - only what is needed for the DSF subscription at /machine
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    pingInterval = 10  # seconds without a patch before asking the printer if it is still there
+
+    def __init__(self, url, timeout):
+        parsed = urlparse(url)
+        self.buffer = b''
+        self.first = True
+        self.timeout = timeout
+        self.sock = socket.create_connection((parsed.hostname, parsed.port or 80), timeout=timeout)
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = parsed.path
+        if parsed.query:
+            path += '?' + parsed.query
+        request = 'GET ' + path + ' HTTP/1.1\r\n' \
+                  'Host: ' + parsed.netloc + '\r\n' \
+                  'Upgrade: websocket\r\n' \
+                  'Connection: Upgrade\r\n' \
+                  'Sec-WebSocket-Key: ' + key + '\r\n' \
+                  'Sec-WebSocket-Version: 13\r\n\r\n'
+        self.sock.sendall(request.encode())
+        while b'\r\n\r\n' not in self.buffer:
+            self.buffer += self._recv()
+        header, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        lines = header.decode('latin-1').split('\r\n')
+        if len(lines[0].split()) < 2 or lines[0].split()[1] != '101':
+            self.sock.close()
+            raise ConnectionError('Subscription refused: ' + lines[0])
+        expected = base64.b64encode(hashlib.sha1((key + self.GUID).encode()).digest()).decode()
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'sec-websocket-accept' and value.strip() != expected:
+                self.sock.close()
+                raise ConnectionError('Invalid Sec-WebSocket-Accept from printer')
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('Connection closed by printer')
+        return data
+
+    def _read(self, count):
+        while len(self.buffer) < count:
+            self.buffer += self._recv()
+        data, self.buffer = self.buffer[:count], self.buffer[count:]
+        return data
+
+    def send(self, message, opcode=1):
+        payload = message.encode('utf-8') if isinstance(message, str) else message
+        length = len(payload)
+        header = bytes([0x80 | opcode])
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)  # Clients must always mask
+        self.sock.sendall(header + mask + wsMask(payload, mask))
+
+    def recv(self):
+        # Returns the next complete text message
+        message = b''
+        while True:
+            b1, b2 = self._read(2)
+            opcode = b1 & 0x0F
+            length = b2 & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', self._read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._read(8))[0]
+            if b2 & 0x80:
+                mask = self._read(4)
+                payload = wsMask(self._read(length), mask)
+            else:
+                payload = self._read(length)
+            if opcode == 8:  # close
+                raise ConnectionError('Subscription closed by printer')
+            elif opcode == 9:  # ping
+                self.send(payload, 10)
+                continue
+            elif opcode == 10:  # pong
+                continue
+            message += payload
+            if b1 & 0x80:  # final fragment
+                return message.decode('utf-8')
+
+    def update(self):
+        # DSF subscription: first call returns the full model, then one patch per call
+        if not self.first:
+            self.send('OK\n')  # Ask for the next patch
+        self.first = False
+        # DSF only sends a patch when something changes.  PING keeps a quiet connection open - any reply shows it is alive
+        quiet = 0
+        while True:
+            if len(self.buffer) == 0 and not select.select([self.sock], [], [], self.pingInterval)[0]:
+                quiet += self.pingInterval
+                if quiet >= self.timeout:
+                    raise ConnectionError('No reply from printer for ' + str(quiet) + ' seconds')
+                self.send('PING\n')
+                continue
+            message = self.recv()
+            quiet = 0
+            if not message.startswith('PONG'):
+                return json.loads(message)
+
+    def close(self):
+        try:
+            self.send(b'', 8)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def mergePatch(target, patch):
+    # Applies a DSF object model patch to target (in place)
+    # Objects are merged by key, arrays of objects are merged by index and take the length of the patch
+    for key, value in patch.items():
+        current = target.get(key)
+        if isinstance(value, dict) and isinstance(current, dict):
+            mergePatch(current, value)
+        elif isinstance(value, list) and isinstance(current, list):
+            target[key] = mergeList(current, value)
+        else:
+            target[key] = value
+    return target
+
+def mergeList(current, patch):
+    merged = []
+    for i, value in enumerate(patch):
+        if i < len(current) and isinstance(value, dict) and isinstance(current[i], dict):
+            merged.append(mergePatch(current[i], value))
+        else:
+            merged.append(value)
+    return merged
+
+#  The parts of the object model that are reported as events
+watchedModel = {'status': ('state', 'status'),
+                'layer': ('job', 'layer'),
+                'messages': ('global', 'DL3msg'),
+                'deletes': ('global', 'DL3del')}
+
+def watchedValues(model):
+    values = {}
+    for name, path in watchedModel.items():
+        value = model
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        values[name] = copy.deepcopy(value)
+    return values
+
+def notifyModelChange(changes, initial = False):
+    # initial is the full model when the subscription (re)connects - nothing has actually changed at that time
+    global modelSequence
+    with modelCondition:
+        for change in changes:
+            if initial:
+                modelChangeTime.pop(change, None)  # Not known - may have changed while disconnected
+            else:
+                modelChangeTime[change] = time.time()
+        modelSequence += 1
+        modelHistory.append((modelSequence, set(changes)))
+        modelCondition.notify_all()
+    logger.debug('Object model changed: ' + str(changes))
+
+def waitforModelChange(timeout):
+    # Replaces fixed sleeps.  Returns early with the set of changes if the subscription reports one
+    # Each thread gets every change since its last call - one waiter does not take a change from another
+    if not subscriptionLive:
+        time.sleep(timeout)
+        return set()
+    with modelCondition:
+        seen = getattr(modelSeen, 'sequence', modelSequence)
+        if modelSequence == seen:
+            modelCondition.wait(timeout)
+        changes = set()
+        for sequence, names in modelHistory:
+            if sequence > seen:
+                changes.update(names)
+        modelSeen.sequence = modelSequence
+    return changes
+
+def modelSource():
+    if subscriptionLive:
+        return 'subscription'
+    return 'polling'
+
+def openSubscription():
+    global subscribedKeys
+    if socketTransport:
+        subscribedKeys = ['state', 'job', 'move', 'global', 'plugins']
+        return DsfSocketClient('Subscribe', subscriptionTimeout, [key + '/**' for key in subscribedKeys])
+    subscribedKeys = None  # Everything
+    URL = 'ws://' + duet + '/machine'
+    if urlHeaders.get('X-Session-Key') is not None:
+        URL += '?sessionKey=' + str(urlHeaders['X-Session-Key'])
+    return WebSocketClient(URL, subscriptionTimeout)
+
+def subscribeLoop():
+    # Keeps a live copy of the object model up to date with patches from DSF
+    # While it is live, getModel reads from it and no polling calls are made
+    global subscriptionState, subscriptionLive, subscribedModel
+    subscriptionState = 1
+    logger.info('###########################')
+    logger.info('Starting object model subscription')
+    logger.info('###########################\n')
+    while subscriptionState == 1 and terminateState != 1:
+        ws = None
+        if not breakerAllow():  # The printer is not answering - no point connecting yet
+            time.sleep(min(mainLoopPoll, max(1, breakerWait())))
+            continue
+        try:
+            ws = openSubscription()
+            model = ws.update()  # The first message is the full model
+            breakerSuccess()
+            with modelLock:
+                subscribedModel = model
+                subscriptionLive = True
+            notifyModelChange(watchedModel.keys(), True)
+            logger.info('Object model subscription is live')
+            while subscriptionState == 1 and terminateState != 1:
+                patch = ws.update()
+                with modelLock:
+                    before = watchedValues(subscribedModel)
+                    mergePatch(subscribedModel, patch)
+                    after = watchedValues(subscribedModel)
+                changes = [name for name in after if after[name] != before[name]]
+                if len(changes) > 0:
+                    notifyModelChange(changes)
+        except (OSError, ConnectionError, ValueError) as e:
+            breakerFailure()
+            if subscriptionLive:
+                logger.info('Object model subscription lost - polling until it reconnects')
+            logger.debug('Subscription error: ' + str(e))
+        finally:
+            subscriptionLive = False
+            if ws is not None:
+                ws.close()
+        if subscriptionState == 1:
+            time.sleep(mainLoopPoll)  # Wait before trying again
+    subscriptionState = -1
+    logger.info('Object model subscription stopped')
+
+def Jobname():
+    # Used to get the print jobname from Duet
+    if simulate in ['all','printer']:
+        return 'simulated_job'
+    job = getModel('job')
+    if job == 'disconnected':
+        return 'disconnected'
+    try:
+        jobname = job['file']['fileName']
+        if jobname is None:
+            jobname = ''
+        return jobname
+    except Exception as e:
+        logger.debug('Could not get jobname')
+        logger.debug(str(e))
 
     return 'disconnected'
 
@@ -1785,50 +4107,31 @@ def Status():
         logger.info('Simulated status is Idle')
         return 'idle', ''
     
-    j = {}
     msgQueue = []
-    if apiModel == 'rr_model':
-        URL = ('http://' + duet + '/rr_model?key=state')
-        r = urlCall(URL,  False)
-        msgQueue = []    
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                status = j['result']['status']
-                logger.debug('Standalone Status is ' + status)  
-            except Exception as e:
-                logger.debug('Could not get Standalone Status')
-                logger.debug(str(e))
-                return 'disconnected', '' 
-        else:
-            return 'disconnected', ''      
-
-    elif apiModel == 'SBC':
-        URL = ('http://' + duet + '/machine/status')
-        # while True: #  The max queue depth is 8 so we clear as many messages as we can in one go
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                status = j['state']['status']
-                logger.debug('SBC Status is ' + status)     
-            except Exception as e:
-                logger.debug('Could not get SBC Status')
-                logger.debug(str(e))
-                return 'disconnected', '' 
-        else:
-            return 'disconnected', ''
+    state = getModel('state')
+    if state == 'disconnected':
+        return 'disconnected', ''
+    try:
+        status = state['status']
+        logger.debug(apiModel + ' Status is ' + status)
+    except Exception as e:
+        logger.debug('Could not get ' + apiModel + ' Status')
+        logger.debug(str(e))
+        return 'disconnected', ''
     
     #  Check for message commands
     try:
         queue = []
         dellist = []
         #  use .get method for safety
-        if j['global'].get('DL3msg') != None: # initialized
-            queue = j['global']['DL3msg']
+        variables = getModel('global')
+        if variables is None or variables == 'disconnected':
+            variables = {}
+        if variables.get('DL3msg') != None: # initialized
+            queue = variables['DL3msg']
             logger.debug(f'DL3Msg queue = {queue}')
-            if j['global'].get('DL3del') != None: # something to delete
-                dellist = j['global']['DL3del']
+            if variables.get('DL3del') != None: # something to delete
+                dellist = variables['DL3del']
                 logger.debug(f'DL3del queue = {dellist}')  
             if queue[0] > lastMessageSeq or len(dellist) > 0:
                 msgQueue = parseM3291(queue,dellist)
@@ -1848,69 +4151,53 @@ def Layer():
     # Used to get the the current layer
     if simulate in ['all','printer']:
         return -1
-    if apiModel == 'rr_model':
-        URL = ('http://' + duet + '/rr_model?key=job.layer')
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                layer = j['result']
-                if layer is None:
-                    layer = -1
-                logger.debug('Current Layer is ' + str(layer))
-                return layer
-            except Exception as e:
-                logger.debug('Could not get Layer Info')
-                logger.debug(str(e))
-
-    elif apiModel == 'SBC':
-        URL = ('http://' + duet + '/machine/status')
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                layer = j['job']['layer']
-                if layer is None:
-                    layer = -1
-                logger.debug('Current Layer is ' + str(layer))    
-                return layer
-            except Exception as e:
-                logger.debug('Could not get Layer Info')
-                logger.debug(str(e))
+    job = getModel('job')
+    if job == 'disconnected':
+        return 'disconnected'
+    try:
+        layer = job['layer']
+        if layer is None:
+            layer = -1
+        logger.debug('Current Layer is ' + str(layer))
+        return layer
+    except Exception as e:
+        logger.debug('Could not get Layer Info')
+        logger.debug(str(e))
 
     return 'disconnected'
 
 
+def layerChangeTime():
+    # When the current layer started (time.time()) or None if not known
+    # The subscription reports the change itself.  Otherwise job.layerTime is the time since the change
+    if subscriptionLive:
+        with modelLock:
+            changed = modelChangeTime.get('layer')
+        if changed is not None:
+            return changed
+    if simulate in ['all','printer']:
+        return None
+    job = getModel('job')
+    if not isinstance(job, dict) or not isinstance(job.get('layerTime'), (int, float)):
+        return None
+    return time.time() - job['layerTime']
+
+
 def Position():
     # Used to get the current head position from Duet
     if simulate in ['all', 'printer']:
         return 0,0,0
-    if apiModel == 'rr_model':
-        URL = ('http://' + duet + '/rr_model?key=move.axes')
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                Xpos = j['result'][0]['machinePosition']
-                Ypos = j['result'][1]['machinePosition']
-                Zpos = j['result'][2]['machinePosition']
-                return Xpos, Ypos, Zpos
-            except Exception as e:
-                logger.debug('Could not get Position Info')
-                logger.debug(str(e))
-    elif apiModel == 'SBC':
-        URL = ('http://' + duet + '/machine/status')
-        r = urlCall(URL,  False)
-        if r.ok:
-            try:
-                j = json.loads(r.text)
-                Xpos = j['move']['axes'][0]['machinePosition']
-                Ypos = j['move']['axes'][1]['machinePosition']
-                Zpos = j['move']['axes'][2]['machinePosition']
-                return Xpos, Ypos, Zpos
-            except Exception as e:
-                logger.debug('Could not get Position Info')
-                logger.debug(str(e))
+    move = getModel('move')
+    if move == 'disconnected':
+        return 'disconnected'
+    try:
+        Xpos = move['axes'][0]['machinePosition']
+        Ypos = move['axes'][1]['machinePosition']
+        Zpos = move['axes'][2]['machinePosition']
+        return Xpos, Ypos, Zpos
+    except Exception as e:
+        logger.debug('Could not get Position Info')
+        logger.debug(str(e))
 
     return 'disconnected'
 
@@ -1922,23 +4209,26 @@ def sendDuetGcode(model, command):
     if model == 'rr_model':
         URL = 'http://' + duet + '/rr_gcode?gcode=' + command
         r = urlCall(URL,  False)
+    elif socketTransport:
+        dsfCommand({'command': 'SimpleCode', 'code': command, 'channel': 'SBC'})
+        invalidateModel()
+        return
     else:
         URL = 'http://' + duet + '/machine/code'
         r = urlCall(URL,  command)
 
+    invalidateModel()  # The next read needs to see the effect of the gcode
     if r.ok:
         return
 
 def isPlugin(model):
     if model == 'SBC':
-        URL = ('http://' + duet + '/machine/status')
-        r = urlCall(URL,  False)
-        if r.ok:
+        plugins = getModel('plugins')
+        if plugins != 'disconnected':
             try:
-                j = json.loads(r.text)
-                if j['plugins'] != None:
-                    if j['plugins']['DuetLapse3'] != None: # DuetLapse3 is registered plugin
-                        if str(j['plugins']['DuetLapse3']['pid']) == pid: # Running as a plugin
+                if plugins != None:
+                    if plugins.get('DuetLapse3') != None: # DuetLapse3 is registered plugin
+                        if str(plugins['DuetLapse3']['pid']) == pid: # Running as a plugin
                             logger.info('Running as a plugin')
                             return True
                 logger.info('Not Running as a plugin')
@@ -1951,7 +4241,13 @@ def isPlugin(model):
             
 def stopPlugin(model, command):
     # Used to send a command to Duet
-    if model == 'SBC':
+    if model == 'SBC' and socketTransport:
+        ok, _ = dsfCommand({'command': 'StopPlugin', 'plugin': command})
+        if ok:
+            logger.info('Sent stopPlugin to plugin manager')
+        else:
+            logger.info('stopPlugin failed using DSF socket')
+    elif model == 'SBC':
         URL = 'http://' + duet + '/machine/stopPlugin'
         r = urlCall(URL,  command)
         if r.ok:
@@ -1963,68 +4259,46 @@ def stopPlugin(model, command):
     return
 
 def getVideoMsg():
+    frame = cameras[0].frame
     if maxvideo > 0:
-        if frame1 > maxvideo:
+        if frame > maxvideo:
             videolength = 'Video will be ' + str(maxvideo) + ' seconds long'
-        elif frame1 > minvideo:
-            videolength = 'Video will be ' + str(frame1) + ' seconds long'
+        elif frame > minvideo:
+            videolength = 'Video will be ' + str(frame) + ' seconds long'
         else:
             videolength = 'Not enough images for video to be created'
     else:
-        if frame1/fps > minvideo:
-            videolength = 'Video will be ' + str(frame1/fps) + ' seconds long'
+        if frame/fps > minvideo:
+            videolength = 'Video will be ' + str(frame/fps) + ' seconds long'
         else:
             videolength = 'Insufficient images for video to be created'
     return videolength        
 
 def makeVideo(directory, xtratime = False):  #  Adds and extra frame
-    global makeVideoState, frame1, frame2
+    global makeVideoState
     try:
         makeVideoState = 1
         # Get a final frame
-        # Make copies if appropriate
+        # Hold it if appropriate
 
+        hold = 0
         if xtratime and extratime >= 1: #  Do not add images if called from snapshot or video
-            logger.debug('For Camera1')
-            oneInterval('Camera1', camera1, weburl1, camparam1, True)  # For Camera 1
-            ## if extratime != 0 and frame1/fps > minvideo:
-            if frame1 > 0:
-                frame1 = copyLastFrame(camfile1, frame1)
-
-            if camera2 != '':   #  Camera 2
-                logger.debug('For Camera2')
-                oneInterval('Camera2', camera2, weburl2, camparam2, True)
-                ## if extratime != 0 and frame2/fps > minvideo:
-                if frame2 > 0:
-                    frame2 = copyLastFrame(camfile2, frame2)
-
-        result = createVideo(directory)
+            logger.debug('Final frame for all cameras')
+            captureInterval(True)
+            logger.info('Holding the last frame to extend video by ' +str(extratime) + ' seconds')
+            hold = extratime
+
+        result = createVideo(directory, xtratime and directory == workingDir, hold)
         makeVideoState = -1
         return result
     except Exception as e:
         logger.info('!!!!!#####!!!!! UNRECOVERABLE ERROR ENCOUNTERED IN MAKE VIDEO -- ' + str(e))
         quit_forcibly()        
 
-def copyLastFrame(f, frame):  # Makes copies and updates frame counter
-    logger.info('Copying last frame to extend video by ' +str(extratime) + ' seconds')
-    fr = str(frame).zfill(8)
-    sourcefile = f + fr + '.jpeg'
-    copies = int(extratime)*int(fps)
-    #  copies = extratime*fps
-    logger.debug('Using file --- ' + sourcefile + ' to make ' + str(copies) + ' copies')
-    for i in range(1, copies):
-        nf = str(frame + i).zfill(8)
-        targetfile = f + nf + '.jpeg'
-
-        try:
-            shutil.copy(sourcefile, targetfile)
-        except shutil.Error as e:
-            logger.info('Error on copy ' + str(e))
-    return int(nf) # Must be an integer for later math
-
 def restartAction():
         global workingDirStatus, pidIncrement, nextWorkingDir
         workingDirStatus = -1 # Force creation of a new workingDir
+        stopEncoders() # Any not used for a video
         setuplogfile() # Create a new log file
         startNow() # determine start state
         listOptions() # List the current values
@@ -2050,6 +4324,8 @@ def terminate():
     # This is more for log timing / sequencing 
     waitforNextAction()
 
+    flushFrames()
+    stopEncoders()
     cleanupFiles('terminate')
 
     if restart:
@@ -2078,9 +4354,14 @@ def terminate():
     else:
         stopmainLoop()
         waitformainLoop()
-        closeHttpListener()
+        stopSubscription()
+        stopStreamReaders()
+        stopCaptureWorkers()
+        stopFrameWriter()
+        if not fleetMember:  # The fleet owns the http listener
+            closeHttpListener()
         logger.info('Program Terminated')
-        if isPlugin(apiModel):
+        if isPlugin(apiModel) and not fleetMember:
             stopPlugin(apiModel, 'DuetLapse3')
         else:
             quit_forcibly()
@@ -2093,12 +4374,144 @@ def quit_sigterm(*args):
     logger.info('Terminating because of SIGTERM')
     quit_forcibly()  
 
+def stopPrinter():
+    # Stops this printer's threads without making a video - a fleet member that stops or a fleet that is killed
+    global fleetStopped, terminateState
+    fleetStopped = True
+    terminateState = 1  # Also ends any reconnect attempts
+    stopCaptureLoop()
+    stopmainLoop()
+    stopSubscription()
+    stopStreamReaders()
+    stopCaptureWorkers()
+    # Images that were captured but are still queued
+    if flushFrames(FrameWriter.drainTimeout):
+        stopFrameWriter()
+    else:
+        logger.info('!!!!! Not all images were written before termination !!!!!')
+    stopEncoders()
+
 def quit_forcibly():
-    global restart 
+    global restart
     restart = False
     logger.info('!!!!! Forced Termination !!!!!')
+    if fleetMember:  # Only this printer stops - the rest of the fleet keeps running
+        # sys.exit only ends the calling thread.  This printer's other threads see fleetStopped (or their own state) and end
+        stopPrinter()
+        sys.exit(0)  # Ends the calling thread only
+    for name, member in fleetMembers.items():  # The fleet is being killed - stop each printer first
+        if not member.fleetStopped:
+            logger.info('Stopping fleet member /' + name)
+            try:
+                member.stopPrinter()
+            except Exception as e:  # e.g. still starting - the kill ends it anyway
+                logger.info('!!!!! Fleet member /' + name + ' did not stop cleanly -- ' + str(e) + ' !!!!!')
+    # Images that were captured but are still queued would be lost by the kill
+    if not flushFrames(FrameWriter.drainTimeout):
+        logger.info('!!!!! Not all images were written before termination !!!!!')
     os.kill(os.getpid(), 9)  # Brutal but effective
 
+###########################
+# Metrics
+###########################
+
+# Upper bounds (seconds) for the latency histograms - from fast printer calls to long encodes
+metricBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+metricHelp = {'duetlapse3_printer_call_seconds': 'Time for calls to the printer by endpoint',
+              'duetlapse3_capture_seconds': 'Time to capture one image by camera and camera type',
+              'duetlapse3_encode_seconds': 'Time to create a video by camera including any wait for ffmpeg',
+              'duetlapse3_capture_loop_seconds': 'Time for one pass of the capture loop',
+              'duetlapse3_capture_skew_seconds': 'Time between the first and last image when cameras are captured together',
+              'duetlapse3_write_seconds': 'Time from capture until the image is on disk (background writer)',
+              'duetlapse3_encode_wait_seconds': 'Time a video encode waited for an encode slot by priority'}
+
+def observe(name, labels, seconds):
+    # Adds one observation to a latency histogram
+    key = tuple(sorted(labels.items()))
+    with metricsLock:
+        histogram = metrics.setdefault(name, {}).get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * len(metricBuckets), 'count': 0, 'sum': 0.0}
+            metrics[name][key] = histogram
+        bucket = bisect.bisect_left(metricBuckets, seconds)
+        if bucket < len(metricBuckets):  # Larger values are only in +Inf (count)
+            histogram['buckets'][bucket] += 1
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+
+def metricLabels(labels):
+    text = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        text.append(name + '="' + value + '"')
+    return '{' + ','.join(text) + '}'
+
+def metricsText():
+    # Prometheus text format
+    printer = (('duet', duet),)
+    lines = []
+    with metricsLock:
+        for name in sorted(metrics):
+            lines.append('# HELP ' + name + ' ' + metricHelp.get(name, name))
+            lines.append('# TYPE ' + name + ' histogram')
+            for key, histogram in sorted(metrics[name].items()):
+                labels = printer + key
+                cumulative = 0
+                for bound, count in zip(metricBuckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append(name + '_bucket' + metricLabels(labels + (('le', str(bound)),)) + ' ' + str(cumulative))
+                lines.append(name + '_bucket' + metricLabels(labels + (('le', '+Inf'),)) + ' ' + str(histogram['count']))
+                lines.append(name + '_sum' + metricLabels(labels) + ' ' + repr(histogram['sum']))
+                lines.append(name + '_count' + metricLabels(labels) + ' ' + str(histogram['count']))
+
+    lines.append('# HELP duetlapse3_printer_call_errors_total Failed calls to the printer by endpoint')
+    lines.append('# TYPE duetlapse3_printer_call_errors_total counter')
+    for endpoint, stats in sorted(getUrlStats().items()):
+        lines.append('duetlapse3_printer_call_errors_total' + metricLabels(printer + (('endpoint', endpoint),)) + ' ' + str(stats['errors']))
+
+    lines.append('# HELP duetlapse3_images_captured Images captured for the current job')
+    lines.append('# TYPE duetlapse3_images_captured gauge')
+    for camera in cameras:
+        lines.append('duetlapse3_images_captured' + metricLabels(printer + (('camera', camera.name),)) + ' ' + str(camera.frame))
+
+    lines.append('# HELP duetlapse3_images_rejected_total Images rejected by -validate for the current job')
+    lines.append('# TYPE duetlapse3_images_rejected_total counter')
+    for camera in cameras:
+        for reason, count in camera.rejected.items():
+            lines.append('duetlapse3_images_rejected_total' + metricLabels(printer + (('camera', camera.name), ('reason', reason))) + ' ' + str(count))
+
+    if frameWriter is not None:
+        lines.append('# HELP duetlapse3_write_queue_depth Images waiting for the background writer')
+        lines.append('# TYPE duetlapse3_write_queue_depth gauge')
+        lines.append('duetlapse3_write_queue_depth' + metricLabels(printer) + ' ' + str(frameWriter.queue.qsize()))
+        lines.append('# HELP duetlapse3_write_dropped_total Images dropped because the write queue was full')
+        lines.append('# TYPE duetlapse3_write_dropped_total counter')
+        lines.append('duetlapse3_write_dropped_total' + metricLabels(printer) + ' ' + str(frameWriter.dropped))
+        lines.append('# HELP duetlapse3_write_errors_total Images that could not be written')
+        lines.append('# TYPE duetlapse3_write_errors_total counter')
+        lines.append('duetlapse3_write_errors_total' + metricLabels(printer) + ' ' + str(frameWriter.errors))
+
+    lines.append('# HELP duetlapse3_encode_running Video encodes running in this process')
+    lines.append('# TYPE duetlapse3_encode_running gauge')
+    lines.append('duetlapse3_encode_running' + metricLabels(printer) + ' ' + str(encodeScheduler.running))
+    lines.append('# HELP duetlapse3_encode_waiting Video encodes in this process waiting for an encode slot')
+    lines.append('# TYPE duetlapse3_encode_waiting gauge')
+    lines.append('duetlapse3_encode_waiting' + metricLabels(printer) + ' ' + str(len(encodeScheduler.waiting)))
+
+    lines.append('# HELP duetlapse3_model_cache_total Object model reads by result')
+    lines.append('# TYPE duetlapse3_model_cache_total counter')
+    lines.append('duetlapse3_model_cache_total' + metricLabels(printer + (('result', 'hit'),)) + ' ' + str(modelCacheHits))
+    lines.append('duetlapse3_model_cache_total' + metricLabels(printer + (('result', 'miss'),)) + ' ' + str(modelCacheMisses))
+
+    lines.append('# HELP duetlapse3_connected 1 if the printer is connected')
+    lines.append('# TYPE duetlapse3_connected gauge')
+    lines.append('duetlapse3_connected' + metricLabels(printer) + ' ' + ('1' if connectionState else '0'))
+    lines.append('# HELP duetlapse3_printer_circuit State of the printer circuit breaker')
+    lines.append('# TYPE duetlapse3_printer_circuit gauge')
+    for state in ['closed', 'open', 'half-open']:
+        lines.append('duetlapse3_printer_circuit' + metricLabels(printer + (('state', state),)) + ' ' + ('1' if breakerState == state else '0'))
+    return '\n'.join(lines) + '\n'
+
 ###########################
 # Integral Web Server
 ###########################
@@ -2294,10 +4707,10 @@ class MyHandler(SimpleHTTPRequestHandler):
     def display_status(self):
         global lastImage
         localtime = time.strftime('%A - %H:%M', time.localtime())
-        if zo1 < 0:
+        if cameras[0].zo < 0:
             thislayer = 'None'
         else:
-            thislayer = str(zo1)
+            thislayer = str(cameras[0].zo)
 
         txt = []
         #  Set style for 2 flex columns
@@ -2318,8 +4731,17 @@ class MyHandler(SimpleHTTPRequestHandler):
                     Capture Status:= ' + str(printState) + '<br>\
                     DuetLapse3 State:= ' + str(action) + '<br>\
                     Duet Status:= ' + str(duetStatus) + '<br>\
-                    Images Captured:= ' + str(frame1) + '<br>\
+                    Images Captured:= ' + ', '.join(str(camera.frame) for camera in cameras) + '<br>\
                     Current Layer:= ' + str(thislayer) + '<br>\
+                    Object Model:= ' + modelSource() + '<br>\
+                    Model Cache:= ' + str(modelCacheHits) + ' hits / ' + str(modelCacheMisses) + ' misses<br>\
+                    Printer Circuit:= ' + breakerStatus() + '<br>\
+                    Camera Skew:= ' + skewStatus() + '<br>\
+                    Rejected Images:= ' + rejectStatus() + '<br>\
+                    Camera Health:= ' + cameraHealth() + '<br>\
+                    Video Encode:= ' + encodeStatus() + '<br>\
+                    Encode Slots:= ' + encodeScheduler.status() + '<br>\
+                    ' + streamStatus() + '\
                     </div>\
                     <div class="column">'
         if lastImage != '':
@@ -2355,8 +4777,18 @@ class MyHandler(SimpleHTTPRequestHandler):
             info += '<td align="left"><b>' + label + ' </b><br>' + str(value) + '</td>'
             count += 1
         
-        info += '</tr></table>\
-                <br><hr /><b>Logs and Videos are located here:</b>&nbsp; &nbsp;' + topDir+ '\
+        info += '</tr></table>'
+
+        info += '<br><hr /><b>Printer calls:</b><br>\
+                <table style="width:auto">\
+                <tr><td><b>Endpoint</b></td><td><b>Calls</b></td><td><b>Errors</b></td><td><b>Average (ms)</b></td><td><b>Max (ms)</b></td><td><b>Last (ms)</b></td></tr>'
+        for endpoint, stats in getUrlStats().items():
+            average = stats['total'] / max(1, stats['calls'])
+            info += '<tr><td>' + html.escape(endpoint) + '</td><td>' + str(stats['calls']) + '</td><td>' + str(stats['errors']) + '</td>\
+                    <td>' + str(int(average * 1000)) + '</td><td>' + str(int(stats['max'] * 1000)) + '</td><td>' + str(int(stats['last'] * 1000)) + '</td></tr>'
+        info += '</table>'
+
+        info += '<br><hr /><b>Logs and Videos are located here:</b>&nbsp; &nbsp;' + topDir+ '\
                 <br><hr /><b>Images are located here:</b>&nbsp; &nbsp;' + imagelocation + '\
                 <br><hr /><b>The current logfile is:</b>&nbsp; &nbsp;' +logfilename + '\
                 </div>'
@@ -2554,6 +4986,12 @@ class MyHandler(SimpleHTTPRequestHandler):
                 referer = self.headers['authority']
                 if not referer:
                     referer = 'localhost'  # Best guess if all else fails
+            if fleetPrefix != '':  # Fleet member - pages live under /<printer>
+                referer += fleetPrefix
+                if self.path.startswith(fleetPrefix):
+                    self.path = self.path[len(fleetPrefix):]
+                    if not self.path.startswith('/'):
+                        self.path = '/' + self.path
 
             global action, selectMessage, refreshing
 
@@ -2578,7 +5016,7 @@ class MyHandler(SimpleHTTPRequestHandler):
                 else:
                     api_args = value
 
-                if not api in ['displayStatus', 'displayControls', 'displayVideo', 'displayFiles', 'displayInfo', 'displayTerminate', 'snapshot', 'command', 'delete', 'zip', 'video', 'terminate', 'fps', 'minvideo', 'maxvideo', 'getfile']:
+                if not api in ['displayStatus', 'displayControls', 'displayVideo', 'displayFiles', 'displayInfo', 'displayTerminate', 'snapshot', 'command', 'delete', 'zip', 'video', 'terminate', 'fps', 'minvideo', 'maxvideo', 'getfile', 'metrics']:
                     msg = 'The API call "' + api + '" with value "' + api_args + '" is not supported\
                            <br><br>' + str(query_components) + '<br>'
                     self._set_headers()
@@ -2634,6 +5072,9 @@ class MyHandler(SimpleHTTPRequestHandler):
                 elif api == 'getfile':
                     self.get_file(api_args)
                     queriesProcessed -= 1 #  get_file closes the connection
+                elif api == 'metrics':
+                    self.send_metrics()
+                    queriesProcessed -= 1 #  send_metrics sends its own response
                 if queriesProcessed == numQueries:
                     # Send a 204
                     self._set_headers204()
@@ -2684,6 +5125,15 @@ class MyHandler(SimpleHTTPRequestHandler):
             self.terminate_process('terminatehttp')
         return
 
+    def send_metrics(self):
+        body = metricsText().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def log_request(self, code=None, size=None):
         pass
 
@@ -3120,13 +5570,26 @@ def waitforNextAction():
     if nextActionState == -1:
         logger.info('nextAction is available')
         return
-    while nextActionState != -1:  # Only one thread at a time may cause delay in http page update
+    while nextActionState != -1 and not fleetStopped:  # Only one thread at a time may cause delay in http page update
         logger.debug('********* nextActionState is ' + str(nextActionState) + ' - Waiting to complete *********')
         time.sleep(1)
 
     logger.debug('nextaction is ready')
     
 
+def startSubscription():
+    if subscriptionState == 1 or terminateState == 1:  #  Already running or don't start
+        return
+    if apiModel != 'SBC':
+        logger.info('-subscribe ignored - only valid for SBC')
+        return
+    threading.Thread(name='subscribeLoop', target=subscribeLoop, args=(), daemon=False).start()
+
+def stopSubscription():
+    global subscriptionState
+    if subscriptionState == 1:
+        subscriptionState = 0  # Signals subscribeLoop to stop
+
 def startcheckforConnection():
     if checkforconnectionState == 1 or terminateState == 1:  #  Already running or don't start
         return
@@ -3140,7 +5603,7 @@ def terminateThread(): # Can only be run once - but called as a thread to allow
 
 def waitforMakeVideo():
     global makeVideoState
-    while makeVideoState >= 0: # wait till its completed
+    while makeVideoState >= 0 and not fleetStopped: # wait till its completed
         time.sleep(mainLoopPoll)  # Makevideo is fairly slow
         logger.debug('********* Waiting for makeVideo thread to finish *********')
     logger.debug('makeVideo is not running')
@@ -3151,7 +5614,7 @@ def startMakeVideo(directory, xtratime = False, thread = True): # Does not run i
         return 'Cannot create video when Terminating'
     waitforMakeVideo()
     if thread:      
-        threading.Thread(name='makeVideo', target=makeVideo, args=(directory,), daemon=False).start()
+        threading.Thread(name='makeVideo', target=makeVideo, args=(directory, xtratime), daemon=False).start()
         return
     else:
         return makeVideo(directory, xtratime)
@@ -3173,13 +5636,14 @@ def mainLoop():
         logger.info('###########################')
         logger.info('Starting mainLoop')
         logger.info('###########################\n')
+        changes = set()  # Object model events from the subscription (if used)
         while mainLoopState == 1 and terminateState != 1 and connectionState:  # Setting to 0 stops
-            if time.time() >= lastStatusCall + mainLoopPoll:  # within 30 seconds   
+            if time.time() >= lastStatusCall + mainLoopPoll or len(changes) > 0:  # within 30 seconds   
                 duetStatus, _ = getDuet('mainLoop', Status)
-            if time.time() >= lastCaptureLoop + poll:
+            if time.time() >= lastCaptureLoop + poll or 'layer' in changes or 'status' in changes:
                 captureLoop()
             if mainLoopState == 1:
-                time.sleep(mainLoopIterate)
+                changes = waitforModelChange(mainLoopIterate)
         mainLoopState = -1 # Not Running
         return
     except Exception as e:
@@ -3237,6 +5701,7 @@ def captureLoop():  # Single instance only
         lastCaptureLoop = time.time()
         return
 
+    loopStart = time.time()
     try:
         captureLoopState = 1
 
@@ -3246,11 +5711,9 @@ def captureLoop():  # Single instance only
         printState = stateMachine(printState)
 
         if printState == 'Capturing':
-            logger.debug('Calling oneInterval for Camera 1')
-            oneInterval('Camera1', camera1, weburl1, camparam1)
-            if camera2 != '':
-                logger.debug('Calling oneInterval for Camera 2')
-                oneInterval('Camera2', camera2, weburl2, camparam2)
+            logger.debug('Calling captureInterval')
+            captureInterval()
+            if len(cameras) > 1:  # Captures take longer - refresh the status
                 duetStatus, _ = getDuet('pause check loop', Status)
             if duetStatus == 'paused' and (pause == 'yes' or detect == pause): # will be ignored if a manual pause
                 unPause()  # Nothing should be paused at this point
@@ -3270,6 +5733,7 @@ def captureLoop():  # Single instance only
     lastPrintState = printState
     lastDuetStatus = duetStatus
     lastCaptureLoop = time.time()
+    observe('duetlapse3_capture_loop_seconds', {'state': printState}, lastCaptureLoop - loopStart)
     captureLoopState = -1  # not running           
 
 def nextAction(nextaction):  # can be run as a thread
@@ -3578,6 +6042,11 @@ def startup():
         duet = "127.0.0.1"
         logger.info("Switching to 127.0.0.1")
 
+    if subscribe:
+        startSubscription()
+
+    startStreamReaders()
+
     logger.info('Initializing DL3msg queue')
     sendDuetGcode(apiModel,M3291 + ' B"Clear"') # Clear the message queue
      
@@ -3586,19 +6055,181 @@ def startup():
     logger.info('Initiating with action set to ' + action)
     nextAction(action)
 
-def main():
+###########################
+# Fleet - many printers in one process
+###########################
+
+# Set by the fleet on each member before its main() is called
+fleetMember = False  # This copy of the module is one printer in a fleet
+fleetPrefix = ''  # Path for this printer on the fleet http listener e.g. /192-168-1-10
+fleetStopped = False  # This printer has stopped - its threads end and the fleet no longer waits for it
+fleetSuffix = ''  # Keeps the directories apart when the same printer is in the fleet more than once
+encodeScheduler = None  # The fleet gives all members the same one
+fleetCapture = None  # Shared by all members - limits concurrent image captures
+fleetMembers = {}  # Set by startFleet - the module copy for each printer by name
+
+def readFleet(filename):
+    # One printer per line using the same options as the command line
+    printers = []
+    try:
+        with open(filename, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                printers.append(shlex.split(line))
+    except OSError as e:
+        logger.info('!!!!! Could not read fleet file ' + filename + ' -- ' + str(e) + ' !!!!!')
+        sys.exit(2)
+    return printers
+
+def fleetName(argv):
+    # Also checks the options before anything is started
+    if '-file' in argv[:-1]:  # Options from the file take the place of -file as with LoadFromFilex
+        i = argv.index('-file')
+        try:
+            with open(argv[i + 1], 'r') as f:
+                argv = argv[:i] + shlex.split(f.read()) + argv[i + 2:]
+        except OSError as e:
+            logger.info('!!!!! Could not read options file ' + argv[i + 1] + ' -- ' + str(e) + ' !!!!!')
+            sys.exit(2)
+    parser = whitelist(argparse.ArgumentParser(allow_abbrev=False))
+    args = vars(parser.parse_args(argv))
+    return args['duet'][0].replace('.', '-').replace(':', '-')
+
+def loadFleetMember(name, argv, suffix = ''):
+    # Each printer gets its own copy of this module so that its globals are separate
+    spec = importlib.util.spec_from_file_location('DuetLapse3_' + name, os.path.realpath(__file__))
+    member = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(member)
+    member.fleetMember = True
+    member.fleetPrefix = '/' + name
+    member.fleetSuffix = suffix
+    member.encodeScheduler = encodeScheduler
+    member.fleetCapture = fleetCapture
+    member.fleetArgv = argv
+    return member
+
+def runFleetMember(member):
+    try:
+        member.main(member.fleetArgv)
+    except SystemExit as e:  # e.g. printer not found
+        member.fleetStopped = True
+        logger.info('!!!!! Fleet member ' + member.fleetPrefix + ' stopped -- ' + returncode(e.code) + ' !!!!!')
+    except Exception as e:  # Stop anything this printer had started
+        logger.info('!!!!! Fleet member ' + member.fleetPrefix + ' stopped -- ' + str(e) + ' !!!!!')
+        try:
+            member.quit_forcibly()
+        except SystemExit:
+            pass
+
+class FleetServer(ThreadingHTTPServer):
+    def finish_request(self, request, client_address):
+        # Peek at the request line to find the printer - its own handler then reads the request as usual
+        try:
+            request.settimeout(10)
+            requestline = request.recv(2048, socket.MSG_PEEK).split(b'\r\n', 1)[0].decode('latin-1')
+            request.settimeout(None)
+        except OSError:
+            return
+        parts = requestline.split(' ')
+        path = parts[1] if len(parts) > 1 else '/'
+        name = urlparse(path).path.strip('/').split('/')[0]
+        member = fleetMembers.get(name)
+        if member is None or member.fleetStopped:
+            FleetHandler(request, client_address, self)
+        else:
+            member.MyHandler(request, client_address, self)
+
+class FleetHandler(SimpleHTTPRequestHandler):
+    # Index of the printers in the fleet
+    def do_GET(self):
+        if 'favicon.ico' in self.path:
+            return
+        host = self.headers['Host']
+        if not host:
+            host = 'localhost'
+        rows = ''
+        for name, member in fleetMembers.items():
+            if member.fleetStopped:
+                state = 'Stopped'
+            else:
+                state = str(getattr(member, 'printState', 'Starting')) + ' -- ' + str(getattr(member, 'duetStatus', ''))
+            rows += '<tr><td><a href="http://' + host + '/' + name + '">' + html.escape(name) + '</a></td>\
+                    <td>' + html.escape(state) + '</td></tr>'
+        page = '<!DOCTYPE html>\
+                <html>\
+                <head><meta charset="utf-8"><title>DuetLapse3 Fleet</title></head>\
+                <body>\
+                <h3>DuetLapse3 Fleet -- Version ' + duetLapse3Version + '</h3>\
+                <table><tr><th>Printer</th><th>State</th></tr>' + rows + '</table>\
+                </body>\
+                </html>'
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.end_headers()
+        self.wfile.write(page.encode('utf-8'))
+
+    def log_message(self, format, *args):
+        return
+
+def startFleet():
+    global fleetMembers, fleetCapture, listener
+    if port == 0:
+        logger.info('!!!!! -fleet needs -port for the shared http listener !!!!!')
+        sys.exit(2)
+    checkforvalidport() # Exits if invalid
+
+    fleetCapture = threading.BoundedSemaphore(fleetworkers)
+    fleetMembers = {}
+    shared = ['-basedir', basedir]  # Members can override these on their own line
+    if verbose:
+        shared.append('-verbose')
+    if nolog:
+        shared.append('-nolog')
+    for argv in readFleet(fleet):
+        argv = shared + argv
+        name = fleetName(argv)
+        suffix = ''
+        if name in fleetMembers:  # Same printer twice e.g. -simulate
+            suffix = '_' + str(len(fleetMembers))
+            name = name + suffix
+        fleetMembers[name] = loadFleetMember(name, argv, suffix)
+        logger.info('Fleet member /' + name + ' -- ' + ' '.join(argv))
+    if len(fleetMembers) == 0:
+        logger.info('!!!!! No printers in fleet file ' + fleet + ' !!!!!')
+        sys.exit(2)
+
+    listener = FleetServer((host, port), FleetHandler)
+    threading.Thread(name='httpServer', target=listener.serve_forever, daemon=False).start()
+    logger.info('##########################################################')
+    logger.info('***** Started fleet http listener on port ' + str(port) + ' *****')
+    logger.info('##########################################################\n')
+
+    for name, member in fleetMembers.items():
+        threading.Thread(name=name, target=runFleetMember, args=(member,), daemon=False).start()
+
+    # Stay until every printer has stopped
+    while not all(member.fleetStopped for member in fleetMembers.values()):
+        time.sleep(mainLoopPoll)
+    logger.info('All printers in the fleet have stopped')
+    closeHttpListener()
+    quit_forcibly()
+
+def main(argv = None):
     # Allow process running in background or foreground to be forcibly
     # shutdown with SIGINT (kill -2 <pid> or SIGTERM)
-    signal.signal(signal.SIGINT, quit_sigint) # Ctrl + C
-    signal.signal(signal.SIGTERM, quit_sigterm)
+    if not fleetMember:  # Fleet members run in a thread - the fleet handles signals
+        signal.signal(signal.SIGINT, quit_sigint) # Ctrl + C
+        signal.signal(signal.SIGTERM, quit_sigterm)
     # Globals
     # Set in startup code
     global httpListener, win, pid, action, apiModel, workingDir, workingDirStatus
     global connectionState, restarting
 
     # Status flag for threads
-    global nextActionState, makeVideoState, captureLoopState, mainLoopState, terminateState, checkforconnectionState
-    nextActionState = captureLoopState = makeVideoState = mainLoopState = terminateState = checkforconnectionState =  -1  #  All set as not running
+    global nextActionState, makeVideoState, captureLoopState, mainLoopState, terminateState, checkforconnectionState, subscriptionState
+    nextActionState = captureLoopState = makeVideoState = mainLoopState = terminateState = checkforconnectionState = subscriptionState = -1  #  All set as not running
     connectionState = restarting = False
     workingDirStatus = -1
 
@@ -3623,6 +6254,86 @@ def main():
     global urlHeaders
     urlHeaders = {}
 
+    # Pooled connection to the printer and per endpoint latency stats
+    global urlSession, urlSessionLock, urlStats
+    urlSession = None
+    urlSessionLock = threading.Lock()
+    global snapshotSession
+    snapshotSession = None
+
+    # Cameras captured together
+    global workingDirLock, captureSkew, frameTimesLock
+    workingDirLock = threading.Lock()
+    frameTimesLock = threading.Lock()  # frametimes.csv
+    captureSkew = None
+    # Resting cameras that keep failing
+    global cooldownFailures, cooldownBase, cooldownMax
+    cooldownFailures = 3  # in a row before a camera is rested
+    cooldownBase = 30  # seconds - doubles with each further failure
+    cooldownMax = 600
+    urlStats = {}
+
+    # Stream camera readers by camera name
+    global streamReaders
+    streamReaders = {}
+    # -encode live encoders by camera name
+    global liveEncoders
+    liveEncoders = {}
+    # -encode segments encoders by camera name
+    global segmentEncoders
+    segmentEncoders = {}
+
+    # Latency histograms for ?metrics
+    global metricsLock, metrics
+    metricsLock = threading.Lock()
+    metrics = {}  # name : {labels : histogram}
+
+    # Circuit breaker for calls to the printer
+    global breakerLock, breakerState, breakerFailures, breakerOpens, breakerRetryTime
+    global breakerThreshold, breakerBaseDelay, breakerMaxDelay
+    breakerLock = threading.Lock()
+    breakerState = 'closed'
+    breakerFailures = 0  # consecutive
+    breakerOpens = 0  # consecutive - sets the backoff
+    breakerRetryTime = 0
+    breakerThreshold = 3  # failures before opening
+    breakerBaseDelay = 1  # seconds
+    breakerMaxDelay = 60  # seconds
+
+    # Object model snapshot shared by Status, Layer, Position and Jobname
+    global modelLock, modelCache, modelTTL, modelCacheHits, modelCacheMisses
+    modelLock = threading.RLock()
+    modelCache = {}
+    modelTTL = 0.4  # seconds - less than the shortest wait in checkForPause / unPause
+    modelCacheHits = modelCacheMisses = 0
+
+    # Standalone object model built from rr_model frequent polls and seqs
+    global standaloneModel, standaloneSeqs, standaloneFetched, standaloneFrequentTime
+    standaloneModel = {}
+    standaloneSeqs = {}
+    standaloneFetched = {}  # key : (seq, time fetched)
+    standaloneFrequentTime = 0
+
+    # DSF socket (-transport socket)
+    global dsfConnection, dsfLock, dsfTimeout, socketTransport
+    dsfConnection = None
+    dsfLock = threading.Lock()
+    dsfTimeout = 5  # seconds
+    socketTransport = False
+
+    # Object model subscription (-subscribe)
+    global subscriptionLive, subscribedModel, subscribedKeys, subscriptionTimeout, modelChangeTime
+    global modelCondition, modelSequence, modelHistory, modelSeen
+    subscriptionLive = False
+    subscribedModel = {}
+    subscribedKeys = None
+    subscriptionTimeout = 30  # seconds without an update or a reply to PING before reconnecting
+    modelCondition = threading.Condition(modelLock)
+    modelSequence = 0  # Counts the changes
+    modelHistory = collections.deque(maxlen=64)  # (sequence, changes) - recent changes for waitforModelChange
+    modelSeen = threading.local()  # The last sequence each thread has seen
+    modelChangeTime = {}
+
     # Keep track of M3291 messages
     global lastMessageSeq
     lastMessageSeq = 0
@@ -3637,14 +6348,28 @@ def main():
 
     apiModel = ''
 
-    init()
+    init(argv)
+
+    # Set from the options
+    global captureWait, frameWriter
+    captureWait = capturetimeout + 10  # seconds to wait for all cameras in a capture - allows for the kill and validation
+    frameWriter = FrameWriter(writequeue, writepolicy) if writequeue > 0 else None  # Background image writer
+    global encodeScheduler
+    if encodeScheduler is None:  # Fleet members are given the fleet's
+        encodeScheduler = EncodeScheduler(maxffmpeg)
+
+    if fleet != '':  # This process only hosts the printers
+        listOptions()
+        startFleet()
+        return
     # Simulated Image
     global simulatedImage
     simulatedImage = base64.b64decode('/9j/4AAQSkZJRgABAQEAYABgAAD/4QAiRXhpZgAATU0AKgAAAAgAAQESAAMAAAABAAEAAAAAAAD/2wBDAAIBAQIBAQICAgICAgICAwUDAwMDAwYEBAMFBwYHBwcGBwcICQsJCAgKCAcHCg0KCgsMDAwMBwkODw0MDgsMDAz/2wBDAQICAgMDAwYDAwYMCAcIDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAwMDAz/wAARCABkAGIDASIAAhEBAxEB/8QAHwAAAQUBAQEBAQEAAAAAAAAAAAECAwQFBgcICQoL/8QAtRAAAgEDAwIEAwUFBAQAAAF9AQIDAAQRBRIhMUEGE1FhByJxFDKBkaEII0KxwRVS0fAkM2JyggkKFhcYGRolJicoKSo0NTY3ODk6Q0RFRkdISUpTVFVWV1hZWmNkZWZnaGlqc3R1dnd4eXqDhIWGh4iJipKTlJWWl5iZmqKjpKWmp6ipqrKztLW2t7i5usLDxMXGx8jJytLT1NXW19jZ2uHi4+Tl5ufo6erx8vP09fb3+Pn6/8QAHwEAAwEBAQEBAQEBAQAAAAAAAAECAwQFBgcICQoL/8QAtREAAgECBAQDBAcFBAQAAQJ3AAECAxEEBSExBhJBUQdhcRMiMoEIFEKRobHBCSMzUvAVYnLRChYkNOEl8RcYGRomJygpKjU2Nzg5OkNERUZHSElKU1RVVldYWVpjZGVmZ2hpanN0dXZ3eHl6goOEhYaHiImKkpOUlZaXmJmaoqOkpaanqKmqsrO0tba3uLm6wsPExcbHyMnK0tPU1dbX2Nna4uPk5ebn6Onq8vP09fb3+Pn6/9oADAMBAAIRAxEAPwD9/KCcUV8R/wDBWL4jL8G9d0X4gap401D/AIQv4b+HNR1jxJ4L0H4iTeEfEU6NPamDWLOOKSNdTaBYLqFbC7dLedrjALSKsUgB9uA5or4a0f8AaV+KWp/EhvBfw+vPA+k6l4k8b+ObeXUfFUer+IYbKLSpbcxeXAdQjYB/M2GGKWKGINujRQnlS8/4F/4KjfEZvAOj+IfEVv8ADmG18YaN8LfGWnC1s7q3j0LS/FfiJNLvLS5kkumFxNbQHfHdqsEbOxLW4VMOAfoLRX5+6v8At5/218Y7Px1q2u6Dp/hP4b3PxOtnvNPa5n06Ww0eGzZbi4SFpWneMLIX8pS2QwRA3y1xmpft/wDxy+KPwqvLdfFHgLwF4k8I/GDwr4butam8MD7HeabqcdpJGlzZQa7dLBue5QMGv/MkjdUMds7hgAfprnNGc1+euqf8FV/izofxH+KOsL8NtL1r4e/D248Xad/ZcVzp1nrDzaDZ3sySrL/a0t5M15JYpstRo0RSHUoZvOlji3TyfB/42eNfFfxQ/aiute+Jvw98a6xofwS8K31tqPw6+0Wel6bNN/wllyrIj3l00c5QwSCUSqZIvssm1AVAAP0Gzmivzv8ABf7bvxstfh/o8mj6h8ObjQ/D5+HnheeXXtO1DUNY1W68R2+mW4vJLhLyNB9mub9J2Uo7XSB499u2J2yf2iP+Cu/xC+A/7P8Aca1/xQeqeNvAz+NbrxNYQ6C8Nlrth4e1j+zvPtpLnV4Bp4mZoFKB9RuEkuQIra5EZ3gH6TUZr8+fi9/wVE+Jfg/9q34raH4b0jw74j8L/BuLV9Q1nw3D4U1N9XvrCw8OpqKXEOtfaVsfNuL+aOzW1S2mnjBLlWAcx+zf8E5P2n/id+0Tb+Jl+I2keF4YrG20zUtH1XRZNNhj1CK8W4LRfZrPWtXwkYgjkS6eeITrc4WFfIZnAPqCiiigArA8W/Czw3491jR9R1vw/oesah4duPtWlXV9YRXM+mTZU+ZA7qTE+VU7kIPyj0Fb9FAGTb+A9Gs75bqHSdLiulkmmEyWkayK82POYNjO6TC7z1bAzmqc/wAJfC9zok+mSeHNAk0260tdEmtW06Ewy2ChlW0ZNu0wAO4ERGwBm45NdFRQBg6L8MPDvhqK1TTdB0PT1sVdLZbawiiW3V1VXCBVG0MqIpx1CqDwBjJtP2c/AOn+Abvwnb+CPB0HhbUFCXWjR6JbLp9yA24B4AnlthvmGVPPNdoeleD/APBQT/goJ4C/4JzfAS88ceOLtpJJM2+jaNbOv27X7vblYIVPYdXkPyxrknsD1YHA4jGYiGEwsHOpNpRildtvoialSMIucnZI9Ytfhh4cs/H03iqHQdDh8UXdqLKfWEsIl1Ca3BBELThfMaMFV+UnHyjjgVD4V+DXhPwJpE+n6H4Z8O6LYXUJt5raw0yG2hmiMkshRkRQGUvPO20jG6aQ9XYn+fv9kv8A4OYPix4I/bU1bxj8VJpvEHwx8Z3CRX3hqyGY/CsCkiKXTgeS0an94rHNwMkkOEK/0DfCj4r+G/jn8OdG8X+EdZsPEHhnxBareadqNnJvhuYm6EHqCOQVOGVgVIBBFfYcb+HWdcK1KcM0grVEmpRd43tdxv8AzR6991dHFgcyoYtN0nt0/X5lmD4b6Db27QpoujrE0ttMUFlEFL2xQ27Y2/eiMcZQ9U2LtxtFZ3iH4EeCvF0cC6t4Q8K6otrPc3UIu9Jt5xFNchhcSLuQ4eUOwkYcvuO4nJrrKK+FO88D0P8A4JvfDnQP2lF+KES61LrUOvXXiq2sprlHs7TV7mzksprxW2faGLW80qCF5mgTzMpEpRCnr/gT4YeG/hdY3Vr4a8P6H4etr65a9uYtMsIrOO4nbAaZ1jUBpGwMsck4HNbtFABRRRQAUUUUAFDHaKRm2rmvG/27f23PBn/BPz9m/WviR42mf7BYFbaxsIWUXWtXsgPk2kAJ+aR9rEnoiJI7YVGI6MHg6+LrwwuGg5zm0oxWrbbskiZzUIuUtEih+39+394C/wCCdPwDvPHPjq6ZtxNtpGkW7D7drt3tytvAp/NnPyxrlj2B/l1/bs/bt8ef8FBvjzf+PvH1+rTMDBpmlwOfsOgWmcrbW6nt0LOfmkb5j2A+1P2fv2T/AI2f8HKf7TmufFTx74kt/CHw28P3Z0nzoCLhdIQKso0zTrckZk2SRtJPLgEuGIcgRj9Drz9mf/gnz/wR30a1g8aWnw/h8SeSsgl8VJ/wkniK8GeJVttkjxhj/FDDHHkdsV/UnB9bI/Dyt9XnRljs3kvehSV1SvZ8ilZ+9b4nFSfTRb/J4yNfMY8ykoUV1fXz/wAj+bRdQt5H2rPCzegkFfc//BGr/gsr4i/4JnfEb+xNd+3eIPg34hug+saTG3mTaRK3Bv7NScBx1kiGBKo7OqtX6or/AMF1/wBgTx+RoWqrpv8AZcn7s/2p8O55LHH+0v2diB9Vqp8Y/wDgiX+x7/wU8+F914t+COqeHfCOqTk+TrvgS4jm0xJsA+XdaeGES+rIoglyeW7H7DiHxWwWY4SWWca5NWw+Hq6c7Tai+kk3GLTW6cbvpZnHh8pqUp+0wNaMpLp/TP0Y+FnxU8PfG34eaP4t8JaxY+IPDfiC1S807ULOTzIbqJhkMD27gqcFSCCAQRXRV/O/+yF+118Wv+Dc39sW8+DfxggOsfC3WpE1G5t9PnN1FFbzO8aazpoOGAJicSwMqs/lsNu9VZv6CvBfjXSviH4R0vXtD1C01bRdbtIr/T761lEsF7byoHiljYcMjKQwI6g1/LnHPBFbh+vCpSmq2FrLmo1V8M4+faS+0j6zA45YiLTVpR0a7P8AyNaiiivhjuCiiigAooooAbIcIa/mp/4OR/25Lr9qb9vrUvA+n3xk8F/Btn0G0hjb93PqZCnULgj++sgFtg52/ZWK43tn+ldm2jngdea/iw8Y+PL34q+MNY8Vak7Sal4ov7jWbxycs81zK00hJ9Szmv6Y+jFw/Qxed4jNKyu8PBKPlKo2ub1UYyXzPl+KsRKGHjTj9p6+iPTP2Pv27fip+wd4t1rWvhb4puPDt34g06TTNQjMS3FtcoVYRytC4KGaBmMkUhGUbcOUeRH/AFS/4JI/8Etv2aPjf+zBJ+0t8cviHafFvWNSlkvPE0/iHWJLTTPDN5lTJBftK6yTXKll3PcN5bh0KIyMkj/ijWr4X8RLpk0NjqX9rX3ha41G0vdX0iz1A2g1NYGbAyVdFlEcs6xytG5j81iAQWB/qDjrgWpm2HnPKq7wtabXtJ04rnqQin7jleMv8PvJXsnpt8nl+YexklVXPFbJvRPvY/oh0jxf/wAEvfj9rP8AwgljZ/s7teXDfZYQmjJo/muTtCwXnlRAuTwpjlyexr4j/wCCoH7Oui/8EA/2ofBfxC/Zt+K154f8QeJnZ734fX80l+fsCliXmP8Ay1sGZfKCXJ83fl4ZGMbtDV/4KD2f/BOrTf8Agm9oviL4T+Fbh/iJ41tWh8OWNhrl0NZ0S5jwJ31eOaWZFjiY4ZWVjOSBA2wmeP8ALvXvEepeKtRW81TUL7VLxYIbUT3lw9xKIYY1ihjDOSdkcaIirnCqiqAAAK/JfDPgKpi6rxkMRiVhE5wq0MTGL9q1poruNk93y8yaaUt7exmmYKEeTljz6NSg9ja+M/xn8VftD/FTXfG3jXXL7xF4q8SXRu9Q1C7bMkzkAAADCpGihUSNAERFVVCqoA/a7/g0/wD24rvxt8OfGHwB168a4m8Fp/wkfhjzDl106aYJdwD/AGIbmSJx3zesOAqgfhXX29/wbm+O7vwV/wAFgfhbb28pjtvEsGr6Pegf8tIjpd1cKv8A3+toT/wGv0bxh4XwmP4LxOHhBR+rw9pTsklH2avZLpeKcfRnm5Hi508dGTfxOz+f/B1P6gqKKK/zbP04KKKKACiiigBCK/jA+LXwvuvgf8WfFfgi+DC98F6ze6BcA/8APS0uJLdv1jNf2gN92v53f+Dn39gW9+A/7WUXxo0axb/hC/iwUj1CWKM+Xp+uRRBXRsDCi4hiWZeSXkjuScYBP9I/Rn4loYDPq2WYhpfWYpRv1nBtpfNOVu7SR8xxRhZVcOqkfsvX0Z+YNFGeKK/u8/PhAoBJxyevvS0UUAA4Ffdv/Btl8Mbv4if8FdPAWoW8Zkt/BOm6v4gveMhYjYy2Kk/9tr6H8a+Eegr+gz/g1x/YBvfgH+zdrHxl8TWL2fiD4tJAuiwzx7ZLbQ4svFLyAV+1SMZR1DRR2zA/Nx+ReOHElDKOEsTGb9+uvZQXVuStJ/KN3f0XU9rIcLKtjItbR1fy/wCCfqrRRRX+bh+nBRRRQAUUUUADDIrgv2kv2dPCP7V3wS8QfD/x1pMOteF/Ett9nvLZyVYEEMksbjmOWN1V0ccqyqR0rvaMVpRrVKNSNajJxlFppp2aa1TT6NMUopqz2P5a/wDgqN/wRR+KH/BN3xLfaulne+NfhMzl7LxZY2xb7DGTgRajGg/0aReB5h/cyZUqwZjEnxju3dOhGa/temtVuIXjkVWjkBVlYZBB6gjuK+PP2hP+CCP7K37R+p3Go6l8LdO8OavdEs974WuZtEJYnLMYYGW3Zm7s0RY5POSa/rTgv6TkqFCOG4koOpKOntKdrv8AxQbSv3aav2PkMdwqpS58LK3k/wBGfyzUKN8iRjLPIwRFAyzseAoHcnsB1r+jTTv+DVP9l+y1Tz5bz4pXkOc/ZZfEESxD2ylur8/72a+pP2Wf+CU37Pv7GGpR6h8O/hf4d0fWoR8msXayanqkZIw2y6umkljDZORGyg8cYAA+vzX6T/D9Gi/7Pw9WpPopKMFfzd5P7kzho8J4hy/eSSX3s/If/gjr/wAG6PiT40eJdI+JH7QOh3XhrwHaul1p/hC/jMWpeI2GGU3cR+a2tc9Y3xLLggqiEM/79WlkljBHFEsccMKhERF2qigYAAHAAHapBHjHP6U6v5M4448zXirH/XsylotIwXwwXZJ9X1b1fySPsMDl9LCU/Z0vm+rCiiivizuCiiigAooooAKKKKACiiigAooooAKKKKACiiigAooooA//2Q==')
 
     listOptions()
     issue_warnings()
-    checkforvalidport() # Exits if invalid
+    if not fleetMember:
+        checkforvalidport() # Exits if invalid
     startMessages()
     startup()
 